@@ -1,24 +1,90 @@
 #!/usr/bin/env python3
 
+import argparse
 import logging
 import os
-import sys
 
-from automatagl.helpers.config_parser import ConfigOps, sanitize_username
-from automatagl.helpers.ssh_key_object import SSHKeyObject
-from automatagl.helpers.user_operations import (
-    UserOps, UOGroupNotFoundError, UOProtectedUserError, UOUserAlreadyExistsError
-)
+from automatagl.helpers.bundle import write_bundle
+from automatagl.helpers.config_parser import ConfigOps
+from automatagl.helpers.file_manifest import FileManifest
+from automatagl.helpers.planner import format_plan, plan_to_json
+from automatagl.helpers.http_cache import HTTPCache
+from automatagl.helpers.purge_queue import PurgeQueue
+from automatagl.helpers.snapshot_store import SnapshotStore
+from automatagl.helpers.ssh_key_parser import KeyParser
+from automatagl.helpers.synchronizer import Synchronizer
+from automatagl.helpers.tracing import tracer
+from automatagl.helpers.user_operations import UserOps
 from automatagl.helpers.providers import automata_providers
 
 
+def parse_arguments(args: list = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments
+    :param args: The arguments to parse (defaults to `sys.argv`)
+    :return: The parsed arguments
+    """
+    parser = argparse.ArgumentParser(description='Create and manage Linux user accounts from a provider.')
+    parser.add_argument('command', nargs='?', choices=['sync', 'export'], default='sync',
+                        help='Synchronize the local system (the default), or export every group to a bundle.')
+    parser.add_argument('-c', '--config', default='/etc/automata/automata.conf',
+                        help='The configuration file to use (defaults to /etc/automata/automata.conf).')
+    parser.add_argument('-o', '--output', default='automata.bundle', help='Where `export` writes the bundle.')
+    parser.add_argument('--signing-key-file', help='Sign the exported bundle with the shared secret in this file.')
+    parser.add_argument('--no-cache', action='store_true', help='Ignore the provider response cache for this run.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, reconciling on an interval and when Gitlab system hooks arrive.')
+    parser.add_argument('--plan', action='store_true', help='Print the changes that would be made.')
+    parser.add_argument('--plan-json', action='store_true', help='Print the changes that would be made as JSON.')
+    parser.add_argument('--apply', action='store_true',
+                        help='Make the changes (the default unless --plan or --plan-json is given).')
+    parser.add_argument('--profile', nargs='?', const='automata.pstats', metavar='FILE',
+                        help='Profile the run with cProfile and write the stats to FILE (defaults to automata.pstats).')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Record HTTP calls, subprocesses and file writes to FILE as a Chrome trace.')
+    return parser.parse_args(args)
+
+
 def main():
 
+    arguments = parse_arguments()
+    profile_file = os.path.abspath(arguments.profile) if arguments.profile else None
+    trace_file = os.path.abspath(arguments.trace) if arguments.trace else None
+
+    if trace_file:
+        tracer.start()
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+    try:
+        if profiler:
+            profiler.runcall(run, arguments)
+        else:
+            run(arguments)
+    finally:
+        if profiler:
+            profiler.dump_stats(profile_file)
+            logging.info("Wrote profile to '{}'.".format(profile_file))
+        if trace_file:
+            tracer.write(trace_file)
+            logging.info("Wrote trace to '{}'.".format(trace_file))
+
+
+def run(arguments: argparse.Namespace) -> None:
+    """
+    Runs Automata with the parsed command line arguments.
+    :param arguments: The parsed command line arguments
+    """
+    config_file = os.path.abspath(arguments.config)
+    output_file = os.path.abspath(arguments.output)
+    signing_key_file = os.path.abspath(arguments.signing_key_file) if arguments.signing_key_file else None
+
     working_dir = os.path.dirname(os.path.realpath(__file__))
     os.chdir(working_dir)
 
     # Grab configuration information
-    config_ops = ConfigOps(filename='/etc/automata/automata.conf')
+    config_ops = ConfigOps(filename=config_file)
 
     # Logging configuration
     logging_config = config_ops.get_logging_config()
@@ -28,9 +94,43 @@ def main():
     provider_config = config_ops.get_provider_config()
     provider_ops = automata_providers[provider_config.provider](config=provider_config.config)
 
+    # Provider response cache configuration
+    cache_config = config_ops.get_cache_config()
+    provider_ops.http_cache = HTTPCache(
+        cache_dir=cache_config.path,
+        max_size=cache_config.max_size,
+        enabled=cache_config.enabled and not arguments.no_cache,
+    )
+
     # Automata configuration
     automata_config = config_ops.get_server_config()
 
+    # Export every group to a bundle instead of touching the local system.
+    if arguments.command == 'export':
+        signing_key = None
+        if signing_key_file:
+            with open(signing_key_file, 'rb') as f:
+                signing_key = f.read().strip()
+        group_members = provider_ops.fetch_groups([group.provider_group for group in automata_config.groups])
+        write_bundle(output_file, group_members, signing_key)
+        logging.info("Exported {} groups to '{}'.".format(len(group_members), output_file))
+        return
+
+    # Only `--plan` and `--plan-json` without `--apply` leave the local system alone.
+    apply = arguments.daemon or arguments.apply or not (arguments.plan or arguments.plan_json)
+
+    # Deleted users' homes are removed in the background if deferred purging is enabled.  A dry run does not purge.
+    purge_config = config_ops.get_purge_config()
+    purge_queue = None
+    if purge_config.enabled and apply:
+        purge_queue = PurgeQueue(
+            queue_file=os.path.join(automata_config.state_dir, 'purge_queue.json'),
+            tombstone_dir=os.path.join(automata_config.home_dir_path, '.automata-purge'),
+            retention=purge_config.retention,
+            files_per_second=purge_config.files_per_second,
+        )
+        purge_queue.start()
+
     # Set host environment and user operations stuff
     default_shell = '/bin/bash'
     host_env = os.environ.copy()
@@ -41,101 +141,50 @@ def main():
         base_dir=automata_config.home_dir_path,
         protected_uid_start=automata_config.protected_uid_start,
         protected_gid_start=automata_config.protected_gid_start,
+        manifest=FileManifest(os.path.join(automata_config.state_dir, 'manifest.json')),
+        backend=automata_config.backend,
+        purge_queue=purge_queue,
     )
 
-    # Get all members of a given group
-    logging.debug("Processing {} groups from the config file.".format(len(automata_config.groups)))
-
-    # Create a cache of created users.
-    finished_users = list()
-
-    # Start by parsing each group.
-    for group in automata_config.groups:
-        logging.debug("Querying users in group '{}'.".format(group.provider_group))
-        members = provider_ops.get_users_from_group(group.provider_group)
-
-        # Get associated SSH keys for members
-        ssh_list = list()
-        for member in members:
-            ssh_obj = SSHKeyObject(username=member.username)
-            logging.debug("Querying user SSH key information for {}.".format(member.username))
-            ssh_obj.add_keys(member.keys)
-            ssh_list.append(ssh_obj)
-
-        # Get list of user accounts in the group from the '/etc/group' file
+    # Synchronize the local system with the provider.
+    key_parser = KeyParser(config_ops.get_key_policy(), os.path.join(automata_config.state_dir, 'key_cache.json'))
+    snapshot_config = config_ops.get_snapshot_config()
+    snapshots = None
+    if snapshot_config.enabled:
+        snapshots = SnapshotStore(
+            snapshot_dir=snapshot_config.path,
+            max_staleness=snapshot_config.max_staleness,
+            revalidate_timeout=snapshot_config.revalidate_timeout,
+        )
+    synchronizer = Synchronizer(
+        provider_ops, user_ops, automata_config, config_ops.get_metrics_config(), key_parser, snapshots
+    )
+    if arguments.daemon:
+        # Only the daemon needs the HTTP server, so one-shot runs do not import it.
+        from automatagl.helpers.daemon import AutomataDaemon
+        AutomataDaemon(synchronizer, config_ops.get_daemon_config()).run()
+    else:
+        success = False
         try:
-            linux_group_id = user_ops.get_group_gid(group.linux_group)
-        except UOGroupNotFoundError:
-            logging.info("Group not found, creating the '{}' group.".format(group.linux_group))
-            user_ops.create_group(group.linux_group)
-            linux_group_id = user_ops.get_group_gid(group.linux_group)
-
-        # Start removing users with extreme prejudice that are no longer in the GitLab group.
-        current_users = user_ops.get_all_users_in_group(linux_group_id)
-        provider_users = {sanitize_username(i.username) for i in ssh_list}
-        removed_users = current_users - provider_users
-        if removed_users:
-            logging.info("Found {} users to delete in group {}: {}".format(
-                len(removed_users),
-                group.linux_group,
-                ', '.join(removed_users),
-            ))
-        else:
-            logging.info("No users to delete in group {}.".format(group.linux_group))
-
-        # Deleting users that have been removed
-        for user in removed_users:
-            logging.info("Deleting user {}.".format(user))
-            try:
-                user_ops.delete_user(user)
-            except UOProtectedUserError:
-                logging.info("Cannot delete user '{}' as it is a protected system user.".format(user))
-                sys.exit(101)
-
-        # Create new users in group
-        created_users = provider_users - current_users
-        if created_users:
-            logging.info("Found {} users to create in group {}: {}".format(
-                len(created_users),
-                group.linux_group,
-                ', '.join(created_users),
-            ))
-        else:
-            logging.info("No users to add to group {}.".format(group.linux_group))
-
-        for user in created_users:
-            if user not in set(finished_users):
-                logging.info("Creating user {}.".format(user))
-                user_data = {
-                    "user": user,
-                    "group": group.linux_group,
-                    "groups": group.other_groups,
-                }
-                try:
-                    user_ops.create_user(**user_data)
-                except UOUserAlreadyExistsError:
-                    logging.info("User '{}' already exists, deleting user.".format(user))
-                    try:
-                        user_ops.delete_user(user)
-                    except UOProtectedUserError:
-                        logging.info("Cannot delete user '{}' as it is a protected system user.".format(user))
-                        sys.exit(101)
-                    logging.info("Recreating user '{}'.".format(user))
-                    user_ops.create_user(**user_data)
-            else:
-                logging.info("Skipping user {}, handled previously in another group.".format(user))
-
-        # Create the SSH authorized_keys file so the user can actually log in.
-        for ssh_keys in ssh_list:
-            user_ops.populate_ssh_file(
-                ssh_keys=ssh_keys,
-                gid=linux_group_id,
-            )
-
-        # Add users to the finished_users table
-        finished_users = list(set(provider_users).union(finished_users))
-        logging.debug("Finished users list now contains {} members.".format(len(finished_users)))
-
-    # Create the sudoers.d file.
-    logging.info("Regenerating the '{}' file.".format(automata_config.sudoers_file))
-    user_ops.generate_sudoers_file(automata_config.sudoers_file, automata_config.groups)
+            # A dry run waits for the provider, there is no point in showing a plan that is about to change.  Without a
+            # plan to show, the groups are applied while they are fetched.
+            synchronizer.fetch(serve_stale=apply, apply_early=apply and not (arguments.plan or arguments.plan_json))
+            plan = synchronizer.plan()
+            if arguments.plan:
+                print(format_plan(plan))
+            if arguments.plan_json:
+                print(plan_to_json(plan))
+            if apply:
+                synchronizer.apply(plan)
+                if synchronizer.revalidate():
+                    synchronizer.apply()
+            synchronizer.check_refused()
+            success = True
+        finally:
+            # Only runs that change the system are reported, a dry run does not replace the last run's metrics.
+            if apply:
+                synchronizer.write_metrics(success)
+
+    # Give the purge worker a chance to catch up, anything left over is picked up on the next run.
+    if purge_queue:
+        purge_queue.finish(timeout=purge_config.max_runtime)
@@ -0,0 +1,37 @@
+from typing import Union
+import os
+import tempfile
+
+__all__ = [
+    'write_atomically',
+]
+
+
+def write_atomically(path: str, contents: Union[str, bytes], mode: int = 0o644, uid: int = None,
+                     gid: int = None) -> None:
+    """
+    Writes the contents to a temporary file in the same directory, syncs it to disk and renames it over `path`, so
+    readers see either the old or the new file, never a partial one.  The temporary file is removed on failure.
+    :param path: The file to replace
+    :param contents: The new contents of the file
+    :param mode: The permissions of the new file
+    :param uid: The owner of the new file (left to the current user if `None`)
+    :param gid: The group of the new file (left to the current group if `None`)
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.{}.'.format(name))
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(contents, bytes) else 'w') as f:
+            f.write(contents)
+            f.flush()
+            if uid is not None or gid is not None:
+                os.fchown(f.fileno(), -1 if uid is None else uid, -1 if gid is None else gid)
+            os.fchmod(f.fileno(), mode)
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
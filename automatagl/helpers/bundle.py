@@ -0,0 +1,92 @@
+from typing import Dict, List
+import hashlib
+import hmac
+import json
+import time
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.provider_operations import ProviderUser
+
+__all__ = [
+    'bundle_version',
+    'read_bundle',
+    'write_bundle',
+    'BNDError',
+    'BNDFormatError',
+    'BNDGroupNotFoundError',
+    'BNDSignatureError',
+]
+
+bundle_version = 1
+
+
+def write_bundle(path: str, group_members: Dict[str, List[ProviderUser]], signing_key: bytes = None) -> None:
+    """
+    Atomically writes the members and keys of every group to a bundle file.  The file is a JSON header line followed by
+    a compact JSON payload line; the header carries an HMAC-SHA256 of the payload if a signing key is given.
+    :param path: Where to write the bundle
+    :param group_members: The provider members of every group
+    :param signing_key: The shared secret to sign the bundle with (unsigned if `None`)
+    """
+    payload = json.dumps({
+        'created': int(time.time()),
+        'groups': {group: [[i.username, list(i.keys)] for i in members] for group, members in group_members.items()},
+    }, separators=(',', ':')).encode('utf-8')
+    header = {'version': bundle_version}
+    if signing_key:
+        header['signature'] = hmac.new(signing_key, payload, hashlib.sha256).hexdigest()
+
+    write_atomically(path, json.dumps(header).encode('utf-8') + b'\n' + payload + b'\n')
+
+
+def read_bundle(path: str, signing_key: bytes = None) -> Dict[str, List[ProviderUser]]:
+    """
+    Reads and verifies a bundle written by `write_bundle`.
+    :param path: The bundle to read
+    :param signing_key: The shared secret the bundle must be signed with (signature not checked if `None`)
+    :return: A dictionary of group name to ProviderUsers
+    :raises BNDFormatError: If the bundle cannot be parsed or is a version this release does not understand
+    :raises BNDSignatureError: If the bundle is unsigned or its signature does not match
+    """
+    with open(path, 'rb') as f:
+        header_line, _, payload = f.read().partition(b'\n')
+    try:
+        header = json.loads(header_line.decode('utf-8'))
+    except ValueError:
+        raise BNDFormatError("'{}' is not an Automata bundle.".format(path))
+    if not isinstance(header, dict):
+        raise BNDFormatError("'{}' is not an Automata bundle.".format(path))
+    if header.get('version') != bundle_version:
+        raise BNDFormatError("Unsupported bundle version '{}'.".format(header.get('version')))
+    payload = payload.rstrip(b'\n')
+    if signing_key:
+        expected = hmac.new(signing_key, payload, hashlib.sha256).hexdigest()
+        signature = header.get('signature')
+        if not isinstance(signature, str) or not hmac.compare_digest(expected, signature):
+            raise BNDSignatureError("The signature of '{}' does not match.".format(path))
+    try:
+        groups = json.loads(payload.decode('utf-8'))['groups']
+        return {
+            group: [ProviderUser(username=username, keys=keys) for username, keys in members]
+            for group, members in groups.items()
+        }
+    except (ValueError, KeyError, TypeError, AttributeError):
+        raise BNDFormatError("Cannot parse the payload of '{}'.".format(path))
+
+
+class BNDError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class BNDFormatError(BNDError):
+    pass
+
+
+class BNDSignatureError(BNDError):
+    pass
+
+
+class BNDGroupNotFoundError(BNDError):
+    pass
@@ -4,7 +4,18 @@ import re
 import sys
 import yaml
 
-from automatagl.helpers.provider_operations import AutomataGroupConfig, ProviderConfig, AutomataConfig
+from automatagl.helpers.provider_operations import (
+    AutomataConfig,
+    AutomataGroupConfig,
+    CacheConfig,
+    DaemonConfig,
+    KeyPolicy,
+    MetricsConfig,
+    ProviderConfig,
+    PurgeConfig,
+    SnapshotConfig,
+)
+from automatagl.helpers.ssh_key_parser import default_key_policy
 
 # Dictionary to translate logging levels in the config file
 log_level_dict = {
@@ -35,6 +46,9 @@ class ConfigOps:
         self.provider_config = self.raw_config['config']
         self.server_config = self.raw_config['server']
         self.logging_config = self.raw_config['logging']
+        self.cache_config = self.raw_config.get('cache') or dict()
+        self.metrics_config = self.raw_config.get('metrics') or dict()
+        self.snapshot_config = self.raw_config.get('snapshots') or dict()
         self.api_token_env = api_token_env
 
     def get_logging_config(self) -> dict:
@@ -85,6 +99,11 @@ class ConfigOps:
             home_dir_path=self.server_config['home_dir_path'],
             protected_uid_start=protected_uid_start,
             protected_gid_start=protected_gid_start,
+            state_dir=self.server_config.get('state_dir', '/var/lib/automata'),
+            backend=self.server_config.get('backend', 'useradd'),
+            key_index=self.server_config.get('key_index', ''),
+            authorized_keys_files=self.server_config.get('authorized_keys_files', True),
+            pipeline_depth=self.server_config.get('pipeline_depth', 8),
         )
 
     def get_provider_config(self) -> ProviderConfig:
@@ -100,6 +119,85 @@ class ConfigOps:
             config=provider_config,
         )
 
+    def get_cache_config(self) -> CacheConfig:
+        """
+        Returns the provider response cache configuration, filling in defaults for anything not in the config file
+        :return: CacheConfig object
+        """
+        return CacheConfig(
+            enabled=self.cache_config.get('enabled', True),
+            path=self.cache_config.get('path', '/var/cache/automata'),
+            max_size=self.cache_config.get('max_size', 64 * 1024 * 1024),
+        )
+
+    def get_snapshot_config(self) -> SnapshotConfig:
+        """
+        Returns the provider snapshot configuration, the snapshots are kept in `snapshots` in the state directory by
+        default
+        :return: SnapshotConfig object
+        """
+        state_dir = self.server_config.get('state_dir', '/var/lib/automata')
+        return SnapshotConfig(
+            enabled=self.snapshot_config.get('enabled', False),
+            path=self.snapshot_config.get('path', str(Path(state_dir, 'snapshots'))),
+            max_staleness=self.snapshot_config.get('max_staleness', 86400),
+            revalidate_timeout=self.snapshot_config.get('revalidate_timeout', 30),
+        )
+
+    def get_daemon_config(self) -> DaemonConfig:
+        """
+        Returns the configuration used when running as a daemon
+        :return: DaemonConfig object
+        """
+        daemon_config = self.server_config.get('daemon') or dict()
+        return DaemonConfig(
+            interval=daemon_config.get('interval', 900),
+            listen_address=daemon_config.get('listen_address', '127.0.0.1'),
+            listen_port=daemon_config.get('listen_port', 0),
+            hook_token=daemon_config.get('hook_token', ''),
+            debounce=daemon_config.get('debounce', 1),
+            watch_files=daemon_config.get('watch_files', False),
+        )
+
+    def get_purge_config(self) -> PurgeConfig:
+        """
+        Returns the deferred home directory purge configuration.  `deferred_purge` is either a boolean or a mapping of
+        the purge settings, any value but `false` enables the purge (with the defaults if it is not a mapping).
+        :return: PurgeConfig object
+        """
+        deferred_purge = self.server_config.get('deferred_purge', False)
+        purge_config = deferred_purge if isinstance(deferred_purge, dict) else dict()
+        return PurgeConfig(
+            enabled=deferred_purge is not False,
+            retention=purge_config.get('retention', 0),
+            files_per_second=purge_config.get('files_per_second', 0),
+            max_runtime=purge_config.get('max_runtime', 300),
+        )
+
+    def get_key_policy(self) -> KeyPolicy:
+        """
+        Returns the SSH key types and minimum key sizes to accept.  By default, every key type OpenSSH accepts except
+        `ssh-dss` is allowed, and RSA keys need at least 2048 bits.
+        :return: KeyPolicy object
+        """
+        key_policy = self.server_config.get('key_policy') or dict()
+        return KeyPolicy(
+            allowed_types=key_policy.get('allowed_types', default_key_policy.allowed_types),
+            min_bits=dict(default_key_policy.min_bits, **key_policy.get('min_bits', dict())),
+        )
+
+    def get_metrics_config(self) -> MetricsConfig:
+        """
+        Returns where the run metrics are written.  The Prometheus textfile is only written if a path is configured,
+        the JSON run summary defaults to `last_run.json` in the state directory.
+        :return: MetricsConfig object
+        """
+        state_dir = self.server_config.get('state_dir', '/var/lib/automata')
+        return MetricsConfig(
+            textfile=self.metrics_config.get('textfile', ''),
+            summary_file=self.metrics_config.get('summary_file', str(Path(state_dir, 'last_run.json'))),
+        )
+
     @staticmethod
     def __import_config(filename: str) -> dict:
         """
@@ -0,0 +1,198 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import List, Set
+import hmac
+import json
+import logging
+import signal
+import threading
+import time
+
+from automatagl.helpers.drift_watcher import DriftWatcher, DWNotSupportedError
+from automatagl.helpers.provider_operations import DaemonConfig
+from automatagl.helpers.synchronizer import Synchronizer
+
+__all__ = [
+    'AutomataDaemon',
+]
+
+# Gitlab system hook events that trigger a resync
+membership_events = ('user_add_to_group', 'user_remove_from_group', 'user_update_for_group')
+key_events = ('key_create', 'key_destroy')
+
+
+class AutomataDaemon:
+    """
+    Keeps Automata running: full reconciliations happen every `interval` seconds, and Gitlab system hooks received on
+    the local HTTP endpoint trigger a resync of only the affected groups within seconds.  If `watch_files` is set,
+    managed files changed outside of Automata are repaired from the last desired state as soon as they are touched.
+    """
+
+    config: DaemonConfig
+    synchronizer: Synchronizer
+
+    def __init__(self, synchronizer: Synchronizer, config: DaemonConfig) -> None:
+        """
+        :param synchronizer: The synchronizer to run, kept (along with its provider and user state) between runs
+        :param config: The daemon configuration
+        """
+        self.synchronizer = synchronizer
+        self.config = config
+        self.server = None
+        self.watcher = None
+        self.__pending = set()
+        self.__drifted = set()
+        self.__full_runs = 0
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__stop = threading.Event()
+
+    def run(self) -> None:
+        """
+        Runs until SIGTERM/SIGINT is received.
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        if self.config.listen_port and not self.config.hook_token:
+            # Without a token, anyone who can reach the port could make Automata hammer the provider.
+            logging.error("Not listening for system hooks, `hook_token` must be set to use `listen_port`.")
+        elif self.config.listen_port:
+            self.server = HTTPServer((self.config.listen_address, self.config.listen_port), self.__handler())
+            threading.Thread(target=self.server.serve_forever, name='automata-hooks', daemon=True).start()
+            logging.info("Listening for system hooks on {}:{}.".format(*self.server.server_address))
+        if self.config.watch_files:
+            try:
+                self.watcher = DriftWatcher(self.queue_repair)
+                self.watcher.start()
+            except DWNotSupportedError as e:
+                logging.warning("Not watching managed files: {}".format(e.message))
+
+        next_full_run = time.monotonic()
+        while not self.__stop.is_set():
+            if time.monotonic() >= next_full_run:
+                logging.info("Starting a full reconciliation.")
+                self.__safe_run(None)
+                next_full_run = time.monotonic() + self.config.interval
+                with self.__lock:
+                    self.__pending.clear()
+            self.__wakeup.wait(max(next_full_run - time.monotonic(), 0))
+            self.__wakeup.clear()
+            with self.__lock:
+                hooked = bool(self.__pending)
+            if hooked:
+                # Give related hooks (e.g. a user added to several groups) a moment to arrive together.
+                self.__stop.wait(self.config.debounce)
+            with self.__lock:
+                groups, self.__pending = sorted(self.__pending), set()
+                drifted, self.__drifted = sorted(self.__drifted), set()
+            if groups and not self.__stop.is_set():
+                logging.info("Resyncing groups after system hooks: {}".format(', '.join(groups)))
+                self.__safe_run(groups)
+            if drifted and not self.__stop.is_set():
+                self.__safe_repair(drifted)
+
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.watcher:
+            self.watcher.stop()
+
+    def stop(self) -> None:
+        self.__stop.set()
+        self.__wakeup.set()
+
+    def queue_resync(self, provider_groups: List[str]) -> None:
+        """
+        Schedules a resync of some groups.
+        :param provider_groups: The provider groups to fetch again
+        """
+        if not provider_groups:
+            return
+        with self.__lock:
+            self.__pending.update(provider_groups)
+        self.__wakeup.set()
+
+    def queue_repair(self, paths: List[str]) -> None:
+        """
+        Schedules a check of managed files that were touched.
+        :param paths: The paths of the managed files
+        """
+        with self.__lock:
+            self.__drifted.update(paths)
+        self.__wakeup.set()
+
+    def groups_for_hook(self, payload: dict) -> Set[str]:
+        """
+        Works out which configured groups a Gitlab system hook affects.
+        :param payload: The decoded system hook
+        :return: The affected provider groups
+        """
+        event = payload.get('event_name')
+        configured = [group.provider_group for group in self.synchronizer.automata_config.groups]
+        if event in membership_events:
+            names = {str(payload.get(i)) for i in ('group_id', 'group_path', 'group_name', 'full_path')}
+            return {group for group in configured if str(group) in names}
+        if event in key_events:
+            # Only the groups the key's owner is a member of need to be refreshed.
+            username = payload.get('username')
+            return {
+                group for group in configured
+                if any(i.username == username for i in self.synchronizer.group_members.get(group, list()))
+            }
+        return set()
+
+    def __safe_run(self, provider_groups: List[str] = None) -> None:
+        try:
+            if provider_groups is None:
+                # The index built at startup is kept up to date with Automata's own changes only, so every full run
+                # after the first one starts from the databases as they are now.
+                if self.__full_runs:
+                    self.synchronizer.user_ops.reload_local_state()
+                self.__full_runs += 1
+            self.synchronizer.run(provider_groups)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Synchronization failed, retrying on the next trigger.")
+        self.__update_watches()
+
+    def __safe_repair(self, paths: List[str]) -> None:
+        try:
+            self.synchronizer.repair(paths)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Repairing managed files failed, retrying on the next trigger.")
+        self.__update_watches()
+
+    def __update_watches(self) -> None:
+        if self.watcher:
+            self.watcher.watch(list(self.synchronizer.user_ops.manifest.entries))
+
+    def __handler(self):
+        daemon = self
+
+        class SystemHookHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                token = self.headers.get('X-Gitlab-Token', '')
+                if not hmac.compare_digest(token.encode('utf-8'), str(daemon.config.hook_token).encode('utf-8')):
+                    self.__respond(403)
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    payload = json.loads(self.rfile.read(length).decode('utf-8'))
+                except ValueError:
+                    self.__respond(400)
+                    return
+                groups = daemon.groups_for_hook(payload)
+                logging.debug("Received system hook '{}' affecting: {}".format(
+                    payload.get('event_name'), ', '.join(sorted(groups)) or 'nothing',
+                ))
+                daemon.queue_resync(sorted(groups))
+                self.__respond(202)
+
+            def __respond(self, code: int) -> None:
+                self.send_response(code)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                logging.debug("System hook request: %s", format % args)
+
+        return SystemHookHandler
@@ -0,0 +1,190 @@
+from typing import Callable, Iterable, List, Set
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+__all__ = [
+    'DriftWatcher',
+    'DWError',
+    'DWNotSupportedError',
+]
+
+# inotify flags from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Managed files are replaced by renaming a temporary file over them (and so are files saved by most editors), so the
+# directories holding them are watched rather than the files themselves.
+watch_mask = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+    IN_MOVE_SELF | IN_ONLYDIR
+)
+event_header = struct.Struct('iIII')
+
+
+class DriftWatcher:
+    """
+    Watches the files Automata manages with inotify and reports the ones that were touched, so they can be repaired
+    without waiting for the next full run.  Automata's own writes are reported too; the callback is expected to skip
+    files that still match the file manifest.
+    """
+
+    callback: Callable[[List[str]], None]
+    settle: float
+
+    def __init__(self, callback: Callable[[List[str]], None], settle: float = 0.1) -> None:
+        """
+        :param callback: Called from the watcher thread with the paths of managed files that were touched
+        :param settle: How long to wait for further events before reporting a burst of them, in seconds
+        :raises DWNotSupportedError: If inotify is not available on this system
+        """
+        self.callback = callback
+        self.settle = settle
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self.__inotify_init1 = libc.inotify_init1
+            self.__inotify_add_watch = libc.inotify_add_watch
+            self.__inotify_rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise DWNotSupportedError('inotify is not available on this system.')
+        self.__inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.__inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.__fd = self.__inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise DWNotSupportedError('Cannot initialize inotify: {}'.format(os.strerror(ctypes.get_errno())))
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.__files = dict()
+        self.__wd_by_dir = dict()
+        self.__dir_by_wd = dict()
+        self.__out_of_watches = False
+
+    def watch(self, paths: Iterable[str]) -> None:
+        """
+        Replaces the set of watched files.  Directories that no longer hold a managed file stop being watched.
+        :param paths: The paths of every managed file
+        """
+        files = dict()
+        for path in paths:
+            directory, name = os.path.split(path)
+            files.setdefault(directory, set()).add(name)
+        with self.__lock:
+            self.__files = files
+            for directory in set(self.__wd_by_dir) - set(files):
+                self.__inotify_rm_watch(self.__fd, self.__wd_by_dir.pop(directory))
+            for directory in set(files) - set(self.__wd_by_dir):
+                self.__add_watch(directory)
+
+    def start(self) -> None:
+        """
+        Starts the thread that reads inotify events.
+        """
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='automata-drift', daemon=True)
+            self.__thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the watcher thread and closes the inotify instance.
+        """
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+        os.close(self.__fd)
+
+    def __add_watch(self, directory: str) -> None:
+        if self.__out_of_watches:
+            return
+        wd = self.__inotify_add_watch(self.__fd, os.fsencode(directory), watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self.__out_of_watches = True
+                logging.warning("Ran out of inotify watches, raise fs.inotify.max_user_watches to watch every file.")
+            elif error != errno.ENOENT:
+                logging.debug("Cannot watch '{}': {}".format(directory, os.strerror(error)))
+            return
+        self.__wd_by_dir[directory] = wd
+        self.__dir_by_wd[wd] = directory
+
+    def __run(self) -> None:
+        while not self.__stop.is_set():
+            readable, _, _ = select.select([self.__fd], [], [], 1)
+            if not readable:
+                continue
+            touched = self.__read_events()
+            # A single edit is several events (write, close, rename), which may not all be read at once: wait for the
+            # burst to end, so every touched file is reported once.
+            deadline = time.monotonic() + 10 * self.settle
+            while touched and time.monotonic() < deadline and select.select([self.__fd], [], [], self.settle)[0]:
+                touched.update(self.__read_events())
+            if touched:
+                try:
+                    self.callback(sorted(touched))
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception("Drift watcher callback failed.")
+
+    def __read_events(self) -> Set[str]:
+        try:
+            return self.__parse_events(os.read(self.__fd, 64 * 1024))
+        except BlockingIOError:
+            return set()
+
+    def __parse_events(self, data: bytes) -> Set[str]:
+        """
+        Turns a buffer of inotify events into the managed files they touched.
+        """
+        touched, offset = set(), 0
+        with self.__lock:
+            while offset + event_header.size <= len(data):
+                wd, mask, _, length = event_header.unpack_from(data, offset)
+                name = os.fsdecode(data[offset + event_header.size:offset + event_header.size + length].rstrip(b'\0'))
+                offset += event_header.size + length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost, so every managed file might have drifted.
+                    touched.update(os.path.join(d, n) for d, names in self.__files.items() for n in names)
+                    continue
+                directory = self.__dir_by_wd.get(wd)
+                if directory is None:
+                    continue
+                names = self.__files.get(directory, set())
+                if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                    # The directory itself is gone, the files in it will be recreated (and watched) by the repair.
+                    touched.update(os.path.join(directory, n) for n in names)
+                    if mask & IN_IGNORED:
+                        self.__dir_by_wd.pop(wd, None)
+                        if self.__wd_by_dir.get(directory) == wd:
+                            del self.__wd_by_dir[directory]
+                elif name in names:
+                    touched.add(os.path.join(directory, name))
+        return touched
+
+
+class DWError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class DWNotSupportedError(DWError):
+    pass
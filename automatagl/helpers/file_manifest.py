@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+import os
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
+
+__all__ = [
+    'FileManifest',
+]
+
+
+class FileManifest:
+    """
+    Keeps track of the content hash, owner and mode of every file Automata manages so unchanged files are never
+    rewritten.  Changed files are replaced atomically.
+    """
+
+    entries: dict
+    manifest_file: str
+    rewritten: int
+    skipped: int
+
+    def __init__(self, manifest_file: str = None) -> None:
+        """
+        :param manifest_file: Where to persist the manifest between runs (not persisted if `None`)
+        """
+        self.manifest_file = manifest_file
+        self.entries = dict()
+        self.rewritten = 0
+        self.skipped = 0
+        if self.manifest_file:
+            try:
+                with open(self.manifest_file, 'r') as f:
+                    self.entries = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError):
+                logging.warning("Cannot read the file manifest '{}', all files will be rewritten.".format(manifest_file))
+
+    def is_current(self, path: str, contents: str, uid: int = None, gid: int = None, mode: int = 0o644) -> bool:
+        """
+        Checks whether a file on disk still matches what was last written to it and what should be written now.
+        :param path: The path of the file
+        :param contents: The contents the file should have
+        :param uid: The UID that should own the file
+        :param gid: The GID that should own the file
+        :param mode: The permissions the file should have
+        :return: True if the file does not need to be written
+        """
+        entry = self.entries.get(path)
+        if not entry or entry['sha256'] != self.__hash(contents):
+            return False
+        if (uid, gid, mode) != (entry['uid'], entry['gid'], entry['mode']):
+            return False
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return entry['stat'] == self.__stat_signature(stat)
+
+    def write_file(self, path: str, contents: str, uid: int = None, gid: int = None, mode: int = 0o644) -> bool:
+        """
+        Writes a managed file if it changed.  The new contents are written to a temporary file in the same directory,
+        synced to disk and renamed over the original.
+        :param path: The path of the file
+        :param contents: The contents of the file
+        :param uid: The UID that owns the file (left alone if `None`)
+        :param gid: The GID that owns the file (left alone if `None`)
+        :param mode: The permissions of the file
+        :return: True if the file was written, False if it was already up to date
+        """
+        if self.is_current(path, contents, uid, gid, mode):
+            self.skipped += 1
+            metrics.increment('files_skipped')
+            return False
+        with tracer.span('write_file', path=path):
+            write_atomically(path, contents, mode, uid, gid)
+        self.entries[path] = {
+            'sha256': self.__hash(contents),
+            'uid': uid,
+            'gid': gid,
+            'mode': mode,
+            'stat': self.__stat_signature(os.stat(path)),
+        }
+        self.rewritten += 1
+        metrics.increment('files_written')
+        metrics.increment('bytes_written', len(contents.encode('utf-8')))
+        return True
+
+    def forget(self, path: str) -> None:
+        """
+        Stops tracking a file (for example when its owner has been deleted).
+        :param path: The path of the file
+        """
+        self.entries.pop(path, None)
+
+    def save(self) -> None:
+        """
+        Atomically persists the manifest to `manifest_file`.
+        """
+        if not self.manifest_file:
+            return
+        directory = os.path.dirname(self.manifest_file)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        write_atomically(self.manifest_file, json.dumps(self.entries), mode=0o600)
+
+    @staticmethod
+    def __hash(contents: str) -> str:
+        return hashlib.sha256(contents.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def __stat_signature(stat: os.stat_result) -> list:
+        """
+        The parts of a file's metadata that change whenever somebody else touches it.
+        """
+        return [stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_uid, stat.st_gid, stat.st_mode & 0o7777]
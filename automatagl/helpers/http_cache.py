@@ -0,0 +1,192 @@
+from typing import TYPE_CHECKING
+from urllib.parse import urlencode
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+
+# `requests` is only imported once a response has to be rebuilt, so providers that never touch the network (and the
+# rest of Automata) do not pay for importing it.
+if TYPE_CHECKING:
+    import requests
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
+
+__all__ = [
+    'HTTPCache',
+]
+
+
+class HTTPCache:
+    """
+    An on-disk cache of provider responses that revalidates entries with `ETag`/`Last-Modified` validators.  Entries
+    are evicted least-recently-used first once the cache grows beyond `max_size` bytes.
+    """
+
+    cache_dir: str
+    enabled: bool
+    hits: int
+    misses: int
+    max_size: int
+
+    # Response headers that are stored alongside the body (needed for pagination).
+    stored_headers = ('Content-Type', 'ETag', 'Last-Modified', 'Link', 'X-Next-Page', 'X-Total', 'X-Total-Pages')
+
+    def __init__(self, cache_dir: str = '/var/cache/automata', max_size: int = 64 * 1024 * 1024,
+                 enabled: bool = True) -> None:
+        """
+        :param cache_dir: The directory to store cached responses in
+        :param max_size: The maximum size of the cache in bytes
+        :param enabled: If disabled, every request goes straight to the server
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__size = 0
+        if self.enabled:
+            try:
+                os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+                self.__size = sum(i.stat().st_size for i in self.__entries())
+            except OSError:
+                logging.warning("Cannot use '{}' as the HTTP cache directory, caching disabled.".format(cache_dir))
+                self.enabled = False
+
+    def get(self, session, url: str, params: dict = None, headers: dict = None, **kwargs) -> 'requests.Response':
+        """
+        Perform a GET request, using the cached body if the server reports that it has not changed.
+        :param session: The `HTTPClient` (or a `requests.Session`) to send the request with
+        :param url: The URL to query
+        :param params: Query string parameters to send along with the request
+        :param headers: Additional headers to send along with the request
+        :return: The response, rebuilt from the cache on a `304 Not Modified`
+        """
+        metrics.increment('http_requests')
+        with tracer.span('GET', url=url):
+            return self.__get(session, url, params, headers, **kwargs)
+
+    def __get(self, session, url: str, params: dict = None, headers: dict = None, **kwargs) -> 'requests.Response':
+        if not self.enabled:
+            return session.get(url, params=params, headers=headers, **kwargs)
+
+        entry_path = self.__entry_path(url, params)
+        entry = self.__load(entry_path)
+        request_headers = dict(headers or {})
+        if entry:
+            if entry['headers'].get('ETag'):
+                request_headers['If-None-Match'] = entry['headers']['ETag']
+            if entry['headers'].get('Last-Modified'):
+                request_headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+
+        response = session.get(url, params=params, headers=request_headers, **kwargs)
+        if response.status_code == 304 and entry:
+            with self.__lock:
+                self.hits += 1
+            metrics.increment('http_cache_hits')
+            try:
+                os.utime(entry_path)
+            except OSError:
+                pass
+            return self.__build_response(response, entry)
+
+        with self.__lock:
+            self.misses += 1
+        if response.status_code == 200 and ('ETag' in response.headers or 'Last-Modified' in response.headers):
+            # The body is stored as the bytes the server sent: `response.text` would keep a decoded copy of every
+            # page around (and decode it again on every hit).
+            self.__store(entry_path, {
+                'headers': {k: response.headers[k] for k in self.stored_headers if k in response.headers},
+                'content': base64.b64encode(response.content).decode('ascii'),
+            })
+        return response
+
+    def __entry_path(self, url: str, params: dict = None) -> str:
+        """
+        Generates the file name of a cache entry from the request URL and query string.
+        :param url: The URL of the request
+        :param params: Query string parameters of the request
+        :return: The path of the cache entry
+        """
+        query = urlencode(sorted((params or {}).items()))
+        digest = hashlib.sha256('{}?{}'.format(url, query).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(digest))
+
+    def __entries(self) -> list:
+        return [i for i in os.scandir(self.cache_dir) if i.name.endswith('.json') and i.is_file()]
+
+    @staticmethod
+    def __load(entry_path: str) -> dict:
+        """
+        Reads a cache entry, decoding the stored body.
+        :param entry_path: The path of the cache entry
+        :return: The cache entry, or an empty dictionary if there is none (or it was written by an older version)
+        """
+        try:
+            with open(entry_path, 'r') as f:
+                entry = json.load(f)
+            entry['content'] = base64.b64decode(entry['content'])
+            return entry
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def __store(self, entry_path: str, entry: dict) -> None:
+        """
+        Atomically writes a cache entry and evicts old entries if the cache is now too big.
+        :param entry_path: The path of the cache entry
+        :param entry: The headers and body to store
+        """
+        data = json.dumps(entry).encode('utf-8')
+        try:
+            previous_size = os.path.getsize(entry_path)
+        except OSError:
+            previous_size = 0
+        try:
+            write_atomically(entry_path, data, mode=0o600)
+        except OSError:
+            logging.debug("Could not write HTTP cache entry '{}'.".format(entry_path))
+            return
+        with self.__lock:
+            self.__size += len(data) - previous_size
+            if self.__size > self.max_size:
+                self.__evict()
+
+    def __evict(self) -> None:
+        """
+        Removes the least recently used entries until the cache fits in `max_size` again.
+        """
+        entries = sorted(self.__entries(), key=lambda i: i.stat().st_mtime)
+        self.__size = sum(i.stat().st_size for i in entries)
+        for entry in entries:
+            if self.__size <= self.max_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self.__size -= size
+            except OSError:
+                pass
+
+    @staticmethod
+    def __build_response(not_modified: 'requests.Response', entry: dict) -> 'requests.Response':
+        """
+        Rebuild a full response from a cache entry.
+        :param not_modified: The `304 Not Modified` response from the server
+        :param entry: The cache entry
+        :return: A `200 OK` response with the cached headers and body
+        """
+        import requests
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = not_modified.url
+        response.request = not_modified.request
+        response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response._content = entry['content']  # pylint: disable=protected-access
+        return response
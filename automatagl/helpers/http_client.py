@@ -0,0 +1,291 @@
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import threading
+import time
+
+import requests
+
+from automatagl.helpers.metrics import metrics
+
+__all__ = [
+    'AdaptiveLimiter',
+    'HTTPClient',
+    'TokenBucket',
+]
+
+# Responses that are worth trying again after a pause.
+retry_statuses = (429, 500, 502, 503, 504)
+
+# Once fewer than this share of the server's rate limit is left, requests are spread over the rest of the window.
+low_water_mark = 0.2
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket.  Each request takes a token; tokens refill at `rate` per second up to `burst`.  A rate
+    of `0` means the bucket never runs dry, unless it has been paused.
+    """
+
+    burst: float
+    rate: float
+
+    def __init__(self, rate: float = 0, burst: float = None) -> None:
+        """
+        :param rate: The number of requests allowed per second, `0` for no limit
+        :param burst: The number of requests that can be sent back to back (defaults to one second worth of requests)
+        """
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.__lock = threading.Lock()
+        self.__tokens = self.burst
+        self.__updated = time.monotonic()
+        self.__paused_until = 0.0
+
+    def set_rate(self, rate: float) -> None:
+        with self.__lock:
+            self.__refill(time.monotonic())
+            self.rate = rate
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hands out no tokens at all for the next `seconds`, e.g. when the server asked us to back off.
+        :param seconds: How long to pause for
+        """
+        with self.__lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    def acquire(self) -> float:
+        """
+        Takes a token, waiting for one if the bucket is empty or paused.
+        :return: The number of seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                wait = self.__paused_until - now
+                if wait <= 0:
+                    if not self.rate:
+                        return waited
+                    self.__refill(now)
+                    if self.__tokens >= 1:
+                        self.__tokens -= 1
+                        return waited
+                    wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def __refill(self, now: float) -> None:
+        if self.rate:
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+
+class AdaptiveLimiter:
+    """
+    Caps the number of requests in flight.  The cap is halved whenever the server pushes back and grows by one again
+    after a cap's worth of successful requests (additive increase, multiplicative decrease).
+    """
+
+    limit: int
+    maximum: int
+
+    def __init__(self, maximum: int) -> None:
+        """
+        :param maximum: The largest number of requests allowed in flight
+        """
+        self.maximum = self.limit = max(maximum, 1)
+        self.__active = 0
+        self.__successes = 0
+        self.__condition = threading.Condition()
+
+    def __enter__(self) -> bool:
+        """
+        :return: Whether the caller had to wait for a free slot
+        """
+        waited = False
+        with self.__condition:
+            while self.__active >= self.limit:
+                waited = True
+                self.__condition.wait()
+            self.__active += 1
+        return waited
+
+    def __exit__(self, *args) -> None:
+        with self.__condition:
+            self.__active -= 1
+            self.__condition.notify()
+
+    def decrease(self) -> None:
+        with self.__condition:
+            if self.limit > 1:
+                self.limit //= 2
+                logging.debug("Lowering the number of concurrent requests to {}.".format(self.limit))
+            self.__successes = 0
+
+    def increase(self) -> None:
+        with self.__condition:
+            if self.limit >= self.maximum:
+                return
+            self.__successes += 1
+            if self.__successes >= self.limit:
+                self.limit += 1
+                self.__successes = 0
+                self.__condition.notify()
+
+
+class HTTPClient:
+    """
+    The HTTP client shared by the network providers.  Every request gets a timeout, is retried with jittered
+    exponential backoff on connection errors, `429` and `5xx` responses (honoring `Retry-After`), and is throttled by a
+    token bucket and a concurrency cap that adapt to the `RateLimit-*` headers sent back by the server.
+    """
+
+    backoff: float
+    bucket: TokenBucket
+    limiter: AdaptiveLimiter
+    max_backoff: float
+    max_retries: int
+    rate_limit: float
+    session: requests.Session
+    timeout: float
+
+    def __init__(self, max_concurrency: int = 8, timeout: float = 30, max_retries: int = 5, rate_limit: float = 0,
+                 backoff: float = 0.5, max_backoff: float = 60) -> None:
+        """
+        :param max_concurrency: The largest number of requests in flight, also the size of the connection pool
+        :param timeout: The connect and read timeout of every request, in seconds
+        :param max_retries: How many times a failed request is tried again before giving up
+        :param rate_limit: The number of requests allowed per second, `0` to only throttle when the server asks to
+        :param backoff: The base delay of the exponential backoff, in seconds
+        :param max_backoff: The longest delay between two attempts, in seconds
+        """
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limit = rate_limit
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate_limit, max(rate_limit, max_concurrency, 1))
+        self.limiter = AdaptiveLimiter(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(max_concurrency, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def from_config(cls, config: dict, max_concurrency: int = 8) -> 'HTTPClient':
+        """
+        Builds a client from the `timeout`, `max_retries` and `rate_limit` keys of a provider configuration.
+        :param config: The provider configuration
+        :param max_concurrency: The largest number of requests in flight
+        :return: The HTTP client
+        """
+        return cls(
+            max_concurrency=max_concurrency,
+            timeout=float(config.get('timeout', 30)),
+            max_retries=int(config.get('max_retries', 5)),
+            rate_limit=float(config.get('rate_limit', 0)),
+        )
+
+    @property
+    def headers(self) -> dict:
+        return self.session.headers
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Sends a request, retrying and throttling as needed.
+        :param method: The HTTP method
+        :param url: The URL to query
+        :return: The response.  If every attempt failed with a retryable status, the last response is returned.
+        :raises requests.exceptions.RequestException: If the last attempt could not connect or timed out
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            throttled = self.bucket.acquire() > 0
+            with self.limiter as waited:
+                if throttled or waited:
+                    metrics.increment('http_throttled')
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if attempt >= self.max_retries:
+                        raise
+                    reason, delay = 'connection error', self.__backoff(attempt)
+                else:
+                    self.__adapt(response)
+                    if response.status_code not in retry_statuses or attempt >= self.max_retries:
+                        return response
+                    reason = 'HTTP {}'.format(response.status_code)
+                    delay = max(self.__backoff(attempt), self.__retry_after(response))
+            attempt += 1
+            metrics.increment('http_retries')
+            logging.debug("{} {} failed ({}), retrying in {:.2f}s.".format(method, url, reason, delay))
+            time.sleep(delay)
+
+    def __backoff(self, attempt: int) -> float:
+        """
+        Full jitter: a random delay of up to `backoff * 2 ** attempt`, so that workers do not retry in lockstep.
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def __retry_after(self, response: requests.Response) -> float:
+        """
+        Reads the `Retry-After` header, which is either a number of seconds or an HTTP date.
+        :param response: The response to read it from
+        :return: The number of seconds to wait, `0` if the header is missing or invalid
+        """
+        value = response.headers.get('Retry-After')
+        if not value:
+            return 0.0
+        try:
+            seconds = float(value)
+        except ValueError:
+            try:
+                seconds = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return 0.0
+        return min(max(seconds, 0.0), self.max_backoff)
+
+    def __adapt(self, response: requests.Response) -> None:
+        """
+        Adjusts the token bucket and the concurrency cap to what the server reported in its response.
+        :param response: The response from the server
+        """
+        if response.status_code == 429:
+            self.limiter.decrease()
+            retry_after = self.__retry_after(response)
+            if retry_after:
+                self.bucket.pause(retry_after)
+            return
+        remaining = self.__header_number(response, 'RateLimit-Remaining')
+        limit = self.__header_number(response, 'RateLimit-Limit')
+        reset = self.__header_number(response, 'RateLimit-Reset')
+        if remaining is not None and limit and remaining < limit * low_water_mark:
+            # Spread what is left of the budget over the rest of the window instead of running into a 429.
+            # Gitlab sends the reset time as a Unix timestamp, the IETF draft as a number of seconds.
+            if reset and reset > 1e9:
+                reset -= time.time()
+            window = max(reset, 1.0) if reset else 60.0
+            rate = max(remaining, 1) / window
+            self.bucket.set_rate(min(rate, self.rate_limit) if self.rate_limit else rate)
+            return
+        if self.bucket.rate != self.rate_limit:
+            self.bucket.set_rate(self.rate_limit)
+        if response.status_code < 500:
+            self.limiter.increase()
+
+    @staticmethod
+    def __header_number(response: requests.Response, name: str) -> float:
+        try:
+            return float(response.headers[name])
+        except (KeyError, ValueError):
+            return None
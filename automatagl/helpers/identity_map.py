@@ -0,0 +1,72 @@
+from typing import Any, Callable, Hashable
+import threading
+
+__all__ = [
+    'IdentityMap',
+]
+
+
+class IdentityMap:
+    """
+    A run-scoped map of provider objects (e.g. a user's keys by user ID) that loads every object at most once.  When
+    several threads ask for an object that is still being loaded, they wait for the first load instead of repeating it.
+    """
+
+    hits: int
+    misses: int
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__values = dict()
+        self.__loading = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, load: Callable[[Hashable], Any]) -> Any:
+        """
+        Returns the object for `key`, loading it with `load(key)` if this is the first time it is asked for.
+        :param key: The identity of the object
+        :param load: Loads the object, errors are raised to every caller waiting for it
+        :return: The object
+        """
+        with self.__lock:
+            if key in self.__values:
+                self.hits += 1
+                return self.__values[key]
+            loading = self.__loading.get(key)
+            if loading is None:
+                self.__loading[key] = threading.Event()
+        if loading is not None:
+            loading.wait()
+            with self.__lock:
+                if key in self.__values:
+                    self.hits += 1
+                    return self.__values[key]
+            # The first load failed, try again ourselves.
+            return load(key)
+
+        try:
+            value = load(key)
+        except BaseException:
+            with self.__lock:
+                self.__loading.pop(key).set()
+            raise
+        with self.__lock:
+            self.__values[key] = value
+            self.misses += 1
+            self.__loading.pop(key).set()
+        return value
+
+    def clear(self) -> None:
+        """
+        Forgets every object, e.g. at the start of a new run.
+        """
+        with self.__lock:
+            self.__values = dict()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
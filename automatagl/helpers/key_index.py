@@ -0,0 +1,74 @@
+from typing import Dict, List
+import mmap
+import os
+
+__all__ = [
+    'build_key_index',
+    'lookup_keys',
+    'KIError',
+    'KIFormatError',
+]
+
+# This module is imported by `automata-keys`, which sshd runs for every login attempt, so it must stay free of
+# `requests`, `yaml` and the rest of Automata.
+
+# The first line of every key index, bumped whenever the format changes.
+key_index_header = b'AUTOMATA-KEYS 1\n'
+
+# Where the key index is kept unless configured otherwise.  It has to be readable by sshd's `AuthorizedKeysCommandUser`.
+default_key_index = '/etc/ssh/automata_keys.idx'
+
+
+def build_key_index(users: Dict[str, List[str]]) -> str:
+    """
+    Builds the contents of a key index: the header line followed by one line per user, sorted by username, with the
+    username and every key separated by tabs.  Whitespace inside a key is collapsed so it cannot break a line.
+    :param users: A dictionary of sanitized username to SSH public keys
+    :return: The contents of the key index
+    """
+    lines = [key_index_header.decode('ascii')]
+    for username in sorted(users, key=lambda i: i.encode('utf-8')):
+        keys = [' '.join(key.split()) for key in users[username]]
+        lines.append('\t'.join([username] + [key for key in keys if key]) + '\n')
+    return ''.join(lines)
+
+
+def lookup_keys(path: str, username: str) -> List[str]:
+    """
+    Looks up the keys of a user with a binary search over the memory-mapped key index.
+    :param path: The path of the key index
+    :param username: The username to look up
+    :return: The SSH public keys of the user (empty if the user is not in the index)
+    :raises KIFormatError: If the file is not a key index
+    """
+    key = username.encode('utf-8')
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(key_index_header):
+            raise KIFormatError("'{}' is not an Automata key index.".format(path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            if index[:len(key_index_header)] != key_index_header:
+                raise KIFormatError("'{}' is not an Automata key index.".format(path))
+            # `low` is always the start of a line, and every line ends with a newline.
+            low, high = len(key_index_header), len(index)
+            while low < high:
+                newline = index.rfind(b'\n', low, (low + high) // 2)
+                start = newline + 1 if newline != -1 else low
+                end = index.find(b'\n', start)
+                line = index[start:end].split(b'\t')
+                if line[0] < key:
+                    low = end + 1
+                elif line[0] > key:
+                    high = start
+                else:
+                    return [i.decode('utf-8') for i in line[1:]]
+    return list()
+
+
+class KIError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class KIFormatError(KIError):
+    pass
@@ -0,0 +1,104 @@
+from typing import Dict, Iterable, List, Set
+import grp
+import pwd
+
+__all__ = [
+    'LocalStateIndex',
+]
+
+
+class LocalStateIndex:
+    """
+    An in-memory snapshot of the local passwd and group databases.  The databases are enumerated once and the index is
+    then kept up to date as users and groups are created or deleted, so lookups never go back to NSS.
+    """
+
+    gid_by_name: Dict[str, int]
+    members_by_gid: Dict[int, Set[str]]
+    primary_gid_by_user: Dict[str, int]
+    uid_by_name: Dict[str, int]
+
+    def __init__(self, passwd_entries: Iterable = (), group_entries: Iterable = ()) -> None:
+        """
+        :param passwd_entries: `pwd.struct_passwd`-like entries (name, password, uid, gid, ...)
+        :param group_entries: `grp.struct_group`-like entries (name, password, gid, members)
+        """
+        self.uid_by_name = dict()
+        self.gid_by_name = dict()
+        self.primary_gid_by_user = dict()
+        self.members_by_gid = dict()
+        for entry in group_entries:
+            self.add_group(entry[0], entry[2], entry[3])
+        for entry in passwd_entries:
+            self.add_user(entry[0], entry[2], entry[3])
+
+    @classmethod
+    def from_system(cls) -> 'LocalStateIndex':
+        """
+        Builds the index by enumerating the passwd and group databases once.
+        :return: The LocalStateIndex
+        """
+        return cls(pwd.getpwall(), grp.getgrall())
+
+    @classmethod
+    def from_files(cls, passwd_file: str, group_file: str) -> 'LocalStateIndex':
+        """
+        Builds the index from passwd and group files instead of NSS (for example a chroot or a test root).
+        :param passwd_file: The location of the passwd file
+        :param group_file: The location of the group file
+        :return: The LocalStateIndex
+        """
+        passwd_entries, group_entries = list(), list()
+        with open(passwd_file, 'r') as f:
+            for line in f:
+                entry = line.rstrip('\n').split(':')
+                if len(entry) == 7:
+                    passwd_entries.append((entry[0], entry[1], int(entry[2]), int(entry[3])))
+        with open(group_file, 'r') as f:
+            for line in f:
+                entry = line.rstrip('\n').split(':')
+                if len(entry) == 4:
+                    group_entries.append((entry[0], entry[1], int(entry[2]), [i for i in entry[3].split(',') if i]))
+        return cls(passwd_entries, group_entries)
+
+    def add_group(self, group: str, gid: int, members: Iterable[str] = ()) -> None:
+        """
+        Adds a group (and optionally its supplementary members) to the index.
+        :param group: The name of the group
+        :param gid: The GID of the group
+        :param members: The supplementary members of the group
+        """
+        self.gid_by_name[group] = gid
+        self.members_by_gid.setdefault(gid, set()).update(members)
+
+    def add_user(self, user: str, uid: int, gid: int, groups: List[int] = ()) -> None:
+        """
+        Adds a user to the index.
+        :param user: The name of the user
+        :param uid: The UID of the user
+        :param gid: The GID of the user's primary group
+        :param groups: The GIDs of the user's supplementary groups
+        """
+        self.uid_by_name[user] = uid
+        self.primary_gid_by_user[user] = gid
+        for group_id in [gid] + list(groups):
+            self.members_by_gid.setdefault(group_id, set()).add(user)
+
+    def remove_user(self, user: str) -> None:
+        """
+        Removes a user from the index along with all of its group memberships.
+        :param user: The name of the user
+        """
+        self.uid_by_name.pop(user, None)
+        self.primary_gid_by_user.pop(user, None)
+        for members in self.members_by_gid.values():
+            members.discard(user)
+
+    def remove_group(self, group: str) -> None:
+        """
+        Removes a group from the index.
+        :param group: The name of the group
+        """
+        gid = self.gid_by_name.pop(group, None)
+        if gid is not None and gid not in self.gid_by_name.values():
+            self.members_by_gid.pop(gid, None)
@@ -0,0 +1,171 @@
+from contextlib import contextmanager
+from typing import Dict, Tuple
+import json
+import os
+import threading
+import time
+
+from automatagl.helpers.atomic_file import write_atomically
+
+__all__ = [
+    'RunMetrics',
+    'metrics',
+]
+
+# Counters that are always reported, even if nothing incremented them during the run.
+default_counters = (
+    'http_requests',
+    'http_cache_hits',
+    'http_retries',
+    'http_throttled',
+    'subprocess_forks',
+    'files_written',
+    'files_skipped',
+    'bytes_written',
+)
+
+
+class RunMetrics:
+    """
+    Collects per-phase wall time, counters and gauges for a single run, and writes them out as a node_exporter
+    textfile collector `.prom` file and a JSON run summary.
+    """
+
+    counters: Dict[str, float]
+    gauges: Dict[Tuple[str, tuple], float]
+    phases: Dict[Tuple[str, tuple], float]
+    started: float
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Starts a new run.
+        """
+        with self.__lock:
+            self.started = time.time()
+            self.__started_monotonic = time.monotonic()
+            self.phases = dict()
+            self.counters = dict.fromkeys(default_counters, 0)
+            self.gauges = dict()
+
+    @contextmanager
+    def phase(self, name: str, **labels):
+        """
+        Times a block of code, adding the wall time to the phase (phases can be entered more than once).
+        :param name: The name of the phase
+        :param labels: Extra labels for the phase (e.g. the group being fetched)
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.monotonic() - started, **labels)
+
+    def record_phase(self, name: str, seconds: float, **labels) -> None:
+        """
+        Adds wall time to a phase.
+        :param name: The name of the phase
+        :param seconds: The time spent in the phase
+        :param labels: Extra labels for the phase
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.phases[key] = self.phases.get(key, 0) + seconds
+
+    def increment(self, name: str, value: float = 1) -> None:
+        """
+        Increments a counter.
+        :param name: The name of the counter
+        :param value: How much to add
+        """
+        with self.__lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """
+        Sets a gauge, replacing any earlier value with the same labels.
+        :param name: The name of the gauge
+        :param value: The value
+        :param labels: Extra labels for the gauge (e.g. the group it describes)
+        """
+        with self.__lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def summary(self, success: bool = True) -> dict:
+        """
+        Returns the run summary.
+        :param success: Whether the run completed
+        :return: A dictionary that can be serialized as JSON
+        """
+        with self.__lock:
+            return {
+                'started': self.started,
+                'duration': time.monotonic() - self.__started_monotonic,
+                'success': success,
+                'phases': [
+                    dict(labels, phase=name, seconds=seconds) for (name, labels), seconds in self.phases.items()
+                ],
+                'counters': dict(self.counters),
+                'gauges': [dict(labels, gauge=name, value=value) for (name, labels), value in self.gauges.items()],
+            }
+
+    def write_textfile(self, path: str, success: bool = True) -> None:
+        """
+        Atomically writes the run metrics in the Prometheus text format for node_exporter's textfile collector.
+        :param path: The `.prom` file to write
+        :param success: Whether the run completed
+        """
+        summary = self.summary(success)
+        lines = [
+            '# HELP automata_last_run_timestamp_seconds When the last Automata run started.',
+            '# TYPE automata_last_run_timestamp_seconds gauge',
+            'automata_last_run_timestamp_seconds {}'.format(summary['started']),
+            '# HELP automata_last_run_duration_seconds How long the last Automata run took.',
+            '# TYPE automata_last_run_duration_seconds gauge',
+            'automata_last_run_duration_seconds {}'.format(summary['duration']),
+            '# HELP automata_last_run_success Whether the last Automata run completed.',
+            '# TYPE automata_last_run_success gauge',
+            'automata_last_run_success {}'.format(int(success)),
+            '# HELP automata_phase_seconds Wall time spent in each phase of the last run.',
+            '# TYPE automata_phase_seconds gauge',
+        ]
+        for phase in summary['phases']:
+            labels = self.__format_labels(phase, 'seconds')
+            lines.append('automata_phase_seconds{{{}}} {}'.format(labels, phase['seconds']))
+        for name, value in sorted(summary['counters'].items()):
+            lines.append('# TYPE automata_last_run_{} gauge'.format(name))
+            lines.append('automata_last_run_{} {}'.format(name, value))
+        for name in sorted({gauge['gauge'] for gauge in summary['gauges']}):
+            lines.append('# TYPE automata_{} gauge'.format(name))
+            for gauge in summary['gauges']:
+                if gauge['gauge'] == name:
+                    labels = self.__format_labels(gauge, 'gauge', 'value')
+                    lines.append('automata_{}{{{}}} {}'.format(name, labels, gauge['value']))
+        self.__write_atomically(path, '\n'.join(lines) + '\n')
+
+    def write_summary(self, path: str, success: bool = True) -> None:
+        """
+        Atomically writes the run summary as JSON.
+        :param path: The JSON file to write
+        :param success: Whether the run completed
+        """
+        self.__write_atomically(path, json.dumps(self.summary(success), indent=2, sort_keys=True) + '\n')
+
+    @staticmethod
+    def __format_labels(entry: dict, *exclude: str) -> str:
+        return ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in sorted(entry.items()) if k not in exclude
+        )
+
+    @staticmethod
+    def __write_atomically(path: str, contents: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        write_atomically(path, contents)
+
+
+# The metrics of the current run, shared by every part of Automata.
+metrics = RunMetrics()
@@ -0,0 +1,467 @@
+from typing import Dict, List, Set, Tuple
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
+
+__all__ = [
+    'NativeAccountBackend',
+    'NABError',
+    'NABLockError',
+    'NABUserExistsError',
+    'NABGroupExistsError',
+    'NABGroupNotFoundError',
+]
+
+
+class AccountDatabase:
+    """
+    A colon-separated account database (passwd, shadow, group or gshadow) held in memory.  For group and gshadow, the
+    members of every group (the fourth field) are also indexed both ways, so membership changes only touch the groups
+    they concern.
+    """
+
+    entries: list
+    fields: int
+    index: Dict[str, int]
+    modified: bool
+    path: str
+
+    def __init__(self, path: str, fields: int) -> None:
+        """
+        :param path: The location of the database
+        :param fields: The number of fields in each entry
+        """
+        self.path = path
+        self.fields = fields
+        self.entries = list()
+        self.index = dict()
+        self.modified = False
+        self.__members = None
+        self.__groups_of = None
+        self.__written = None
+        try:
+            with open(path, 'r') as f:
+                self.__original = f.read()
+        except FileNotFoundError:
+            self.__original = None
+        for line in (self.__original or '').splitlines():
+            entry = line.split(':')
+            if len(entry) == fields and entry[0] and not entry[0].startswith(('#', '+', '-')):
+                self.index[entry[0]] = len(self.entries)
+                self.entries.append(entry)
+            else:
+                # Comments and NIS compat entries are kept verbatim.
+                self.entries.append(line)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def get(self, name: str) -> List[str]:
+        return self.entries[self.index[name]]
+
+    def names(self) -> List[str]:
+        return list(self.index)
+
+    def add(self, entry: List[str]) -> None:
+        self.index[entry[0]] = len(self.entries)
+        self.entries.append(entry)
+        self.modified = True
+        if self.__members is not None:
+            self.__index_members(entry)
+
+    def remove(self, name: str) -> None:
+        if name not in self.index:
+            return
+        self.entries[self.index.pop(name)] = None
+        self.modified = True
+        if self.__members is not None:
+            for user in self.__members.pop(name, set()):
+                self.__groups_of[user].discard(name)
+
+    def groups_of(self, user: str) -> Set[str]:
+        """
+        Returns the groups that list a user as a member (group and gshadow only).
+        :param user: The name of the user
+        :return: The names of the groups, do not modify it
+        """
+        if self.__members is None:
+            self.__build_member_index()
+        return self.__groups_of.get(user, set())
+
+    def set_member(self, name: str, user: str, member: bool) -> None:
+        """
+        Adds a user to, or removes it from, the members of a group (group and gshadow only).
+        :param name: The name of the group
+        :param user: The name of the user
+        :param member: Whether the user should be a member
+        """
+        if self.__members is None:
+            self.__build_member_index()
+        members = self.__members.setdefault(name, set())
+        if (user in members) == member:
+            return
+        entry = self.get(name)
+        if member:
+            members.add(user)
+            self.__groups_of.setdefault(user, set()).add(name)
+            entry[3] = '{},{}'.format(entry[3], user) if entry[3] else user
+        else:
+            members.discard(user)
+            self.__groups_of[user].discard(name)
+            entry[3] = ','.join(i for i in entry[3].split(',') if i and i != user)
+        self.modified = True
+
+    def __build_member_index(self) -> None:
+        self.__members, self.__groups_of = dict(), dict()
+        for name in self.index:
+            self.__index_members(self.get(name))
+
+    def __index_members(self, entry: List[str]) -> None:
+        members = {i for i in entry[3].split(',') if i}
+        self.__members[entry[0]] = members
+        for user in members:
+            self.__groups_of.setdefault(user, set()).add(entry[0])
+
+    def write(self) -> None:
+        """
+        Writes the database atomically, keeping the previous version as `<path>-` like the shadow utilities do.
+        """
+        if not self.modified:
+            return
+        contents = ''.join(
+            '{}\n'.format(':'.join(i) if isinstance(i, list) else i) for i in self.entries if i is not None
+        )
+        try:
+            stat = os.stat(self.path)
+            shutil.copy2(self.path, '{}-'.format(self.path))
+            mode, uid, gid = stat.st_mode & 0o7777, stat.st_uid, stat.st_gid
+        except FileNotFoundError:
+            mode, uid, gid = 0o644, 0, 0
+        if os.geteuid() != 0:
+            uid = gid = None
+        write_atomically(self.path, contents, mode, uid, gid)
+        self.__written = (mode, uid, gid)
+        metrics.increment('files_written')
+        metrics.increment('bytes_written', len(contents.encode('utf-8')))
+        self.modified = False
+        # Re-number the index now that deleted entries are gone from disk.
+        self.entries = [i for i in self.entries if i is not None]
+        self.index = {i[0]: n for n, i in enumerate(self.entries) if isinstance(i, list)}
+
+    def rollback(self) -> None:
+        """
+        Puts back the database as it was read, if it has been written since.
+        """
+        if self.__written is None:
+            return
+        if self.__original is None:
+            os.remove(self.path)
+        else:
+            write_atomically(self.path, self.__original, *self.__written)
+        self.__written = None
+
+
+class NativeAccountBackend:
+    """
+    Applies user and group changes directly to the passwd, shadow, group and gshadow databases.  The databases are
+    locked and read once, every change is made in memory and each database is written back once on `commit`.
+    """
+
+    etc_dir: str
+    gid_range: Tuple[int, int]
+    lock_timeout: int
+    pending_home_removals: List[str]
+    skel_dir: str
+    uid_range: Tuple[int, int]
+
+    def __init__(self, etc_dir: str = '/etc', skel_dir: str = '/etc/skel', lock_timeout: int = 15) -> None:
+        """
+        :param etc_dir: The directory holding the account databases
+        :param skel_dir: The skeleton directory copied into new home directories
+        :param lock_timeout: How long to wait for the password file lock (in seconds)
+        """
+        self.etc_dir = etc_dir
+        self.skel_dir = skel_dir
+        self.lock_timeout = lock_timeout
+        self.pending_home_removals = list()
+        self.__lock_fd = None
+        self.__databases = None
+        self.__last_ids = dict()
+        login_defs = self.__read_login_defs()
+        self.uid_range = (int(login_defs.get('UID_MIN', 1000)), int(login_defs.get('UID_MAX', 60000)))
+        self.gid_range = (int(login_defs.get('GID_MIN', 1000)), int(login_defs.get('GID_MAX', 60000)))
+
+    @property
+    def databases(self) -> Dict[str, AccountDatabase]:
+        """
+        The account databases, locked and loaded on first use.
+        """
+        if self.__databases is None:
+            self.__lock()
+            self.__databases = {
+                'passwd': AccountDatabase(os.path.join(self.etc_dir, 'passwd'), 7),
+                'shadow': AccountDatabase(os.path.join(self.etc_dir, 'shadow'), 9),
+                'group': AccountDatabase(os.path.join(self.etc_dir, 'group'), 4),
+                'gshadow': AccountDatabase(os.path.join(self.etc_dir, 'gshadow'), 4),
+            }
+        return self.__databases
+
+    def add_group(self, group: str) -> int:
+        """
+        Adds a group.
+        :param group: The name of the group
+        :return: The GID of the new group
+        :raises NABGroupExistsError: If the group already exists
+        """
+        db = self.databases
+        if group in db['group']:
+            raise NABGroupExistsError
+        gid = self.__next_id('group', self.gid_range)
+        db['group'].add([group, 'x', str(gid), ''])
+        if os.path.exists(db['gshadow'].path):
+            db['gshadow'].add([group, '!', '', ''])
+        return gid
+
+    def add_user(self, user: str, group: str, groups: List[str], home: str, shell: str) -> Tuple[int, int]:
+        """
+        Adds a user, the equivalent of `useradd -m -g <group> -G <groups>`.  The home directory is created right away.
+        :param user: The name of the user
+        :param group: The name of the user's primary group
+        :param groups: The names of the user's supplementary groups
+        :param home: The home directory of the user
+        :param shell: The login shell of the user
+        :return: The UID and GID of the new user
+        :raises NABUserExistsError: If the user already exists
+        :raises NABGroupNotFoundError: If the primary or a supplementary group does not exist
+        """
+        db = self.databases
+        if user in db['passwd']:
+            raise NABUserExistsError
+        for i in [group] + list(groups):
+            if i not in db['group']:
+                raise NABGroupNotFoundError(i)
+        uid = self.__next_id('passwd', self.uid_range)
+        gid = int(db['group'].get(group)[2])
+        db['passwd'].add([user, 'x', str(uid), str(gid), '', home, shell])
+        db['shadow'].add([user, '!', str(int(time.time() // 86400)), '0', '99999', '7', '', '', ''])
+        self.set_supplementary_groups(user, groups)
+        if home in self.pending_home_removals:
+            # The user is being recreated, start from a fresh home directory like `userdel --remove` would.
+            self.pending_home_removals.remove(home)
+            shutil.rmtree(home, ignore_errors=True)
+        self.__create_home(home, uid, gid)
+        return uid, gid
+
+    def delete_user(self, user: str, remove_home: bool = True) -> str:
+        """
+        Deletes a user and its group memberships.  The home directory is removed after the databases are committed.
+        :param user: The name of the user
+        :param remove_home: Whether to remove the user's home directory
+        :return: The home directory of the deleted user
+        """
+        db = self.databases
+        if user not in db['passwd']:
+            return ''
+        home = db['passwd'].get(user)[5]
+        db['passwd'].remove(user)
+        db['shadow'].remove(user)
+        self.set_supplementary_groups(user, list())
+        if remove_home and home:
+            self.pending_home_removals.append(home)
+        return home
+
+    def modify_user(self, user: str, group: str, groups: List[str]) -> int:
+        """
+        Changes the primary and supplementary groups of a user, the equivalent of `usermod -g <group> -G <groups>`.
+        :param user: The name of the user
+        :param group: The name of the user's primary group
+        :param groups: The names of the user's supplementary groups
+        :return: The GID of the user's primary group
+        :raises NABGroupNotFoundError: If the primary or a supplementary group does not exist
+        """
+        db = self.databases
+        for i in [group] + list(groups):
+            if i not in db['group']:
+                raise NABGroupNotFoundError(i)
+        gid = db['group'].get(group)[2]
+        entry = db['passwd'].get(user)
+        if entry[3] != gid:
+            entry[3] = gid
+            db['passwd'].modified = True
+        self.set_supplementary_groups(user, groups)
+        return int(gid)
+
+    def get_home(self, user: str) -> str:
+        """
+        Returns the home directory of a user.
+        :param user: The name of the user
+        :return: The home directory, or an empty string if the user does not exist
+        """
+        if user not in self.databases['passwd']:
+            return ''
+        return self.databases['passwd'].get(user)[5]
+
+    def set_supplementary_groups(self, user: str, groups: List[str]) -> None:
+        """
+        Makes `groups` the complete list of supplementary groups of a user.
+        :param user: The name of the user
+        :param groups: The names of the supplementary groups
+        """
+        db = self.databases
+        groups = set(groups)
+        for name in ('group', 'gshadow'):
+            database = db[name]
+            current = database.groups_of(user)
+            for group in [i for i in groups - current if i in database]:
+                database.set_member(group, user, True)
+            for group in list(current - groups):
+                database.set_member(group, user, False)
+
+    def commit(self) -> None:
+        """
+        Writes every modified database once, releases the lock and removes the homes of deleted users.  If a database
+        cannot be written, the ones already written are rolled back so they stay consistent with each other.
+        """
+        if self.__databases is None:
+            return
+        try:
+            modified = [k for k, v in self.__databases.items() if v.modified]
+            written = list()
+            try:
+                for name in modified:
+                    with tracer.span('write_file', path=self.__databases[name].path):
+                        self.__databases[name].write()
+                    written.append(name)
+            except BaseException:
+                for name in written:
+                    logging.warning("Rolling back '{}'.".format(self.__databases[name].path))
+                    self.__databases[name].rollback()
+                # The deleted users are still there, so are their homes.
+                self.pending_home_removals = list()
+                raise
+        finally:
+            self.__databases = None
+            self.__last_ids = dict()
+            self.__unlock()
+        if modified:
+            logging.debug("Wrote account databases: {}".format(', '.join(modified)))
+            self.__invalidate_nscd(modified)
+        for home in self.pending_home_removals:
+            shutil.rmtree(home, ignore_errors=True)
+        self.pending_home_removals = list()
+
+    def __create_home(self, home: str, uid: int, gid: int) -> None:
+        """
+        Creates a home directory from the skeleton directory, owned by the new user.
+        """
+        if os.path.isdir(home):
+            return
+        if os.path.isdir(self.skel_dir):
+            shutil.copytree(self.skel_dir, home, symlinks=True)
+        else:
+            os.makedirs(home)
+        os.chmod(home, 0o700)
+        if os.geteuid() != 0:
+            return
+        for root, dirs, files in os.walk(home):
+            for name in [root] + [os.path.join(root, i) for i in dirs + files]:
+                os.lchown(name, uid, gid)
+
+    def __lock(self) -> None:
+        """
+        Takes the same lock as `lckpwdf(3)` so the shadow utilities wait for us.
+        :raises NABLockError: If the lock cannot be taken within `lock_timeout` seconds
+        """
+        fd = os.open(os.path.join(self.etc_dir, '.pwd.lock'), os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN) or time.monotonic() > deadline:
+                    os.close(fd)
+                    raise NABLockError
+                time.sleep(0.1)
+        self.__lock_fd = fd
+
+    def __unlock(self) -> None:
+        if self.__lock_fd is not None:
+            os.close(self.__lock_fd)
+            self.__lock_fd = None
+
+    def __read_login_defs(self) -> dict:
+        settings = dict()
+        try:
+            with open(os.path.join(self.etc_dir, 'login.defs'), 'r') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and not parts[0].startswith('#'):
+                        settings[parts[0]] = parts[1]
+        except OSError:
+            pass
+        return settings
+
+    def __next_id(self, database: str, id_range: Tuple[int, int]) -> int:
+        """
+        Picks the next ID the way `useradd` does: one past the highest ID in use within the range.  The highest ID is
+        only looked up once per commit.
+        :param database: The database to allocate the ID in (`passwd` or `group`)
+        :param id_range: The lowest and highest ID to allocate
+        :return: The new ID
+        :raises NABError: If every ID in the range is used
+        """
+        db = self.databases[database]
+        if database not in self.__last_ids:
+            used = [int(db.get(i)[2]) for i in db.names()]
+            self.__last_ids[database] = max([i for i in used if id_range[0] <= i <= id_range[1]] or [id_range[0] - 1])
+        candidate = self.__last_ids[database] + 1
+        if candidate > id_range[1]:
+            used = {int(db.get(i)[2]) for i in db.names()}
+            free = [i for i in range(id_range[0], id_range[1] + 1) if i not in used]
+            if not free:
+                raise NABError
+            candidate = free[0]
+        else:
+            self.__last_ids[database] = candidate
+        return candidate
+
+    @staticmethod
+    def __invalidate_nscd(databases: List[str]) -> None:
+        nscd = shutil.which('nscd')
+        if not nscd:
+            return
+        for database in {'passwd', 'group'}.intersection(databases):
+            metrics.increment('subprocess_forks')
+            with tracer.span('nscd', database=database):
+                subprocess.call([nscd, '-i', database], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class NABError(Exception):
+    pass
+
+
+class NABLockError(NABError):
+    pass
+
+
+class NABUserExistsError(NABError):
+    pass
+
+
+class NABGroupExistsError(NABError):
+    pass
+
+
+class NABGroupNotFoundError(NABError):
+
+    def __init__(self, message):
+        self.message = message
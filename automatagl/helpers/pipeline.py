@@ -0,0 +1,137 @@
+from typing import Dict, List, Tuple
+import threading
+import time
+
+from automatagl.helpers.provider_operations import ProviderUser
+
+__all__ = [
+    'GroupPipeline',
+]
+
+
+class GroupPipeline:
+    """
+    Hands fetched groups from the provider (the producer) to the synchronizer (the consumer) in order of precedence, so
+    local changes can be applied while later groups are still being fetched.  The producer may only start fetching a
+    group once it is at most `depth` groups ahead of the last group the consumer applied.
+    """
+
+    depth: int
+    groups: List[str]
+    results: Dict[str, List[ProviderUser]]
+
+    def __init__(self, groups: List[str], depth: int) -> None:
+        """
+        :param groups: The provider groups, in order of precedence
+        :param depth: How many groups fetching may run ahead of applying
+        """
+        self.groups = list(groups)
+        self.depth = max(depth, 1)
+        self.results = dict()
+        self.__order = {group: i for i, group in enumerate(self.groups)}
+        self.__condition = threading.Condition()
+        self.__applied = 0
+        self.__closed = False
+        self.__finished = False
+        self.__waiters = list()
+
+    async def wait_turn(self, group: str) -> None:
+        """
+        Called by the provider, in its event loop, before it starts fetching a group.
+        :param group: The group about to be fetched
+        """
+        import asyncio
+
+        index = self.__order.get(group)
+        if index is None:
+            return
+        loop = asyncio.get_event_loop()
+        while True:
+            with self.__condition:
+                if self.__closed or index < self.__applied + self.depth:
+                    return
+                future = loop.create_future()
+                self.__waiters.append((loop, future))
+            await future
+
+    def put(self, group: str, users: List[ProviderUser]) -> None:
+        """
+        Called by the provider once a group has been fetched.  Groups are only handed over once.
+        :param group: The group
+        :param users: Its members
+        """
+        with self.__condition:
+            if group in self.__order and group not in self.results:
+                self.results[group] = users
+                self.__condition.notify_all()
+
+    def finish(self) -> None:
+        """
+        Called once the provider is done, successfully or not.
+        """
+        with self.__condition:
+            self.__finished = True
+            self.__condition.notify_all()
+
+    def ready(self) -> bool:
+        """
+        :return: Whether `get` would return the next group right away, without waiting for the provider
+        """
+        with self.__condition:
+            return self.__applied < len(self.groups) and self.groups[self.__applied] in self.results
+
+    def get(self, deadline: float = None) -> Tuple[str, List[ProviderUser]]:
+        """
+        Waits for the next group in order of precedence.
+        :param deadline: The `time.monotonic()` to give up at (no limit if `None`)
+        :return: The group and its members, or `None` if the provider finished without it or the deadline passed
+        """
+        with self.__condition:
+            while self.__applied < len(self.groups):
+                group = self.groups[self.__applied]
+                if group in self.results:
+                    return group, self.results[group]
+                if self.__finished or self.__closed:
+                    return None
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    return None
+                self.__condition.wait(timeout)
+            return None
+
+    def done(self, group: str) -> None:
+        """
+        Called by the consumer once a group has been applied, letting the provider fetch further ahead.
+        :param group: The group returned by the last `get`
+        :raises ValueError: If `group` is not the group the consumer is expected to apply next
+        """
+        with self.__condition:
+            expected = self.groups[self.__applied] if self.__applied < len(self.groups) else None
+            if group != expected:
+                raise ValueError("Group '{}' was applied out of order, expected '{}'.".format(group, expected))
+            self.__applied += 1
+        self.__wake()
+
+    def close(self) -> None:
+        """
+        Stops holding the provider back, e.g. when the consumer gives up waiting.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__wake()
+
+    def __wake(self) -> None:
+        with self.__condition:
+            waiters, self.__waiters = self.__waiters, list()
+        for loop, future in waiters:
+            try:
+                loop.call_soon_threadsafe(self.__resolve, future)
+            except RuntimeError:
+                # The event loop is already closed.
+                pass
+
+    @staticmethod
+    def __resolve(future) -> None:
+        if not future.done():
+            future.set_result(None)
@@ -0,0 +1,286 @@
+from collections import namedtuple
+from typing import Dict, List
+import json
+import logging
+
+from automatagl.helpers.config_parser import sanitize_username
+from automatagl.helpers.key_index import build_key_index
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.provider_operations import AutomataConfig, AutomataGroupConfig, ProviderUser
+from automatagl.helpers.ssh_key_object import SSHKeyObject
+from automatagl.helpers.ssh_key_parser import KeyParser
+from automatagl.helpers.user_operations import UserOps
+
+__all__ = [
+    'DesiredState',
+    'DesiredStateBuilder',
+    'DesiredUser',
+    'Plan',
+    'Planner',
+    'build_desired_state',
+    'format_plan',
+    'plan_to_json',
+]
+
+# Desired state data structures
+DesiredUser = namedtuple(
+    'DesiredUser', ['username', 'provider_group', 'linux_group', 'other_groups', 'member_of', 'ssh_keys']
+)
+DesiredState = namedtuple('DesiredState', ['users', 'groups'])
+
+# Plan data structures
+GroupAdd = namedtuple('GroupAdd', ['group'])
+UserDelete = namedtuple('UserDelete', ['user'])
+UserAdd = namedtuple('UserAdd', ['user', 'group', 'groups', 'recreate'])
+GroupChange = namedtuple('GroupChange', ['user', 'group', 'groups'])
+KeyFileChange = namedtuple('KeyFileChange', ['user', 'group', 'keys'])
+Plan = namedtuple(
+    'Plan', [
+        'group_adds', 'user_deletes', 'user_adds', 'group_changes', 'key_changes', 'key_index', 'sudoers',
+        'unchanged_files',
+    ]
+)
+
+
+class DesiredStateBuilder:
+    """
+    Builds the desired state one provider group at a time, in order of precedence, so the users a group owns are known
+    as soon as it and every group before it have been fetched.
+    """
+
+    duplicates: int
+    groups: List[AutomataGroupConfig]
+    key_parser: KeyParser
+    users: Dict[str, DesiredUser]
+
+    def __init__(self, key_parser: KeyParser = None) -> None:
+        """
+        :param key_parser: Validates and deduplicates every user's keys (they are used verbatim if `None`)
+        """
+        self.key_parser = key_parser
+        self.users = dict()
+        self.groups = list()
+        self.duplicates = 0
+
+    def add_group(self, group: AutomataGroupConfig, members: List[ProviderUser]) -> List[DesiredUser]:
+        """
+        Adds the members of the next group.  Members already seen in an earlier group stay with that group.
+        :param group: The configured group
+        :param members: The provider members of the group
+        :return: The users that belong to this group
+        """
+        self.groups.append(group)
+        owned = list()
+        for member in members:
+            username = sanitize_username(member.username)
+            if username in self.users:
+                self.users[username].member_of.add(group.linux_group)
+                self.duplicates += 1
+                continue
+            ssh_keys = SSHKeyObject(username=member.username)
+            ssh_keys.add_keys(member.keys, self.key_parser)
+            self.users[username] = DesiredUser(
+                username=username,
+                provider_group=group.provider_group,
+                linux_group=group.linux_group,
+                other_groups=list(group.other_groups),
+                member_of={group.linux_group},
+                ssh_keys=ssh_keys,
+            )
+            owned.append(self.users[username])
+        return owned
+
+    def state(self) -> DesiredState:
+        return DesiredState(users=self.users, groups=list(self.groups))
+
+
+def build_desired_state(groups: List[AutomataGroupConfig],
+                        group_members: Dict[str, List[ProviderUser]],
+                        key_parser: KeyParser = None) -> DesiredState:
+    """
+    Works out which users should exist on the system.  Users that are members of several groups belong to the first
+    configured group they are a member of.  Groups missing from `group_members` are left out of the desired state
+    entirely, so their members are not deleted.
+    :param groups: The configured groups, in order of precedence
+    :param group_members: The provider members of every group
+    :param key_parser: Validates and deduplicates every user's keys (they are used verbatim if `None`)
+    :return: The DesiredState
+    """
+    builder = DesiredStateBuilder(key_parser)
+    for group in groups:
+        if group.provider_group in group_members:
+            builder.add_group(group, group_members[group.provider_group])
+    # Every user gets one key file however many groups they are in, count the writes that saves.
+    metrics.increment('memberships_deduplicated', builder.duplicates)
+    return builder.state()
+
+
+class Planner:
+    """
+    Compares the desired state with the local system and works out the changes needed to reconcile them.
+    """
+
+    automata_config: AutomataConfig
+    user_ops: UserOps
+
+    def __init__(self, user_ops: UserOps, automata_config: AutomataConfig) -> None:
+        """
+        :param user_ops: The user operations object for the local system
+        :param automata_config: The Automata server configuration
+        """
+        self.user_ops = user_ops
+        self.automata_config = automata_config
+
+    def plan(self, desired: DesiredState, partial: bool = False) -> Plan:
+        """
+        Diffs the desired state against the local state index in a single pass over the managed users.
+        :param desired: The DesiredState to reconcile with
+        :param partial: Only plan the groups, users and key files to create for the users in `desired`, which may be
+        a subset of every desired user.  Deletions, moves between groups, the key index and the sudoers file are left
+        to the plan of the complete desired state.
+        :return: The Plan
+        """
+        index = self.user_ops.local_state
+        desired_groups = {group.linux_group for group in desired.groups}
+        group_adds = [GroupAdd(group=i) for i in sorted(desired_groups) if i not in index.gid_by_name]
+        # Users of groups that are not part of this plan are still managed, they must not be recreated.
+        managed_groups = {group.linux_group for group in self.automata_config.groups}
+        # Groups that were not fetched (or were refused) are left alone, and so is every user in them.
+        fetched = {group.provider_group for group in desired.groups}
+        held_groups = {
+            group.linux_group for group in self.automata_config.groups if group.provider_group not in fetched
+        }
+
+        # Supplementary group memberships by user, built once from the index.
+        name_by_gid = {v: k for k, v in index.gid_by_name.items()}
+        memberships = dict()
+        for gid, members in index.members_by_gid.items():
+            for member in members:
+                memberships.setdefault(sanitize_username(member), set()).add(gid)
+        managed_gids = {index.gid_by_name[i] for i in managed_groups if i in index.gid_by_name}
+        managed_users = {user for user, gids in memberships.items() if gids & managed_gids}
+        held_gids = {index.gid_by_name[i] for i in held_groups if i in index.gid_by_name}
+        held_users = set() if partial else {user for user in managed_users if memberships[user] & held_gids}
+
+        user_deletes = list() if partial else [
+            UserDelete(user=i) for i in sorted(managed_users - held_users - set(desired.users))
+        ]
+        user_adds, group_changes, key_changes = list(), list(), list()
+        key_files = self.automata_config.authorized_keys_files
+        for user in desired.users.values():
+            if user.username in held_users:
+                logging.info("Leaving user '{}' alone, one of its groups was not fetched.".format(user.username))
+                continue
+            if user.username not in index.uid_by_name or user.username not in managed_users:
+                # New users, and local accounts that Automata does not manage yet, get a fresh account.
+                user_adds.append(UserAdd(
+                    user=user.username,
+                    group=user.linux_group,
+                    groups=user.other_groups,
+                    recreate=user.username in index.uid_by_name,
+                ))
+                if key_files:
+                    key_changes.append(KeyFileChange(user.username, user.linux_group, user.ssh_keys))
+                continue
+            primary_gid = index.primary_gid_by_user[user.username]
+            if partial:
+                # Users moving to another group, and their key files, wait for the complete plan.
+                if name_by_gid.get(primary_gid) != user.linux_group:
+                    continue
+            else:
+                # Membership in the Linux groups of the user's other provider groups is left alone.
+                supplementary = {name_by_gid.get(i) for i in memberships[user.username] if i != primary_gid}
+                required, tolerated = set(user.other_groups), user.member_of - {user.linux_group}
+                if name_by_gid.get(primary_gid) != user.linux_group or \
+                        not required <= supplementary <= required | tolerated:
+                    groups = sorted(required | (supplementary & tolerated))
+                    group_changes.append(GroupChange(user.username, user.linux_group, groups))
+            if not key_files:
+                continue
+            gid = index.gid_by_name.get(user.linux_group)
+            if gid is None or not self.user_ops.ssh_file_is_current(user.ssh_keys, gid):
+                key_changes.append(KeyFileChange(user.username, user.linux_group, user.ssh_keys))
+
+        # The key index is rebuilt from every desired user, and only rewritten if it changed.
+        key_index = None
+        if self.automata_config.key_index and not partial:
+            key_index = build_key_index({i.username: i.ssh_keys.ssh_keys for i in desired.users.values()})
+            if self.user_ops.key_index_is_current(self.automata_config.key_index, key_index):
+                key_index = None
+
+        sudoers = not partial and not self.user_ops.sudoers_file_is_current(
+            self.automata_config.sudoers_file, self.automata_config.groups,
+        )
+
+        # Every key file, the key index and the sudoers file.
+        managed_files = len(set(desired.users) - held_users) if key_files else 0
+        if not partial:
+            managed_files += (1 if self.automata_config.key_index else 0) + 1
+        changed_files = len(key_changes) + (0 if key_index is None else 1) + (1 if sudoers else 0)
+        return Plan(
+            group_adds=group_adds,
+            user_deletes=user_deletes,
+            user_adds=user_adds,
+            group_changes=group_changes,
+            key_changes=key_changes,
+            key_index=key_index,
+            sudoers=sudoers,
+            unchanged_files=managed_files - changed_files,
+        )
+
+
+def plan_to_dict(plan: Plan) -> dict:
+    """
+    Converts a plan into plain data.
+    :param plan: The Plan to convert
+    :return: A dictionary that can be serialized as JSON
+    """
+    return {
+        'group_adds': [i.group for i in plan.group_adds],
+        'user_deletes': [i.user for i in plan.user_deletes],
+        'user_adds': [i._asdict() for i in plan.user_adds],
+        'group_changes': [i._asdict() for i in plan.group_changes],
+        'key_changes': [
+            {'user': i.user, 'group': i.group, 'keys': len(i.keys.ssh_keys), 'fingerprints': i.keys.fingerprints}
+            for i in plan.key_changes
+        ],
+        'key_index': plan.key_index is not None,
+        'sudoers': plan.sudoers,
+        'unchanged_files': plan.unchanged_files,
+    }
+
+
+def plan_to_json(plan: Plan) -> str:
+    """
+    Serializes a plan as JSON.
+    :param plan: The Plan to serialize
+    :return: The JSON document
+    """
+    return json.dumps(plan_to_dict(plan), indent=2, sort_keys=True)
+
+
+def format_plan(plan: Plan) -> str:
+    """
+    Formats a plan for humans.
+    :param plan: The Plan to format
+    :return: One line per change, followed by a summary line
+    """
+    lines = ['+ group {}'.format(i.group) for i in plan.group_adds]
+    lines += ['- user {}'.format(i.user) for i in plan.user_deletes]
+    lines += [
+        '{} user {} (group {}{})'.format(
+            '-/+' if i.recreate else '+', i.user, i.group, ', groups {}'.format(','.join(i.groups)) if i.groups else '',
+        ) for i in plan.user_adds
+    ]
+    lines += ['~ user {} (group {}, groups {})'.format(i.user, i.group, ','.join(i.groups)) for i in plan.group_changes]
+    lines += ['~ keys {} ({} keys)'.format(i.user, len(i.keys.ssh_keys)) for i in plan.key_changes]
+    if plan.key_index is not None:
+        lines.append('~ key index')
+    if plan.sudoers:
+        lines.append('~ sudoers file')
+    lines.append('Plan: {} groups to add, {} users to delete, {} users to add, {} users to change, {} key files to '
+                 'write{}{}.'.format(len(plan.group_adds), len(plan.user_deletes), len(plan.user_adds),
+                                     len(plan.group_changes), len(plan.key_changes),
+                                     ', key index to write' if plan.key_index is not None else '',
+                                     ', sudoers file to write' if plan.sudoers else ''))
+    return '\n'.join(lines)
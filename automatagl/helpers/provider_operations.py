@@ -1,8 +1,42 @@
 from collections import namedtuple
+from typing import Iterable, Iterator
+import sys
 
 
 # Provider data structures
-ProviderUser = namedtuple('ProviderUser', ['username', 'keys'])
+class ProviderUser:
+    """
+    A user and their public SSH keys, as returned by a provider.  Fleets can have tens of thousands of these, so they are
+    compact: no `__dict__`, the keys are kept in a tuple and the username is interned, so the copies held for every
+    group, snapshot and key index share a single string.
+    """
+
+    __slots__ = ('username', 'keys')
+
+    def __init__(self, username: str, keys: Iterable[str] = ()) -> None:
+        """
+        :param username: The username on the provider
+        :param keys: The public SSH keys of the user
+        """
+        self.username = sys.intern(username)
+        self.keys = tuple(keys)
+
+    def __iter__(self) -> Iterator:
+        # Unpacks like the namedtuple it replaces: `username, keys = user`.
+        return iter((self.username, self.keys))
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ProviderUser):
+            return NotImplemented
+        return self.username == other.username and self.keys == other.keys
+
+    def __hash__(self) -> int:
+        return hash((self.username, self.keys))
+
+    def __repr__(self) -> str:
+        return 'ProviderUser(username={!r}, keys={!r})'.format(self.username, self.keys)
+
+
 ProviderConfig = namedtuple(
     'ProviderConfig', [
         'provider',
@@ -10,6 +44,15 @@ ProviderConfig = namedtuple(
     ]
 )
 
+CacheConfig = namedtuple('CacheConfig', ['enabled', 'path', 'max_size'])
+SnapshotConfig = namedtuple('SnapshotConfig', ['enabled', 'path', 'max_staleness', 'revalidate_timeout'])
+DaemonConfig = namedtuple(
+    'DaemonConfig', ['interval', 'listen_address', 'listen_port', 'hook_token', 'debounce', 'watch_files']
+)
+PurgeConfig = namedtuple('PurgeConfig', ['enabled', 'retention', 'files_per_second', 'max_runtime'])
+MetricsConfig = namedtuple('MetricsConfig', ['textfile', 'summary_file'])
+KeyPolicy = namedtuple('KeyPolicy', ['allowed_types', 'min_bits'])
+
 # Automata data structures
 AutomataGroupConfig = namedtuple(
     'AutomataGroupConfig', ['provider_group', 'linux_group', 'sudoers_line', 'other_groups']
@@ -21,5 +64,10 @@ AutomataConfig = namedtuple(
         'home_dir_path',
         'protected_uid_start',
         'protected_gid_start',
+        'state_dir',
+        'backend',
+        'key_index',
+        'authorized_keys_files',
+        'pipeline_depth',
     ]
 )
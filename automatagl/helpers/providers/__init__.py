@@ -1,7 +1,96 @@
-from automatagl.helpers.providers.gitlab_provider import GitlabProvider
-from automatagl.helpers.providers.sca_provider import SCAProvider
+from collections.abc import Mapping
+from importlib import import_module
+import logging
 
-automata_providers = {
-    "gitlab": GitlabProvider,
-    "sca": SCAProvider,
+__all__ = [
+    'ProviderRegistry',
+    'automata_providers',
+]
+
+# The providers shipped with Automata, imported only when they are configured.
+builtin_providers = {
+    "bundle": "automatagl.helpers.providers.bundle_provider:BundleProvider",
+    "gitlab": "automatagl.helpers.providers.gitlab_provider:GitlabProvider",
+    "sca": "automatagl.helpers.providers.sca_provider:SCAProvider",
 }
+
+# Third-party packages register their providers under this entry point group.
+entry_point_group = 'automatagl.providers'
+
+
+class ProviderRegistry(Mapping):
+    """
+    Maps the `provider` name from the configuration file to its class, importing the provider module the first time
+    it is looked up.  Names that are not built in are looked up in the `automatagl.providers` entry points.
+    """
+
+    def __init__(self, providers: dict) -> None:
+        """
+        :param providers: A dictionary of provider name to `module:Class`
+        """
+        self.__providers = dict(providers)
+        self.__classes = dict()
+        self.__entry_points_loaded = False
+
+    def __getitem__(self, name: str) -> type:
+        if name not in self.__classes:
+            if name not in self.__providers:
+                self.__load_entry_points()
+            module_name, class_name = self.__providers[name].split(':')
+            self.__classes[name] = getattr(import_module(module_name), class_name)
+        return self.__classes[name]
+
+    def __iter__(self):
+        self.__load_entry_points()
+        return iter(self.__providers)
+
+    def __len__(self) -> int:
+        self.__load_entry_points()
+        return len(self.__providers)
+
+    def __load_entry_points(self) -> None:
+        """
+        Adds the providers registered by installed packages.  Built-in providers cannot be replaced.
+        """
+        if self.__entry_points_loaded:
+            return
+        self.__entry_points_loaded = True
+        for name, value in self.__iter_entry_points():
+            if name in self.__providers:
+                logging.debug("Ignoring provider entry point '{}', the name is already taken.".format(name))
+                continue
+            self.__providers[name] = value
+
+    @staticmethod
+    def __iter_entry_points() -> list:
+        """
+        Lists the `automatagl.providers` entry points with `importlib.metadata` (Python 3.8+), its `importlib_metadata`
+        backport or `pkg_resources`, whichever is available.
+        :return: A list of (name, `module:Class`) tuples
+        """
+        try:
+            from importlib.metadata import entry_points
+        except ImportError:
+            try:
+                from importlib_metadata import entry_points
+            except ImportError:
+                entry_points = None
+        if entry_points is not None:
+            found = entry_points()
+            if hasattr(found, 'select'):
+                found = found.select(group=entry_point_group)
+            else:
+                found = found.get(entry_point_group, list())
+            return [(i.name, i.value) for i in found]
+        try:
+            import pkg_resources
+        except ImportError:
+            logging.warning("Cannot look up third-party providers, install `importlib_metadata` or `setuptools`.")
+            return list()
+        return [
+            (i.name, '{}:{}'.format(i.module_name, '.'.join(i.attrs)))
+            for i in pkg_resources.iter_entry_points(entry_point_group)
+        ]
+
+
+automata_providers = ProviderRegistry(builtin_providers)
@@ -1,14 +1,105 @@
-from typing import List
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List
+import time
 
+from automatagl.helpers.http_cache import HTTPCache
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
 from automatagl.helpers.provider_operations import ProviderUser
+from automatagl.helpers.snapshot_store import Snapshot
+
+if TYPE_CHECKING:
+    from automatagl.helpers.pipeline import GroupPipeline
 
 
 class BaseProvider:
 
     config: dict
+    http_cache: HTTPCache
+    pipeline: 'GroupPipeline'
 
     def __init__(self, config: dict) -> None:
         self.config = config
+        self.http_cache = HTTPCache(enabled=False)
+        # Set by the synchronizer while it applies groups as they are fetched.
+        self.pipeline = None
 
     def get_users_from_group(self, group: str) -> List[ProviderUser]:
         pass
+
+    async def get_users_from_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        """
+        Get the users of several groups at once.  This default implementation adapts a synchronous provider by running
+        `get_users_from_group` for every group concurrently in the event loop's default executor.
+        :param groups: The group names to query
+        :return: A dictionary of group name to ProviderUsers, in the same order as `groups`
+        """
+        import asyncio
+
+        results = await asyncio.gather(*[
+            self.timed_fetch(group, self.in_executor(self.get_users_from_group, group)) for group in groups
+        ])
+        return dict(zip(groups, results))
+
+    @staticmethod
+    async def in_executor(function: Callable, *args) -> Any:
+        """
+        Runs `function(*args)` in the event loop's default executor.  Unlike `loop.run_in_executor`, nothing runs until
+        the coroutine is awaited, so `timed_fetch` can hold a fetch back until it is its turn.
+        :param function: The blocking function to run
+        :return: The result of `function`
+        """
+        import asyncio
+
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def timed_fetch(self, group: str, fetch: Awaitable) -> List[ProviderUser]:
+        """
+        Awaits the fetch of a single group, recording how long it took in the `group_fetch` phase of the run metrics
+        and as a trace span.  If the synchronizer applies groups as they arrive, the group is handed over as soon as
+        it has been fetched, and a coroutine is only started once the group is close enough to the apply stage.
+        :param group: The group name being fetched
+        :param fetch: The coroutine or future fetching the group
+        :return: The result of `fetch`
+        """
+        pipeline = self.pipeline
+        if pipeline:
+            await pipeline.wait_turn(group)
+        with metrics.phase('group_fetch', group=group), tracer.async_span('group_fetch', group=group):
+            users = await fetch
+        if pipeline:
+            pipeline.put(group, users)
+        return users
+
+    def fetch_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        """
+        Runs `get_users_from_groups` to completion in its own event loop.
+        :param groups: The group names to query
+        :return: A dictionary of group name to ProviderUsers, in the same order as `groups`
+        """
+        # Imported here, so providers that never fetch (e.g. the bundle) do not pay for importing asyncio.
+        import asyncio
+
+        loop = asyncio.new_event_loop()
+        try:
+            group_members = loop.run_until_complete(self.get_users_from_groups(groups))
+        finally:
+            loop.close()
+        # Providers that do not fetch through `timed_fetch` hand every group over at the end.
+        if self.pipeline:
+            for group, users in group_members.items():
+                self.pipeline.put(group, users)
+        return group_members
+
+    def fetch_groups_since(self, snapshots: Dict[str, Snapshot]) -> Dict[str, Snapshot]:
+        """
+        Fetches groups, starting from their last snapshot where the provider can fetch only what changed since.  This
+        default implementation fetches every group in full.
+        :param snapshots: The groups to fetch, with their last snapshot (or `None`)
+        :return: A dictionary of group name to the new Snapshot, in the same order as `snapshots`
+        """
+        fetched_at = time.time()
+        group_members = self.fetch_groups(list(snapshots))
+        return {
+            group: Snapshot(group=group, fetched_at=fetched_at, users=users, cursor=None)
+            for group, users in group_members.items()
+        }
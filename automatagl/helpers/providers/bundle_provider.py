@@ -0,0 +1,53 @@
+from typing import Dict, List
+
+from automatagl.helpers.bundle import read_bundle, BNDGroupNotFoundError
+from automatagl.helpers.provider_operations import ProviderUser
+from automatagl.helpers.providers.base_provider import BaseProvider
+
+__all__ = [
+    'BundleProvider',
+]
+
+# ---
+# config:
+#   provider: bundle
+#   provider_config:
+#     path: /var/lib/automata/bundle.json
+#     signing_key_file: /etc/automata/bundle.key
+
+
+class BundleProvider(BaseProvider):
+    """
+    Reads group members from a bundle written by `automata export`, without any network access.
+    """
+
+    config: dict
+    groups: Dict[str, List[ProviderUser]]
+    path: str
+
+    def __init__(self, config: dict) -> None:
+        """
+        :param config: The bundle configuration settings from Automata
+        """
+        super().__init__(config)
+        self.path = config['path']
+        signing_key = None
+        if config.get('signing_key_file'):
+            with open(config['signing_key_file'], 'rb') as f:
+                signing_key = f.read().strip()
+        self.groups = read_bundle(self.path, signing_key)
+
+    def get_users_from_group(self, group: str) -> List[ProviderUser]:
+        """
+        Get all users from a group in the bundle
+        :param group: The provider group name
+        :return: A list of ProviderUser objects
+        :raises BNDGroupNotFoundError: If the group is not in the bundle (so its members are not mistakenly deleted)
+        """
+        try:
+            return self.groups[group]
+        except KeyError:
+            raise BNDGroupNotFoundError("Group '{}' is not in the bundle '{}'.".format(group, self.path))
+
+    async def get_users_from_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        return {group: self.get_users_from_group(group) for group in groups}
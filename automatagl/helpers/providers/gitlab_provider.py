@@ -1,20 +1,47 @@
 from collections import namedtuple
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Iterator, List, Set, Tuple
+import asyncio
 import json
+import logging
 import os
+import time
 import requests
 
+from automatagl.helpers.http_client import HTTPClient, retry_statuses
+from automatagl.helpers.identity_map import IdentityMap
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
 from automatagl.helpers.provider_operations import ProviderUser
 from automatagl.helpers.providers.base_provider import BaseProvider
+from automatagl.helpers.snapshot_store import Snapshot
 
 __all__ = [
     'GitlabProvider',
     'GLConnectionError',
     'GLApiQueryError',
+    'GLNotFoundError',
 ]
 
 GitlabUser = namedtuple('GitlabUser', ['id', 'username'])
 
+# Direct members of a group with their state and public SSH keys, one page at a time.
+graphql_members_query = """
+query($group: ID!, $first: Int!, $after: String) {
+  group(fullPath: $group) {
+    groupMembers(first: $first, after: $after, relations: [DIRECT]) {
+      pageInfo { hasNextPage endCursor }
+      nodes { user { id username state %s } }
+    }
+  }
+}
+"""
+graphql_keys_field = 'publicKeys { nodes { key } }'
+
+# Audit events are looked up this many seconds before the cursor, in case the clocks of Gitlab and Automata disagree.
+audit_event_overlap = 300
+
 
 class GitlabProvider(BaseProvider):
     """
@@ -24,8 +51,15 @@ class GitlabProvider(BaseProvider):
     api_token: str
     api_address: str
     config: dict
-    payload_token: dict
+    full_sync_interval: float
+    graphql_address: str
+    incremental: bool
+    max_workers: int
+    user_keys: IdentityMap
+    mode: str
     only_active: bool
+    per_page: int
+    session: HTTPClient
 
     def __init__(self, config: dict) -> None:
         """
@@ -35,63 +69,420 @@ class GitlabProvider(BaseProvider):
         self.api_token = config['api_token']
         self.api_address = config['api_address']
         self.only_active = config['only_active']
-        self.payload_token = {
-            'private_token': self.api_token,
-        }
+        self.max_workers = int(config.get('max_workers', 8))
+        self.mode = config.get('mode', 'rest')
+        self.graphql_address = config.get(
+            'graphql_address', os.path.join(os.path.dirname(self.api_address.rstrip('/')), 'graphql')
+        )
+        self.incremental = bool(config.get('incremental', False))
+        self.full_sync_interval = float(config.get('full_sync_interval', 86400))
+        self.per_page = 100
+        # Whether the server exposes SSH keys over GraphQL, probed once before the first fetch.
+        self.__graphql_keys = None
+        self.__user_ids = dict()
+        # Users are often members of several groups, their keys are only fetched once per run.
+        self.user_keys = IdentityMap()
+
+        # One connection pool for the whole run, sized for the key fetching workers.
+        self.session = HTTPClient.from_config(config, self.max_workers)
+        self.session.headers['PRIVATE-TOKEN'] = self.api_token
 
     def get_users_from_group(self, group: str) -> List[ProviderUser]:
         """
         Get all users from a Gitlab Group
         :param group: The group name in Gitlab
-        :return: A GitlabUser object with the user information
+        :return: A list of ProviderUser objects with the user information, in the order Gitlab returned them
+        """
+        if self.mode == 'graphql':
+            return self.get_users_from_group_graphql(group)
+        members = self.get_members_from_group(group)
+
+        # `map` hands the results back in submission order, so the output stays deterministic.
+        with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            keys = executor.map(self.get_keys, [member.id for member in members])
+            return [ProviderUser(username=m.username, keys=k) for m, k in zip(members, keys)]
+
+    async def get_users_from_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        """
+        Get all users from several Gitlab groups.  The member lists of every group are fetched concurrently, and the
+        keys of the members of a group as soon as its member list arrives, all sharing the same `max_workers` limit and
+        connection pool.
+        :param groups: The group names in Gitlab
+        :return: A dictionary of group name to ProviderUsers, in the same order as `groups`
+        """
+        loop = asyncio.get_event_loop()
+        if self.mode == 'graphql':
+            # Probed before the fan-out, so every group is fetched the same way.
+            with_keys = self.graphql_keys_supported(groups[0]) if groups else True
+            results = await asyncio.gather(*[
+                self.timed_fetch(group, self.in_executor(self.get_users_from_group_graphql, group, with_keys))
+                for group in groups
+            ])
+            return dict(zip(groups, results))
+
+        async def fetch_group(group: str) -> List[ProviderUser]:
+            # The keys of the members of a page are requested while the next page of members is being fetched.
+            members, usernames, keys = self.iter_members_from_group(group), list(), list()
+            while True:
+                page = await loop.run_in_executor(executor, list, islice(members, self.per_page))
+                if not page:
+                    break
+                usernames.extend(m.username for m in page)
+                keys.extend(loop.run_in_executor(executor, self.get_keys, m.id) for m in page)
+            keys = await asyncio.gather(*keys)
+            return [ProviderUser(username=u, keys=k) for u, k in zip(usernames, keys)]
+
+        with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            results = await asyncio.gather(*[self.timed_fetch(group, fetch_group(group)) for group in groups])
+        return dict(zip(groups, results))
+
+    def get_users_from_group_graphql(self, group: str, with_keys: bool = None) -> List[ProviderUser]:
+        """
+        Get all users and their keys from a Gitlab group with cursor-paginated GraphQL queries, 100 members at a time.
+        If the server does not expose SSH keys over GraphQL, the keys are fetched through the REST API instead.
+        :param group: The group name (full path) or ID in Gitlab
+        :param with_keys: Whether to query the keys over GraphQL (probed with `graphql_keys_supported` if `None`)
+        :return: A list of ProviderUser objects with the user information, in the order Gitlab returned them
+        """
+        if with_keys is None:
+            with_keys = self.graphql_keys_supported(group)
+        group = self.__graphql_group_path(group)
+        query = graphql_members_query % (graphql_keys_field if with_keys else '')
+        # Every page is turned into compact records before the next one is requested, so the decoded JSON of only one
+        # page is held at a time.
+        users, members_without_keys, cursor = list(), list(), None
+        while True:
+            data = self.__process_graphql_query(query, {'group': group, 'first': self.per_page, 'after': cursor})
+            if not data.get('group'):
+                raise GLApiQueryError("Group '{}' not found.".format(group))
+            members = data['group']['groupMembers']
+            for node in members['nodes']:
+                user = node.get('user')
+                if not user or (self.only_active and user['state'] != 'active'):
+                    continue
+                member = GitlabUser(id=int(user['id'].rsplit('/', 1)[-1]), username=user['username'])
+                self.__user_ids[member.username] = member.id
+                if with_keys:
+                    users.append(ProviderUser(username=member.username, keys=[
+                        k['key'] for k in user['publicKeys']['nodes']
+                    ]))
+                else:
+                    members_without_keys.append(member)
+            if not members['pageInfo']['hasNextPage']:
+                break
+            cursor = members['pageInfo']['endCursor']
+
+        if with_keys:
+            return users
+        with ThreadPoolExecutor(max_workers=max(self.max_workers, 1)) as executor:
+            keys = executor.map(self.get_keys, [member.id for member in members_without_keys])
+            return [ProviderUser(username=m.username, keys=k) for m, k in zip(members_without_keys, keys)]
+
+    def graphql_keys_supported(self, group: str) -> bool:
+        """
+        Checks whether the Gitlab server exposes SSH keys over GraphQL, by asking for the keys of a single member of a
+        group.  The server is only asked once.
+        :param group: The group name (full path) or ID in Gitlab to query
+        :return: Whether the keys can be queried over GraphQL
+        """
+        if self.__graphql_keys is None:
+            variables = {'group': self.__graphql_group_path(group), 'first': 1, 'after': None}
+            try:
+                self.__process_graphql_query(graphql_members_query % graphql_keys_field, variables)
+                self.__graphql_keys = True
+            except GLApiQueryError as e:
+                logging.info("The Gitlab server does not expose SSH keys over GraphQL, fetching them through the REST "
+                             "API: {}".format(e.message))
+                self.__graphql_keys = False
+        return self.__graphql_keys
+
+    def __graphql_group_path(self, group: str) -> str:
+        """
+        GraphQL only looks groups up by full path, numeric IDs are looked up through the REST API.
+        :param group: The group name (full path) or ID in Gitlab
+        :return: The full path of the group
+        """
+        if not str(group).isdigit():
+            return group
+        response = self.__process_response_from_server(os.path.join(self.api_address, 'groups/{}'.format(group)))[0]
+        return response['full_path']
+
+    def get_members_from_group(self, group: str) -> List[GitlabUser]:
+        """
+        Get the members of a Gitlab group, honoring the `only_active` setting.
+        :param group: The group name in Gitlab
+        :return: A list of GitlabUser objects
+        """
+        with tracer.span('get_members_from_group', group=group):
+            return list(self.iter_members_from_group(group))
+
+    def iter_members_from_group(self, group: str) -> Iterator[GitlabUser]:
+        """
+        Yields the members of a Gitlab group, honoring the `only_active` setting.  Pages are requested as they are
+        consumed.
+        :param group: The group name in Gitlab
+        :return: An iterator of GitlabUser objects
         """
-        users = list()
         path = os.path.join(self.api_address, 'groups/{}/members'.format(group))
-        response = self.__process_response_from_server(path)
-        if self.only_active:
-            members = [GitlabUser(id=i['id'], username=i['username']) for i in response if i['state'] == 'active']
-        else:
-            members = [GitlabUser(id=i['id'], username=i['username']) for i in response]
-        for member in members:
-            users.append(
-                ProviderUser(
-                    username=member.username,
-                    keys=self.get_keys_from_user_id(member.id)
-                )
-            )
-        return users
+        for i in self.__iter_pages(path):
+            if not self.only_active or i['state'] == 'active':
+                member = GitlabUser(id=i['id'], username=i['username'])
+                self.__user_ids[member.username] = member.id
+                yield member
+
+    def get_keys(self, user_id: int) -> Tuple[str, ...]:
+        """
+        Get all SSH public keys associated with a given user ID, only querying Gitlab the first time they are asked for
+        during a run.
+        :param user_id: The user ID to query
+        :return: A tuple of SSH public keys associated with the user ID.
+        """
+        return self.user_keys.get(user_id, self.get_keys_from_user_id)
 
-    def get_keys_from_user_id(self, user_id: int) -> list:
+    def get_keys_from_user_id(self, user_id: int) -> Tuple[str, ...]:
         """
         Get all SSH public keys associated with a given user ID.
         :param user_id: The user ID to query
-        :return: A list of SSH public keys associated with the user ID.
+        :return: A tuple of SSH public keys associated with the user ID, shared by every ProviderUser of the user.
         """
         path = os.path.join(self.api_address, 'users/{}/keys'.format(user_id))
-        response = self.__process_response_from_server(path)
-        keys = [i["key"] for i in response]
-        return keys
+        with tracer.span('get_keys_from_user_id', user_id=user_id):
+            return tuple(i["key"] for i in self.__iter_pages(path))
+
+    def fetch_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        self.user_keys.clear()
+        try:
+            return super().fetch_groups(groups)
+        finally:
+            self.__report_key_dedup()
+
+    def fetch_groups_since(self, snapshots: Dict[str, Snapshot]) -> Dict[str, Snapshot]:
+        """
+        In `incremental` mode, only the members that audit events mention since the last snapshot of a group are
+        fetched again, and the changes are applied to the snapshot.  Groups without a usable snapshot, or whose last
+        full fetch is more than `full_sync_interval` seconds ago, are fetched in full.
+        :param snapshots: The groups to fetch, with their last snapshot (or `None`)
+        :return: A dictionary of group name to the new Snapshot, in the same order as `snapshots`
+        """
+        if not self.incremental:
+            return super().fetch_groups_since(snapshots)
+        self.user_keys.clear()
+        try:
+            return self.__fetch_groups_since(snapshots)
+        finally:
+            self.__report_key_dedup()
+
+    def __fetch_groups_since(self, snapshots: Dict[str, Snapshot]) -> Dict[str, Snapshot]:
+        started = time.time()
+        full, partial = list(), dict()
+        for group, snapshot in snapshots.items():
+            cursor = snapshot.cursor if snapshot else None
+            if cursor and started - cursor.get('full_sync_at', 0) < self.full_sync_interval:
+                partial[group] = snapshot
+            else:
+                full.append(group)
+
+        results = dict()
+        if partial:
+            try:
+                since = min(i.cursor['since'] for i in partial.values())
+                user_events = self.get_user_event_ids(since)
+                for group, snapshot in partial.items():
+                    results[group] = self.__apply_changes(snapshot, user_events, started)
+                    if self.pipeline:
+                        self.pipeline.put(group, results[group].users)
+            except GLApiQueryError as e:
+                logging.warning("Cannot sync incrementally ({}), fetching every group in full from now on.".format(
+                    e.message
+                ))
+                self.incremental = False
+                full.extend(i for i in partial if i not in results)
+        metrics.increment('groups_incremental', len(results))
+        metrics.increment('groups_full_sync', len(full))
 
-    def __process_response_from_server(self, path) -> List[dict]:
+        if full:
+            for group, users in super().fetch_groups(full).items():
+                user_ids = {i.username: self.__user_ids[i.username] for i in users if i.username in self.__user_ids}
+                cursor = {'full_sync_at': started, 'since': started, 'user_ids': user_ids}
+                results[group] = Snapshot(group=group, fetched_at=started, users=users, cursor=cursor)
+        return {group: results[group] for group in snapshots}
+
+    def get_user_event_ids(self, since: float) -> Set[int]:
+        """
+        Get the IDs of the users with instance audit events (such as added or removed SSH keys) since a given time.
+        This needs an administrator token.
+        :param since: The Unix time to look for events from
+        :return: The set of user IDs
+        """
+        path = os.path.join(self.api_address, 'audit_events')
+        with tracer.span('get_user_event_ids'):
+            params = {'entity_type': 'User', 'created_after': self.__audit_time(since)}
+            return {i['entity_id'] for i in self.__iter_pages(path, params)}
+
+    def get_member_event_ids(self, group: str, since: float) -> Set[int]:
+        """
+        Get the IDs of the users whose membership of a group changed since a given time, from the group's audit events.
+        :param group: The group name in Gitlab
+        :param since: The Unix time to look for events from
+        :return: The set of user IDs
+        """
+        path = os.path.join(self.api_address, 'groups/{}/audit_events'.format(group))
+        with tracer.span('get_member_event_ids', group=group):
+            return {
+                i['details']['target_id'] for i in self.__iter_pages(path, {'created_after': self.__audit_time(since)})
+                if i.get('details', {}).get('target_type') == 'User' and i['details'].get('target_id')
+            }
+
+    def get_member(self, group: str, user_id: int) -> GitlabUser:
+        """
+        Get a direct member of a Gitlab group, honoring the `only_active` setting.
+        :param group: The group name in Gitlab
+        :param user_id: The user ID to look up
+        :return: The GitlabUser, or `None` if the user is not an (active) member of the group
+        """
+        path = os.path.join(self.api_address, 'groups/{}/members/{}'.format(group, user_id))
+        try:
+            member = self.__process_response_from_server(path)[0]
+        except GLNotFoundError:
+            return None
+        if self.only_active and member['state'] != 'active':
+            return None
+        return GitlabUser(id=member['id'], username=member['username'])
+
+    def __apply_changes(self, snapshot: Snapshot, user_events: Set[int], started: float) -> Snapshot:
+        """
+        Refetches the members of a group that changed since its snapshot, and applies the changes to the snapshot.
+        :param snapshot: The last snapshot of the group
+        :param user_events: The IDs of the users with instance audit events since the snapshot
+        :param started: When this fetch started
+        :return: The new Snapshot
+        """
+        group, cursor = snapshot.group, snapshot.cursor
+        with metrics.phase('group_fetch', group=group), tracer.span('group_fetch', group=group):
+            user_ids = dict(cursor['user_ids'])
+            changed = self.get_member_event_ids(group, cursor['since'])
+            known_ids = set(user_ids.values())
+            changed.update(i for i in user_events if i in known_ids)
+
+            # Members keep their position in the snapshot, new members are added at the end.
+            users = {i.username: i for i in snapshot.users}
+            for user_id in sorted(changed):
+                member = self.get_member(group, user_id)
+                # A member that is still there is updated in place, unless the user was renamed.
+                for username in [k for k, v in user_ids.items() if v == user_id]:
+                    if not member or member.username != username:
+                        users.pop(username, None)
+                        del user_ids[username]
+                if member:
+                    users[member.username] = ProviderUser(
+                        username=member.username, keys=self.get_keys(member.id)
+                    )
+                    user_ids[member.username] = member.id
+        if changed:
+            logging.debug("Refetched {} changed members of group '{}'.".format(len(changed), group))
+        return Snapshot(
+            group=group,
+            fetched_at=started,
+            users=list(users.values()),
+            cursor=dict(cursor, since=started, user_ids=user_ids),
+        )
+
+    def __report_key_dedup(self) -> None:
+        """
+        Records how many key lookups of this run were answered by the identity map instead of Gitlab.
+        """
+        metrics.increment('user_keys_fetched', self.user_keys.misses)
+        metrics.increment('user_keys_deduplicated', self.user_keys.hits)
+        metrics.set_gauge('user_keys_dedup_ratio', self.user_keys.hit_rate)
+        if self.user_keys.hits:
+            logging.debug("Fetched the keys of {} users, {:.0%} of the key lookups were answered from memory.".format(
+                self.user_keys.misses, self.user_keys.hit_rate
+            ))
+
+    @staticmethod
+    def __audit_time(since: float) -> str:
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(since - audit_event_overlap))
+
+    def __iter_pages(self, path: str, params: dict = None) -> Iterator[dict]:
+        """
+        Yields the objects of a collection, following the `Link` headers returned by Gitlab.  The next page is only
+        requested once the objects of the current one have been consumed, and only one decoded page is held at a time.
+        :param path: The path of the collection to query
+        :param params: Additional query string parameters for the first page
+        :return: An iterator of the objects from every page
+        """
+        next_path, params = path, dict(params or {}, per_page=self.per_page)
+        while next_path:
+            page, next_path = self.__process_response_from_server(next_path, params)
+            # The `next` link already carries the query string of the original request.
+            params = None
+            yield from page
+
+    def __process_graphql_query(self, query: str, variables: dict) -> dict:
+        """
+        Sends a query to the Gitlab GraphQL API
+        :param query: The GraphQL query
+        :param variables: The variables of the query
+        :return: The `data` of the response
+        :raises GLApiQueryError: On any errors returned by the GL server query
+        :raises GLConnectionError: On any connection issues with the GL server
+        """
+        metrics.increment('http_requests')
+        try:
+            with tracer.span('POST', url=self.graphql_address, group=variables.get('group')):
+                raw_response = self.session.post(
+                    self.graphql_address,
+                    json={'query': query, 'variables': variables},
+                    headers={'Authorization': 'Bearer {}'.format(self.api_token)},
+                )
+        except requests.exceptions.RequestException:
+            raise GLConnectionError
+        response = self.__decode(raw_response)
+        if response.get('errors'):
+            raise GLApiQueryError('; '.join(i.get('message', '') for i in response['errors']))
+        if 'data' not in response:
+            raise GLApiQueryError(response.get('message', 'Invalid GraphQL response.'))
+        return response['data']
+
+    def __process_response_from_server(self, path: str, params: dict = None) -> Tuple[List[dict], str]:
         """
         Performs queries to the Gitlab server and process the response for common errors/issues
         :param path: The path to query
-        :return: The response object
+        :param params: Query string parameters to send along with the request
+        :return: The decoded page and the path of the next page (or None on the last page)
         :raises GLApiQueryError: On any errors returned by the GL server query
         :raises GLConnectionError: On any connection issues with the GL server
         """
         try:
-            response = json.loads(requests.get(path, params=self.payload_token).text)
-        except requests.exceptions.ConnectionError:
+            raw_response = self.http_cache.get(self.session, path, params=params)
+        except requests.exceptions.RequestException:
             raise GLConnectionError
+        response = self.__decode(raw_response)
+        if raw_response.status_code == 404:
+            raise GLNotFoundError(response.get('message', 'Not found') if isinstance(response, dict) else 'Not found')
         if isinstance(response, dict):
             if "error" in response.keys():
-                raise GLApiQueryError(message=response["error_description"])
+                raise GLApiQueryError(message=response.get("error_description", response["error"]))
             elif "message" in response.keys():
                 raise GLApiQueryError(response["message"])
-            else:
-                raise GLApiQueryError(response[response])
-        return response
+        return response, raw_response.links.get('next', {}).get('url')
+
+    @staticmethod
+    def __decode(raw_response: requests.Response):
+        """
+        Decodes the JSON body of a response.
+        :param raw_response: The response from the Gitlab server
+        :return: The decoded body
+        :raises GLApiQueryError: If the body is not valid JSON
+        :raises GLConnectionError: If the server was still unavailable or rate limiting after every retry
+        """
+        if raw_response.status_code in retry_statuses:
+            raise GLConnectionError
+        try:
+            # Decoded straight from the body bytes, `text` would hold another (up to four times larger) copy of them.
+            return json.loads(raw_response.content)
+        except ValueError:
+            raise GLApiQueryError("Invalid response from the Gitlab server (HTTP {}).".format(raw_response.status_code))
 
 
 class GLError(Exception):
@@ -106,3 +497,7 @@ class GLApiQueryError(GLError):
 
     def __init__(self, message):
         self.message = message
+
+
+class GLNotFoundError(GLApiQueryError):
+    pass
@@ -1,8 +1,17 @@
-from typing import List
+from typing import Dict, List
+import asyncio
+import base64
 import os
 import json
+import logging
+import threading
+import time
 import requests
 
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.http_client import HTTPClient
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
 from automatagl.helpers.providers.base_provider import BaseProvider
 from automatagl.helpers.provider_operations import ProviderUser
 
@@ -13,6 +22,7 @@ from automatagl.helpers.provider_operations import ProviderUser
 #     sca_address: https://sca.address.com/api
 #     username: username
 #     password: password
+#     token_cache: /var/lib/automata/sca_token.json
 
 
 class SCAProvider(BaseProvider):
@@ -21,49 +31,148 @@ class SCAProvider(BaseProvider):
     api_address: str
     jwt_token: str
     header: dict
+    session: HTTPClient
+    token_cache: str
 
     def __init__(self, config: dict):
         super().__init__(config)
         self.address = self.config['api_address']
-        self.jwt_token = self.__get_jwt_token(
-            config['username'],
-            config['password'],
-        )
+        self.token_cache = self.config.get('token_cache', '/var/lib/automata/sca_token.json')
+        self.session = HTTPClient.from_config(self.config)
+        self.__group_index = None
+        self.__group_index_lock = threading.Lock()
+        self.jwt_token = self.__load_cached_token()
+        if not self.jwt_token:
+            self.__login()
         self.header = {"Authorization": "Bearer {}".format(self.jwt_token)}
 
     def get_users_from_group(self, group: str) -> List[ProviderUser]:
         group = self.get_group_from_sca(group)
         if not group:
             return []
-        group_info_path = self.generate_full_path('group/{}'.format(group['id']))
-        group_info = json.loads(requests.get(group_info_path, headers=self.header).text)
-        users = list()
-        for u in group_info['users']:
-            users.append(ProviderUser(username=u['username'], keys=[k['pub_ssh_key'] for k in u['keys']]))
-        return users
+        return self.get_users_from_group_id(group['id'])
 
-    def get_group_from_sca(self, group: str) -> dict:
+    async def get_users_from_groups(self, groups: List[str]) -> Dict[str, List[ProviderUser]]:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.get_group_index)
+        group_ids = [self.get_group_from_sca(group).get('id') for group in groups]
+        results = await asyncio.gather(*[
+            self.timed_fetch(group, self.in_executor(self.get_users_from_group_id, i))
+            for group, i in zip(groups, group_ids) if i is not None
+        ])
+        results = iter(results)
+        return {group: next(results) if i is not None else [] for group, i in zip(groups, group_ids)}
+
+    def get_users_from_group_id(self, group_id: int) -> List[ProviderUser]:
+        group_info_path = self.generate_full_path('group/{}'.format(group_id))
+        # SCA returns every member at once: decode the body bytes without a `text` copy, and turn the members into
+        # compact records as they are read.
+        members = json.loads(self.__get(group_info_path).content)['users']
+        return [ProviderUser(username=u['username'], keys=[k['pub_ssh_key'] for k in u['keys']]) for u in members]
+
+    def get_all_groups_from_sca(self) -> List[dict]:
         path = self.generate_full_path('groups')
-        groups = json.loads(requests.get(path, headers=self.header).text)
-        group_query = [g for g in groups if g['name'] == group]
-        if group_query:
-            return group_query[0]
-        return {}
+        return json.loads(self.__get(path).content)
+
+    def get_group_index(self) -> Dict[str, dict]:
+        """
+        Downloads the group list once per run and indexes it by name.
+        :return: A dictionary of group name to SCA group
+        """
+        with self.__group_index_lock:
+            if self.__group_index is None:
+                self.__group_index = dict()
+                for g in self.get_all_groups_from_sca():
+                    self.__group_index.setdefault(g['name'], g)
+            return self.__group_index
+
+    def get_group_from_sca(self, group: str) -> dict:
+        return self.get_group_index().get(group, {})
 
     def generate_full_path(self, relative_path: str):
         return os.path.join(self.address, relative_path)
 
+    def __get(self, path: str) -> requests.Response:
+        """
+        Performs a GET request on the shared session, logging in again once if the token was rejected.
+        :param path: The path to query
+        :return: The response object
+        """
+        response = self.http_cache.get(self.session, path, headers=self.header)
+        if response.status_code == 401:
+            self.__login()
+            response = self.http_cache.get(self.session, path, headers=self.header)
+        return response
+
+    def __login(self) -> None:
+        self.jwt_token = self.__get_jwt_token(
+            self.config['username'],
+            self.config['password'],
+        )
+        self.header = {"Authorization": "Bearer {}".format(self.jwt_token)}
+        self.__save_cached_token()
+
     def __get_jwt_token(self, username: str, password: str):
         payload = {
             "username": username,
             "password": password,
         }
         path = self.generate_full_path('login')
-        response = json.loads(requests.post(path, json=payload).text)
+        metrics.increment('http_requests')
+        with tracer.span('POST', url=path):
+            response = json.loads(self.session.post(path, json=payload).text)
         if 'access_token' not in response.keys():
             raise SCANotAuthorized(response["message"])
         return response['access_token']
 
+    def __load_cached_token(self) -> str:
+        """
+        Returns the access token saved by an earlier run if it belongs to this server/user and has not expired.
+        :return: The access token, or an empty string if a new one is needed
+        """
+        try:
+            with open(self.token_cache, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return ''
+        if cached.get('api_address') != self.address or cached.get('username') != self.config['username']:
+            return ''
+        token = cached.get('access_token', '')
+        # Leave a minute of slack so the token does not expire halfway through the run.
+        if self.__get_token_expiry(token) < time.time() + 60:
+            return ''
+        return token
+
+    def __save_cached_token(self) -> None:
+        """
+        Saves the access token readable only by the owner of the cache file.
+        """
+        contents = json.dumps({
+            'api_address': self.address,
+            'username': self.config['username'],
+            'access_token': self.jwt_token,
+        })
+        try:
+            os.makedirs(os.path.dirname(self.token_cache), mode=0o700, exist_ok=True)
+            write_atomically(self.token_cache, contents, mode=0o600)
+        except OSError as e:
+            logging.warning("Cannot cache the SCA access token in '{}', logging in again on the next run: {}".format(
+                self.token_cache, e))
+
+    @staticmethod
+    def __get_token_expiry(token: str) -> float:
+        """
+        Reads the `exp` claim of a JWT without verifying it (the server does that).
+        :param token: The JWT
+        :return: The expiry time, or 0 if it cannot be determined
+        """
+        try:
+            payload = token.split('.')[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)).decode('utf-8'))
+            return float(claims['exp'])
+        except (IndexError, KeyError, TypeError, ValueError):
+            return 0
+
 
 class SCAError(Exception):
     pass
@@ -0,0 +1,163 @@
+from typing import List
+import json
+import logging
+import os
+import threading
+import time
+
+from automatagl.helpers.atomic_file import write_atomically
+
+__all__ = [
+    'PurgeQueue',
+]
+
+
+class PurgeQueue:
+    """
+    A persisted queue of home directories waiting to be removed.  Deleted users' homes are renamed into a tombstone
+    directory right away and reclaimed by a throttled background worker, so large homes never hold up a sync.
+    """
+
+    entries: List[dict]
+    files_per_second: int
+    queue_file: str
+    retention: int
+    tombstone_dir: str
+
+    def __init__(self,
+                 queue_file: str,
+                 tombstone_dir: str,
+                 retention: int = 0,
+                 files_per_second: int = 0) -> None:
+        """
+        :param queue_file: Where the queue is persisted between runs
+        :param tombstone_dir: The directory homes are moved into (must be on the same filesystem as the homes)
+        :param retention: How long to keep a tombstoned home before removing it (in seconds)
+        :param files_per_second: The maximum number of files to remove per second (unlimited if 0)
+        """
+        self.queue_file = queue_file
+        self.tombstone_dir = tombstone_dir
+        self.retention = retention
+        self.files_per_second = files_per_second
+        self.entries = list()
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__finishing = threading.Event()
+        self.__wakeup = threading.Event()
+        self.__thread = None
+        self.__failed = set()
+        try:
+            with open(self.queue_file, 'r') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logging.warning("Cannot read the purge queue '{}', starting with an empty queue.".format(queue_file))
+
+    def enqueue(self, user: str, home: str) -> str:
+        """
+        Moves a home directory into the tombstone directory and queues it for removal.
+        :param user: The name of the user that owned the home directory
+        :param home: The home directory
+        :return: The tombstone path of the home directory
+        """
+        os.makedirs(self.tombstone_dir, mode=0o700, exist_ok=True)
+        tombstone = os.path.join(self.tombstone_dir, '{}.{}'.format(user, time.time()))
+        os.rename(home, tombstone)
+        with self.__lock:
+            self.entries.append({'user': user, 'path': tombstone, 'queued': time.time()})
+            self.__save()
+        self.__wakeup.set()
+        logging.debug("Queued '{}' for removal as '{}'.".format(home, tombstone))
+        return tombstone
+
+    def start(self) -> None:
+        """
+        Starts the background worker that removes queued homes once their retention period is over.
+        """
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run, name='automata-purge', daemon=True)
+            self.__thread.start()
+
+    def finish(self, timeout: float = None) -> None:
+        """
+        Lets the worker remove whatever is due and then stops it.  Anything left over stays queued for the next run.
+        :param timeout: How long to wait for the worker (in seconds, forever if `None`)
+        """
+        if self.__thread is None:
+            return
+        self.__finishing.set()
+        self.__wakeup.set()
+        self.__thread.join(timeout)
+        if self.__thread.is_alive():
+            logging.info("Stopping the purge worker, {} homes are still queued.".format(len(self.entries)))
+            self.__stop.set()
+            self.__thread.join()
+        self.__thread = None
+
+    def __run(self) -> None:
+        while not self.__stop.is_set():
+            entry = self.__next_due()
+            if entry is None:
+                if self.__finishing.is_set():
+                    break
+                self.__wakeup.wait(1)
+                self.__wakeup.clear()
+                continue
+            try:
+                purged = self.__purge(entry['path'])
+            except OSError as e:
+                logging.warning("Cannot remove '{}': {}".format(entry['path'], e))
+                self.__failed.add(entry['path'])
+                continue
+            if purged:
+                logging.info("Removed the home directory of deleted user '{}'.".format(entry['user']))
+                with self.__lock:
+                    self.entries.remove(entry)
+                    self.__save()
+
+    def __next_due(self) -> dict:
+        with self.__lock:
+            due = [
+                i for i in self.entries
+                if i['queued'] + self.retention <= time.time() and i['path'] not in self.__failed
+            ]
+        return due[0] if due else None
+
+    def __purge(self, path: str) -> bool:
+        """
+        Removes a directory tree bottom-up, throttled to `files_per_second`.
+        :param path: The directory to remove
+        :return: True if the directory was completely removed, False if the worker was stopped
+        """
+        started = time.monotonic()
+        removed = 0
+        for root, dirs, files in os.walk(path, topdown=False):
+            for name in files + dirs:
+                if self.__stop.is_set():
+                    return False
+                full_path = os.path.join(root, name)
+                try:
+                    if os.path.isdir(full_path) and not os.path.islink(full_path):
+                        os.rmdir(full_path)
+                    else:
+                        os.unlink(full_path)
+                except FileNotFoundError:
+                    pass
+                removed += 1
+                if self.files_per_second:
+                    delay = removed / self.files_per_second - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def __save(self) -> None:
+        """
+        Atomically persists the queue to `queue_file`.
+        """
+        os.makedirs(os.path.dirname(self.queue_file), mode=0o700, exist_ok=True)
+        write_atomically(self.queue_file, json.dumps(self.entries), mode=0o600)
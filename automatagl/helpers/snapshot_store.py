@@ -0,0 +1,85 @@
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import os
+import time
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.provider_operations import ProviderUser
+
+__all__ = [
+    'Snapshot',
+    'SnapshotStore',
+]
+
+# `cursor` is whatever the provider needs to fetch only the changes since the snapshot was taken (or `None`).
+Snapshot = namedtuple('Snapshot', ['group', 'fetched_at', 'users', 'cursor'])
+
+
+class SnapshotStore:
+    """
+    Keeps the last members and keys successfully fetched for every provider group on disk, so a run can go ahead with
+    known-good state while the provider is slow or unreachable.
+    """
+
+    max_staleness: float
+    revalidate_timeout: float
+    snapshot_dir: str
+
+    def __init__(self, snapshot_dir: str, max_staleness: float = 86400, revalidate_timeout: float = 30) -> None:
+        """
+        :param snapshot_dir: The directory to keep the snapshots in
+        :param max_staleness: How old a snapshot may be, in seconds, before it is no longer applied
+        :param revalidate_timeout: How long to wait for the provider before falling back to the snapshots, in seconds
+        """
+        self.snapshot_dir = snapshot_dir
+        self.max_staleness = max_staleness
+        self.revalidate_timeout = revalidate_timeout
+
+    def load(self, group: str) -> Snapshot:
+        """
+        Reads the snapshot of a group.
+        :param group: The provider group
+        :return: The Snapshot, or `None` if there is no readable snapshot of the group
+        """
+        try:
+            with open(self.__snapshot_path(group), 'r') as f:
+                data = json.load(f)
+            return Snapshot(
+                group=data['group'],
+                fetched_at=float(data['fetched_at']),
+                users=[ProviderUser(username=username, keys=keys) for username, keys in data['users']],
+                cursor=data.get('cursor'),
+            )
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, snapshot: Snapshot) -> None:
+        """
+        Atomically replaces the snapshot of a group.
+        :param snapshot: The Snapshot, with the members in the order the provider returned them
+        """
+        group = snapshot.group
+        data = json.dumps({
+            'group': group,
+            'fetched_at': snapshot.fetched_at,
+            'users': [[user.username, list(user.keys)] for user in snapshot.users],
+            'cursor': snapshot.cursor,
+        })
+        try:
+            os.makedirs(self.snapshot_dir, mode=0o700, exist_ok=True)
+            write_atomically(self.__snapshot_path(group), data, mode=0o600)
+        except OSError as e:
+            logging.warning("Could not save the snapshot of group '{}': {}".format(group, e))
+
+    def is_fresh(self, snapshot: Snapshot) -> bool:
+        return self.age(snapshot) <= self.max_staleness
+
+    @staticmethod
+    def age(snapshot: Snapshot) -> float:
+        return max(time.time() - snapshot.fetched_at, 0.0)
+
+    def __snapshot_path(self, group: str) -> str:
+        digest = hashlib.sha256(str(group).encode('utf-8')).hexdigest()
+        return os.path.join(self.snapshot_dir, '{}.json'.format(digest))
@@ -1,31 +1,43 @@
+import sys
+
 from automatagl.helpers.config_parser import sanitize_username
+from automatagl.helpers.ssh_key_parser import KeyParser
 
 
 class SSHKeyObject:
     """
-    An SSH key storage object to make things a bit easier to manage.
+    An SSH key storage object to make things a bit easier to manage.  One is kept per desired user, so it has no
+    `__dict__` and shares its (interned) username with the other objects describing the same user.
     """
 
+    __slots__ = ('ssh_keys', 'fingerprints', 'username')
+
     def __init__(self, username: str = '') -> None:
         """
         Create the SSH key object
         :param username: the username of the account with the SSH keys
         """
         self.ssh_keys = list()
-        self.username = sanitize_username(username)
+        self.fingerprints = list()
+        self.username = sys.intern(sanitize_username(username))
 
-    def add_keys(self, ssh_keys) -> None:
+    def add_keys(self, ssh_keys, key_parser: KeyParser = None) -> None:
         """
         Add one or more keys to the SSH key object
         :param ssh_keys: The ssk_key(s) to add.
+        :param key_parser: Validates and deduplicates the keys (they are stored verbatim if `None`)
         :return:
         """
-        if isinstance(ssh_keys, list):
-            self.ssh_keys = ssh_keys
-        elif isinstance(ssh_keys, str):
-            self.ssh_keys = [ssh_keys]
-        else:
-            raise TypeError("SSH keys must either be type 'list' or 'str'.")
+        if isinstance(ssh_keys, str):
+            ssh_keys = [ssh_keys]
+        elif not isinstance(ssh_keys, (list, tuple)):
+            raise TypeError("SSH keys must either be type 'list', 'tuple' or 'str'.")
+        if key_parser is None:
+            self.ssh_keys = list(ssh_keys)
+            return
+        parsed_keys = key_parser.filter_keys(self.username, ssh_keys)
+        self.ssh_keys = [' '.join(i for i in (k.type, k.blob, k.comment) if i) for k in parsed_keys]
+        self.fingerprints = [k.fingerprint for k in parsed_keys]
 
     def get_authorized_keys(self) -> str:
         """
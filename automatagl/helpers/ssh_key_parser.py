@@ -0,0 +1,255 @@
+from collections import namedtuple
+from typing import Dict, List
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import struct
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.provider_operations import KeyPolicy
+
+__all__ = [
+    'KeyParser',
+    'ParsedKey',
+    'parse_key',
+    'SKPError',
+    'SKPInvalidKeyError',
+]
+
+ParsedKey = namedtuple('ParsedKey', ['type', 'blob', 'comment', 'fingerprint', 'bits'])
+
+# Key sizes that are fixed by the key type (RSA and DSA sizes are read from the key itself).
+fixed_key_bits = {
+    'ecdsa-sha2-nistp256': 256,
+    'ecdsa-sha2-nistp384': 384,
+    'ecdsa-sha2-nistp521': 521,
+    'ssh-ed25519': 256,
+    'sk-ecdsa-sha2-nistp256@openssh.com': 256,
+    'sk-ssh-ed25519@openssh.com': 256,
+}
+certificate_suffix = '-cert-v01@openssh.com'
+
+# Every key type OpenSSH still accepts by default, with RSA keys of at least 2048 bits.
+default_key_policy = KeyPolicy(allowed_types=sorted(fixed_key_bits) + ['ssh-rsa'], min_bits={'ssh-rsa': 2048})
+
+
+def parse_key(key: str) -> ParsedKey:
+    """
+    Parses an `authorized_keys` style public key (`<type> <base64 blob> [comment]`).
+    :param key: The public key
+    :return: The ParsedKey, with the blob still base64 encoded and a `SHA256:` fingerprint like `ssh-keygen -l`
+    :raises SKPInvalidKeyError: If the key is malformed, or its blob does not match its type
+    """
+    fields = key.strip().split(None, 2)
+    if len(fields) < 2:
+        raise SKPInvalidKeyError('Not an SSH public key.')
+    key_type, blob = fields[0], fields[1]
+    comment = fields[2] if len(fields) > 2 else ''
+    try:
+        data = base64.b64decode(blob, validate=True)
+    except (binascii.Error, ValueError):
+        raise SKPInvalidKeyError('The key data is not valid base64.')
+
+    reader = KeyBlobReader(data)
+    if reader.string() != key_type.encode('ascii', 'replace'):
+        raise SKPInvalidKeyError("The key data does not match the '{}' key type.".format(key_type))
+    base_type = get_base_key_type(key_type)
+    if base_type != key_type:
+        reader.string()  # The certificate nonce comes before the public key.
+    if base_type == 'ssh-rsa':
+        reader.string()  # The public exponent.
+        bits = reader.integer().bit_length()
+    elif base_type == 'ssh-dss':
+        bits = reader.integer().bit_length()
+    elif base_type in fixed_key_bits:
+        if base_type.startswith(('ecdsa-', 'sk-ecdsa-')):
+            reader.string()  # The curve name comes before the public point.
+        reader.string()  # The public key itself, so truncated keys are rejected.
+        bits = fixed_key_bits[base_type]
+    else:
+        raise SKPInvalidKeyError("Unknown key type '{}'.".format(key_type))
+
+    digest = base64.b64encode(hashlib.sha256(data).digest()).decode('ascii').rstrip('=')
+    return ParsedKey(type=key_type, blob=blob, comment=comment, fingerprint='SHA256:{}'.format(digest), bits=bits)
+
+
+def get_base_key_type(key_type: str) -> str:
+    """
+    Returns the type of the public key inside a certificate (e.g. `ssh-ed25519` for `ssh-ed25519-cert-v01@openssh.com`).
+    :param key_type: The key type
+    :return: The key type without the certificate suffix
+    """
+    if key_type.endswith(certificate_suffix):
+        return key_type[:-len(certificate_suffix)]
+    return key_type
+
+
+class KeyBlobReader:
+    """
+    Reads the length-prefixed fields of an SSH public key blob.
+    """
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        self.offset = 0
+
+    def string(self) -> bytes:
+        if self.offset + 4 > len(self.data):
+            raise SKPInvalidKeyError('The key data is truncated.')
+        length, = struct.unpack('>I', self.data[self.offset:self.offset + 4])
+        if self.offset + 4 + length > len(self.data):
+            raise SKPInvalidKeyError('The key data is truncated.')
+        value = self.data[self.offset + 4:self.offset + 4 + length]
+        self.offset += 4 + length
+        return value
+
+    def integer(self) -> int:
+        return int.from_bytes(self.string(), 'big')
+
+
+class KeyParser:
+    """
+    Parses, validates and deduplicates the keys of every user.  Parse results are memoized by the SHA-256 of the key in
+    a persistent cache, so unchanged keys are not decoded again on the next run.
+    """
+
+    cache: Dict[str, list]
+    cache_file: str
+    counts: Dict[str, int]
+    policy: KeyPolicy
+
+    def __init__(self, policy: KeyPolicy = None, cache_file: str = None) -> None:
+        """
+        :param policy: The key types and minimum sizes to accept (`default_key_policy` if `None`)
+        :param cache_file: Where parse results are kept between runs (not kept if `None`)
+        """
+        self.policy = policy or default_key_policy
+        self.cache_file = cache_file
+        self.cache = dict()
+        self.counts = dict.fromkeys(['keys_parsed', 'keys_cached', 'keys_rejected', 'keys_duplicate'], 0)
+        self.__parsed = dict()
+        self.__used = set()
+        if self.cache_file:
+            try:
+                with open(self.cache_file, 'r') as f:
+                    self.cache = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError):
+                logging.warning("Cannot read the key cache '{}', every key will be parsed.".format(cache_file))
+
+    def parse(self, key: str) -> ParsedKey:
+        """
+        Parses a key, using the memoized result if the key has been seen before.
+        :param key: The public key
+        :return: The ParsedKey
+        :raises SKPInvalidKeyError: If the key is malformed
+        """
+        # Keys seen earlier in this process are a single dictionary lookup away.
+        memo = self.__parsed.get(key)
+        if memo is None:
+            digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+            memo = self.__parsed[key] = (digest, self.__parse(key, digest))
+        else:
+            self.counts['keys_cached'] += 1
+        self.__used.add(memo[0])
+        parsed = memo[1]
+        if isinstance(parsed, str):
+            raise SKPInvalidKeyError(parsed)
+        return parsed
+
+    def __parse(self, key: str, digest: str):
+        """
+        Parses a key through the persistent cache.
+        :param key: The public key
+        :param digest: The SHA-256 of the key
+        :return: The ParsedKey, or the error message if the key is invalid
+        """
+        entry = self.cache.get(digest)
+        if entry is None:
+            self.counts['keys_parsed'] += 1
+            try:
+                parsed = parse_key(key)
+                entry = [parsed.type, parsed.fingerprint, parsed.bits, '']
+            except SKPInvalidKeyError as e:
+                entry = ['', '', 0, e.message]
+            self.cache[digest] = entry
+        else:
+            self.counts['keys_cached'] += 1
+        key_type, fingerprint, bits, error = entry
+        if error:
+            return error
+        fields = key.strip().split(None, 2)
+        return ParsedKey(
+            type=key_type,
+            blob=fields[1],
+            comment=fields[2] if len(fields) > 2 else '',
+            fingerprint=fingerprint,
+            bits=bits,
+        )
+
+    def filter_keys(self, username: str, keys: List[str]) -> List[ParsedKey]:
+        """
+        Parses the keys of a user, dropping malformed keys, keys the policy does not allow and duplicates of a key that
+        was already listed (by fingerprint, so keys that only differ in their comment are duplicates too).
+        :param username: The user the keys belong to (for logging)
+        :param keys: The public keys from the provider
+        :return: The accepted keys, in their original order
+        """
+        accepted, fingerprints = list(), set()
+        for key in keys:
+            try:
+                parsed = self.parse(key)
+            except SKPInvalidKeyError as e:
+                logging.warning("Ignoring an invalid SSH key of user '{}': {}".format(username, e.message))
+                self.counts['keys_rejected'] += 1
+                continue
+            if parsed.fingerprint in fingerprints:
+                self.counts['keys_duplicate'] += 1
+                continue
+            fingerprints.add(parsed.fingerprint)
+            base_type = get_base_key_type(parsed.type)
+            if base_type not in self.policy.allowed_types:
+                logging.warning("Ignoring the {} key {} of user '{}', the key type is not allowed.".format(
+                    parsed.type, parsed.fingerprint, username,
+                ))
+                self.counts['keys_rejected'] += 1
+                continue
+            if parsed.bits < self.policy.min_bits.get(base_type, 0):
+                logging.warning("Ignoring the {}-bit {} key {} of user '{}', the key is too short.".format(
+                    parsed.bits, parsed.type, parsed.fingerprint, username,
+                ))
+                self.counts['keys_rejected'] += 1
+                continue
+            accepted.append(parsed)
+        return accepted
+
+    def save(self) -> None:
+        """
+        Atomically persists the parse results of the keys seen during this run, forgetting keys that are gone, and adds
+        the key counts of the run to the run metrics.
+        """
+        for name, count in self.counts.items():
+            metrics.increment(name, count)
+            self.counts[name] = 0
+        self.cache = {k: v for k, v in self.cache.items() if k in self.__used}
+        self.__parsed = {k: v for k, v in self.__parsed.items() if v[0] in self.__used}
+        self.__used = set()
+        if not self.cache_file:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), mode=0o700, exist_ok=True)
+        write_atomically(self.cache_file, json.dumps(self.cache), mode=0o600)
+
+
+class SKPError(Exception):
+
+    def __init__(self, message):
+        self.message = message
+
+
+class SKPInvalidKeyError(SKPError):
+    pass
@@ -0,0 +1,508 @@
+from typing import TYPE_CHECKING, Dict, List
+import logging
+import sys
+import threading
+import time
+
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.key_index import build_key_index
+from automatagl.helpers.pipeline import GroupPipeline
+from automatagl.helpers.planner import DesiredState, DesiredStateBuilder, Plan, Planner, build_desired_state
+from automatagl.helpers.provider_operations import AutomataConfig, MetricsConfig, ProviderUser
+from automatagl.helpers.snapshot_store import Snapshot, SnapshotStore
+from automatagl.helpers.ssh_key_parser import KeyParser
+from automatagl.helpers.tracing import tracer
+from automatagl.helpers.user_operations import UserOps, UOProtectedUserError
+
+# The provider (and asyncio with it) is only imported once one is configured.
+if TYPE_CHECKING:
+    from automatagl.helpers.providers.base_provider import BaseProvider
+
+__all__ = [
+    'Synchronizer',
+    'SYError',
+    'SYStaleSnapshotError',
+]
+
+
+class Synchronizer:
+    """
+    Fetches the configured groups from the provider and reconciles the local users, keys and sudoers file with them.
+    The last membership fetched for each group is kept, so a long-running process can refresh only some groups.  With
+    a snapshot store, runs go ahead with the last known-good membership of every group while the provider is queried
+    in the background.
+    """
+
+    automata_config: AutomataConfig
+    desired: DesiredState
+    group_members: Dict[str, List[ProviderUser]]
+    key_parser: KeyParser
+    metrics_config: MetricsConfig
+    provider_ops: 'BaseProvider'
+    refused: List[str]
+    snapshots: SnapshotStore
+    user_ops: UserOps
+
+    def __init__(self, provider_ops: 'BaseProvider', user_ops: UserOps, automata_config: AutomataConfig,
+                 metrics_config: MetricsConfig = None, key_parser: KeyParser = None,
+                 snapshots: SnapshotStore = None) -> None:
+        """
+        :param provider_ops: The provider to fetch group members from
+        :param user_ops: The user operations object for the local system
+        :param automata_config: The Automata server configuration
+        :param metrics_config: Where to write the metrics of each run (not written if `None`)
+        :param key_parser: Validates and deduplicates every user's keys (they are used verbatim if `None`)
+        :param snapshots: Where to keep the last members fetched for every group (groups are always fetched before
+        applying if `None`)
+        """
+        self.provider_ops = provider_ops
+        self.user_ops = user_ops
+        self.automata_config = automata_config
+        self.metrics_config = metrics_config
+        self.key_parser = key_parser
+        self.snapshots = snapshots
+        self.group_members = dict()
+        self.desired = None
+        self.refused = list()
+        self.__key_files = dict()
+        self.__handled_files = set()
+        self.__unchanged_reported = 0
+        self.__revalidation = None
+        self.__revalidation_deadline = 0.0
+
+    def run(self, provider_groups: List[str] = None) -> None:
+        """
+        Fetches groups from the provider and reconciles the local system with every configured group.
+        :param provider_groups: The provider groups to fetch (all configured groups if `None`), the other groups are
+        reconciled from their last fetched membership
+        """
+        metrics.reset()
+        success = False
+        try:
+            self.fetch(provider_groups, apply_early=True)
+            self.apply()
+            if self.revalidate():
+                self.apply()
+            self.check_refused()
+            success = True
+        finally:
+            self.write_metrics(success)
+
+    def write_metrics(self, success: bool = True) -> None:
+        """
+        Writes the metrics of the current run to the configured Prometheus textfile and JSON summary.
+        :param success: Whether the run completed
+        """
+        if not self.metrics_config:
+            return
+        try:
+            if self.metrics_config.textfile:
+                metrics.write_textfile(self.metrics_config.textfile, success)
+            if self.metrics_config.summary_file:
+                metrics.write_summary(self.metrics_config.summary_file, success)
+        except OSError as e:
+            logging.warning("Could not write the run metrics: {}".format(e))
+
+    def fetch(self, provider_groups: List[str] = None, serve_stale: bool = True, apply_early: bool = False) -> None:
+        """
+        Queries groups from the provider concurrently.  With a snapshot store, the provider is queried in the background
+        and, if every group has a snapshot no older than `max_staleness`, the snapshots are used right away; call
+        `revalidate` afterwards to pick up the fresh members.  If some group has no usable snapshot, the provider is
+        waited for however long it takes; with `serve_stale` off, it is waited for up to `revalidate_timeout` and
+        groups it did not return in time fall back to their snapshot.
+        :param provider_groups: The provider groups to fetch (all configured groups if `None`)
+        :param serve_stale: Whether to use the snapshots without waiting for the provider first
+        :param apply_early: While waiting for the provider, create the groups, users and key files of every group as
+        soon as it and the groups before it have been fetched (if `pipeline_depth` is set).  `apply` must be called
+        afterwards to finish the job.
+        :raises SYStaleSnapshotError: If the provider failed and no group has a recent enough snapshot
+        """
+        if provider_groups is None:
+            provider_groups = [group.provider_group for group in self.automata_config.groups]
+        # The managed files are counted over every plan applied during the run, partial or not.
+        self.user_ops.manifest.rewritten = 0
+        self.user_ops.manifest.skipped = 0
+        self.__handled_files = set()
+        self.__unchanged_reported = 0
+        logging.debug("Querying users in groups: {}".format(', '.join(provider_groups)))
+        with metrics.phase('fetch'), tracer.span('fetch', groups=', '.join(provider_groups)):
+            pipeline = None
+            if apply_early and self.automata_config.pipeline_depth:
+                configured = [group.provider_group for group in self.automata_config.groups]
+                pipeline = GroupPipeline(
+                    [i for i in configured if i in provider_groups], self.automata_config.pipeline_depth
+                )
+            try:
+                if self.snapshots is None and pipeline:
+                    self.group_members.update(self.__fetch_pipelined(provider_groups, pipeline))
+                elif self.snapshots is None:
+                    self.group_members.update(self.provider_ops.fetch_groups(provider_groups))
+                else:
+                    self.__fetch_with_snapshots(provider_groups, serve_stale, pipeline)
+            except BaseException:
+                # `apply` will not be called, write out the accounts already created and release the account lock.
+                if pipeline:
+                    self.user_ops.commit()
+                raise
+        logging.debug("Provider response cache: {} hits, {} misses.".format(
+            self.provider_ops.http_cache.hits,
+            self.provider_ops.http_cache.misses,
+        ))
+
+    def revalidate(self) -> bool:
+        """
+        Waits for the background fetch started by `fetch` (up to `revalidate_timeout` after it started) and replaces
+        the snapshots in use with the fresh members.
+        :return: Whether any group changed, i.e. whether the local system has to be reconciled again
+        """
+        if self.__revalidation is None:
+            return False
+        fetched = self.__finish_revalidation()
+        if fetched is None:
+            return False
+        changed = [group for group, users in fetched.items() if self.group_members.get(group) != users]
+        self.group_members.update(fetched)
+        self.refused = [group for group in self.refused if group not in fetched]
+        if changed:
+            logging.info("Groups changed since their snapshot: {}".format(', '.join(changed)))
+        return bool(changed)
+
+    def check_refused(self) -> None:
+        """
+        :raises SYStaleSnapshotError: If any group was left alone because its snapshot was too old
+        """
+        if self.refused:
+            raise SYStaleSnapshotError(
+                "The provider is unavailable and these groups have no snapshot newer than {} seconds, they were left "
+                "alone: {}".format(self.snapshots.max_staleness, ', '.join(self.refused))
+            )
+
+    def __fetch_pipelined(self, provider_groups: List[str],
+                          pipeline: GroupPipeline) -> Dict[str, List[ProviderUser]]:
+        """
+        Fetches the groups in a producer thread while applying them as they arrive.
+        :param provider_groups: The provider groups to fetch
+        :param pipeline: Hands the fetched groups over in order of precedence
+        :return: The fetched groups
+        """
+        result = dict()
+
+        def fetch_groups():
+            try:
+                result['members'] = self.provider_ops.fetch_groups(provider_groups)
+            except Exception as e:  # pylint: disable=broad-except
+                result['error'] = e
+            finally:
+                pipeline.finish()
+
+        self.provider_ops.pipeline = pipeline
+        thread = threading.Thread(target=fetch_groups, name='automata-fetch')
+        thread.start()
+        try:
+            self.__apply_as_fetched(pipeline)
+        finally:
+            pipeline.close()
+            thread.join()
+            self.provider_ops.pipeline = None
+        if 'error' in result:
+            raise result['error']
+        return result['members']
+
+    def __apply_as_fetched(self, pipeline: GroupPipeline, deadline: float = None) -> None:
+        """
+        The apply stage: creates the groups, users and key files of every group in order of precedence as soon as it
+        has been fetched, so the first group a user is a member of still wins.  Deleting users, moving users between
+        groups, the key index and the sudoers file are left to the `apply` of the complete desired state.
+        :param pipeline: Hands the fetched groups over in order of precedence
+        :param deadline: The `time.monotonic()` to stop waiting for the provider at (no limit if `None`)
+        """
+        builder = DesiredStateBuilder(self.key_parser)
+        planner = Planner(self.user_ops, self.automata_config)
+        fetching = set(pipeline.groups)
+        for group in self.automata_config.groups:
+            if group.provider_group not in fetching:
+                # Groups fetched by an earlier run still take precedence over the groups after them.
+                if group.provider_group in self.group_members:
+                    builder.add_group(group, self.group_members[group.provider_group])
+                continue
+            if not pipeline.ready():
+                # Write out what was applied so far before waiting for the provider, so the password file lock is not
+                # held (locking out `passwd`, `useradd` and the like) while the network is slow.
+                with metrics.phase('commit'), tracer.span('commit'):
+                    self.user_ops.commit()
+            fetched = pipeline.get(deadline)
+            if fetched is None:
+                return
+            owned = builder.add_group(group, fetched[1])
+            with tracer.span('apply_group', group=group.provider_group):
+                plan = planner.plan(DesiredState(users={i.username: i for i in owned}, groups=[group]), partial=True)
+                self.apply(plan, final=False)
+            logging.debug("Applied group '{}' while fetching: {} users created, {} key files written.".format(
+                group.provider_group, len(plan.user_adds), len(plan.key_changes)
+            ))
+            pipeline.done(group.provider_group)
+
+    def __fetch_with_snapshots(self, provider_groups: List[str], serve_stale: bool, pipeline: GroupPipeline) -> None:
+        snapshots = {group: self.snapshots.load(group) for group in provider_groups}
+        usable = {group: i for group, i in snapshots.items() if i is not None and self.snapshots.is_fresh(i)}
+        # Groups without a usable snapshot have nothing to fall back on, so the provider is waited for however long
+        # it takes.
+        missing = len(usable) < len(provider_groups)
+        wait = missing or not serve_stale
+        pipeline = pipeline if wait else None
+        self.__start_revalidation(snapshots, pipeline, None if missing else self.snapshots.revalidate_timeout)
+
+        if wait:
+            fetched = self.__finish_revalidation(pipeline)
+            if fetched is not None:
+                self.group_members.update(fetched)
+                self.refused = list()
+                return
+        else:
+            logging.info("Using the provider snapshots while the provider is queried in the background.")
+
+        # Groups that were fetched and already applied before the provider failed are used as they are.
+        fresh = pipeline.results if pipeline else dict()
+        self.refused = [group for group in provider_groups if group not in usable and group not in fresh]
+        if not usable and not fresh:
+            raise SYStaleSnapshotError(
+                "The provider is unavailable and no group has a snapshot newer than {} seconds.".format(
+                    self.snapshots.max_staleness
+                )
+            )
+        for group, snapshot in usable.items():
+            self.group_members[group] = snapshot.users
+            metrics.set_gauge('snapshot_age_seconds', self.snapshots.age(snapshot), group=group)
+        for group, users in fresh.items():
+            self.group_members[group] = users
+            metrics.set_gauge('snapshot_age_seconds', 0, group=group)
+        for group in self.refused:
+            logging.error("Refusing to apply group '{}', its snapshot is too old or missing.".format(group))
+            self.group_members.pop(group, None)
+        metrics.increment('groups_refused', len(self.refused))
+
+    def __start_revalidation(self, snapshots: Dict[str, Snapshot], pipeline: GroupPipeline = None,
+                             timeout: float = None) -> None:
+        """
+        Fetches the groups from the provider in a background thread, only fetching what changed since their snapshots
+        if the provider can.  The snapshots are saved as soon as the fetch completes, even if nobody waits for it any
+        more.  A fetch that is still running from an earlier run is waited for instead of piling up another one behind
+        an unresponsive provider.
+        :param snapshots: The provider groups to fetch, with their last snapshot (or `None`)
+        :param pipeline: Hands the groups over as they are fetched (if set)
+        :param timeout: How long to wait for the fetch, in seconds (no limit if `None`)
+        """
+        self.__revalidation_deadline = None if timeout is None else time.monotonic() + timeout
+        if self.__revalidation is not None:
+            thread, groups, _ = self.__revalidation
+            if thread.is_alive() and set(snapshots) <= set(groups):
+                if pipeline:
+                    pipeline.finish()
+                return
+        result = dict()
+
+        def fetch_groups():
+            try:
+                fetched = self.provider_ops.fetch_groups_since(snapshots)
+                for snapshot in fetched.values():
+                    self.snapshots.save(snapshot)
+                result['snapshots'] = fetched
+            except Exception as e:  # pylint: disable=broad-except
+                result['error'] = e
+            finally:
+                if pipeline:
+                    pipeline.finish()
+
+        self.provider_ops.pipeline = pipeline
+        # A daemon thread, so an unresponsive provider cannot keep the process from exiting.
+        thread = threading.Thread(target=fetch_groups, name='automata-revalidate', daemon=True)
+        thread.start()
+        self.__revalidation = (thread, list(snapshots), result)
+
+    def __finish_revalidation(self, pipeline: GroupPipeline = None) -> Dict[str, List[ProviderUser]]:
+        """
+        Waits for the background fetch until the revalidation deadline (if any).
+        :param pipeline: Applies the groups as they are fetched while waiting (if set)
+        :return: The fetched groups, or `None` if the provider failed or did not answer in time
+        """
+        thread, groups, result = self.__revalidation
+        with metrics.phase('revalidate'), tracer.span('revalidate', groups=', '.join(groups)):
+            if pipeline:
+                try:
+                    self.__apply_as_fetched(pipeline, self.__revalidation_deadline)
+                finally:
+                    pipeline.close()
+                    self.provider_ops.pipeline = None
+            deadline = self.__revalidation_deadline
+            thread.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        if thread.is_alive():
+            logging.warning("The provider did not answer within {} seconds.".format(self.snapshots.revalidate_timeout))
+            return None
+        self.__revalidation = None
+        if 'error' in result:
+            logging.warning("Could not fetch the groups from the provider: {!r}".format(result['error']))
+            return None
+        fetched = dict()
+        for group, snapshot in result['snapshots'].items():
+            metrics.set_gauge('snapshot_age_seconds', self.snapshots.age(snapshot), group=group)
+            fetched[group] = snapshot.users
+        return fetched
+
+    def plan(self) -> Plan:
+        """
+        Works out what needs to change on the local system to match the fetched groups.
+        :return: The Plan
+        """
+        missing = [i.provider_group for i in self.automata_config.groups if i.provider_group not in self.group_members]
+        if missing:
+            logging.warning("Groups not fetched yet, leaving them alone: {}".format(', '.join(missing)))
+        with metrics.phase('plan'), tracer.span('plan'):
+            self.desired = build_desired_state(self.automata_config.groups, self.group_members, self.key_parser)
+            self.__key_files = dict()
+            return Planner(self.user_ops, self.automata_config).plan(self.desired)
+
+    def repair(self, paths: List[str]) -> List[str]:
+        """
+        Rewrites managed files that were changed outside of Automata from the last planned desired state, without
+        asking the provider.  Files that still match the file manifest are left alone.
+        :param paths: The managed files that may have drifted
+        :return: The files that were rewritten
+        """
+        if self.desired is None:
+            return list()
+        if not self.__key_files and self.automata_config.authorized_keys_files:
+            self.__key_files = {self.user_ops.get_authorized_keys_path(i): i for i in self.desired.users}
+        groups = self.automata_config.groups
+        repaired = list()
+        for path in sorted(set(paths)):
+            if path == self.automata_config.sudoers_file:
+                if self.user_ops.sudoers_file_is_current(path, groups):
+                    continue
+                self.user_ops.generate_sudoers_file(path, groups)
+            elif path == self.automata_config.key_index:
+                contents = build_key_index({i.username: i.ssh_keys.ssh_keys for i in self.desired.users.values()})
+                if self.user_ops.key_index_is_current(path, contents):
+                    continue
+                self.user_ops.write_key_index(path, contents)
+            elif path in self.__key_files:
+                user = self.desired.users[self.__key_files[path]]
+                gid = self.user_ops.get_group_gid(user.linux_group)
+                if self.user_ops.ssh_file_is_current(user.ssh_keys, gid):
+                    continue
+                self.user_ops.populate_ssh_file(ssh_keys=user.ssh_keys, gid=gid)
+            else:
+                continue
+            logging.warning("Repaired '{}', it was changed outside of Automata.".format(path))
+            metrics.increment('files_repaired')
+            repaired.append(path)
+        if repaired:
+            self.user_ops.manifest.save()
+        return repaired
+
+    def apply(self, plan: Plan = None, final: bool = True) -> None:
+        """
+        Reconciles the local users, SSH keys and sudoers file with the fetched groups.
+        :param plan: The Plan to execute (planned from the fetched groups if `None`)
+        :param final: Whether this is the last plan of the run, only then the pending account changes are written out
+        and the file manifest and key cache are saved
+        """
+        if plan is None:
+            plan = self.plan()
+        self.__handled_files.update(('authorized_keys', i.user) for i in plan.key_changes)
+        if plan.key_index is not None:
+            self.__handled_files.add(('key_index', None))
+        if plan.sudoers:
+            self.__handled_files.add(('sudoers', None))
+
+        try:
+            for group_add in plan.group_adds:
+                logging.info("Group not found, creating the '{}' group.".format(group_add.group))
+                with metrics.phase('group_create'), tracer.span('group_create', group=group_add.group):
+                    self.user_ops.create_group(group_add.group)
+                metrics.increment('groups_created')
+
+            # Start removing users with extreme prejudice that are no longer in any provider group.
+            for user_delete in plan.user_deletes:
+                logging.info("Deleting user {}.".format(user_delete.user))
+                with metrics.phase('user_delete'), tracer.span('user_delete', user=user_delete.user):
+                    self.__delete_user(user_delete.user)
+                metrics.increment('users_deleted')
+
+            for user_add in plan.user_adds:
+                if user_add.recreate:
+                    logging.info("User '{}' already exists, deleting user.".format(user_add.user))
+                    with metrics.phase('user_delete'), tracer.span('user_delete', user=user_add.user):
+                        self.__delete_user(user_add.user)
+                    metrics.increment('users_deleted')
+                logging.info("Creating user {}.".format(user_add.user))
+                with metrics.phase('user_create'), tracer.span('user_create', user=user_add.user, group=user_add.group):
+                    self.user_ops.create_user(user=user_add.user, group=user_add.group, groups=user_add.groups)
+                metrics.increment('users_created')
+
+            for group_change in plan.group_changes:
+                logging.info("Moving user {} to group {}.".format(group_change.user, group_change.group))
+                with metrics.phase('user_modify'), \
+                        tracer.span('user_modify', user=group_change.user, group=group_change.group):
+                    self.user_ops.modify_user(group_change.user, group_change.group, group_change.groups)
+                metrics.increment('users_modified')
+        finally:
+            # Write out any account changes batched by the user backend.  The partial plans applied while fetching
+            # are written out whenever the apply stage waits for the provider, and the rest with the final plan.
+            if final:
+                with metrics.phase('commit'), tracer.span('commit'):
+                    self.user_ops.commit()
+
+        # Create the SSH authorized_keys file so the user can actually log in.
+        with metrics.phase('key_files'), tracer.span('key_files'):
+            for key_change in plan.key_changes:
+                with tracer.span('authorized_keys', user=key_change.user, group=key_change.group):
+                    self.user_ops.populate_ssh_file(
+                        ssh_keys=key_change.keys,
+                        gid=self.user_ops.get_group_gid(key_change.group),
+                    )
+
+        # Rebuild the key index read by `automata-keys`.
+        if plan.key_index is not None:
+            logging.info("Regenerating the '{}' key index.".format(self.automata_config.key_index))
+            with metrics.phase('key_index'), tracer.span('key_index'):
+                self.user_ops.write_key_index(self.automata_config.key_index, plan.key_index)
+
+        # Create the sudoers.d file.
+        if plan.sudoers:
+            logging.info("Regenerating the '{}' file.".format(self.automata_config.sudoers_file))
+            with metrics.phase('sudoers'), tracer.span('sudoers'):
+                self.user_ops.generate_sudoers_file(self.automata_config.sudoers_file, self.automata_config.groups)
+
+        if not final:
+            return
+
+        # Remember what was written for the next run.
+        self.user_ops.manifest.save()
+        if self.key_parser:
+            self.key_parser.save()
+        # Files written by an earlier plan of this run are unchanged as far as this plan is concerned.
+        managed = plan.unchanged_files + len(plan.key_changes) + (plan.key_index is not None) + plan.sudoers
+        unchanged = max(managed - len(self.__handled_files), 0)
+        metrics.increment('files_skipped', max(unchanged - self.__unchanged_reported, 0))
+        self.__unchanged_reported = max(unchanged, self.__unchanged_reported)
+        logging.info("Managed files: {} rewritten, {} unchanged and skipped.".format(
+            self.user_ops.manifest.rewritten,
+            unchanged + self.user_ops.manifest.skipped,
+        ))
+
+    def __delete_user(self, user: str) -> None:
+        try:
+            self.user_ops.delete_user(user)
+        except UOProtectedUserError:
+            logging.info("Cannot delete user '{}' as it is a protected system user.".format(user))
+            sys.exit(101)
+
+
+class SYError(Exception):
+    pass
+
+
+class SYStaleSnapshotError(SYError):
+
+    def __init__(self, message):
+        self.message = message
@@ -0,0 +1,121 @@
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+import time
+
+__all__ = [
+    'Tracer',
+    'tracer',
+]
+
+
+@contextmanager
+def disabled_span():
+    """
+    Returned by every span while tracing is disabled, so instrumented code costs next to nothing.  (A stand-in for
+    `contextlib.nullcontext`, which needs Python 3.7.)
+    """
+    yield
+
+
+class Tracer:
+    """
+    Records spans in the Chrome trace-event format, which can be opened in Perfetto or `chrome://tracing`.  Spans are
+    only recorded while the tracer is enabled.
+    """
+
+    enabled: bool
+    events: list
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events = list()
+        self.__ids = itertools.count(1)
+        self.__started = time.perf_counter()
+        self.__threads = dict()
+
+    def start(self) -> None:
+        """
+        Starts recording spans.
+        """
+        self.events = list()
+        self.__started = time.perf_counter()
+        self.__threads = dict()
+        self.enabled = True
+
+    def span(self, name: str, **attributes):
+        """
+        Records a block of code as a span on the current thread.
+        :param name: The name of the span
+        :param attributes: Attributes shown with the span (e.g. the user or group it works on)
+        :return: A context manager
+        """
+        if not self.enabled:
+            return disabled_span()
+        return self.__span(name, attributes)
+
+    def async_span(self, name: str, **attributes):
+        """
+        Records a block of code as an async span, for work that overlaps with other work on the same thread (e.g.
+        coroutines running in the same event loop).
+        :param name: The name of the span
+        :param attributes: Attributes shown with the span
+        :return: A context manager
+        """
+        if not self.enabled:
+            return disabled_span()
+        return self.__async_span(name, attributes)
+
+    @contextmanager
+    def __span(self, name: str, attributes: dict):
+        started = self.__now()
+        try:
+            yield
+        finally:
+            self.events.append({
+                'name': name,
+                'cat': 'automata',
+                'ph': 'X',
+                'ts': started,
+                'dur': self.__now() - started,
+                'pid': os.getpid(),
+                'tid': self.__thread_id(),
+                'args': attributes,
+            })
+
+    @contextmanager
+    def __async_span(self, name: str, attributes: dict):
+        span_id = next(self.__ids)
+        event = {'name': name, 'cat': 'automata', 'id': span_id, 'pid': os.getpid(), 'tid': self.__thread_id()}
+        self.events.append(dict(event, ph='b', ts=self.__now(), args=attributes))
+        try:
+            yield
+        finally:
+            self.events.append(dict(event, ph='e', ts=self.__now()))
+
+    def write(self, path: str) -> None:
+        """
+        Writes the recorded spans as a Chrome trace-event JSON file.
+        :param path: The file to write
+        """
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}}
+            for tid, thread_name in self.__threads.items()
+        ]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def __now(self) -> float:
+        return (time.perf_counter() - self.__started) * 1000000
+
+    def __thread_id(self) -> int:
+        ident = threading.get_ident()
+        if ident not in self.__threads:
+            self.__threads[ident] = threading.current_thread().name
+        return ident
+
+
+# The tracer of the current process, shared by every part of Automata.
+tracer = Tracer()
@@ -6,8 +6,16 @@ import subprocess
 import sys
 from typing import Set, List
 
+from automatagl.helpers.file_manifest import FileManifest
+from automatagl.helpers.local_state import LocalStateIndex
+from automatagl.helpers.metrics import metrics
+from automatagl.helpers.tracing import tracer
+from automatagl.helpers.native_accounts import (
+    NativeAccountBackend, NABGroupExistsError, NABGroupNotFoundError, NABUserExistsError
+)
 from automatagl.helpers.ssh_key_object import SSHKeyObject
 from automatagl.helpers.provider_operations import AutomataGroupConfig
+from automatagl.helpers.purge_queue import PurgeQueue
 from automatagl.helpers.config_parser import sanitize_sudoers_line, sanitize_username
 
 __all__ = [
@@ -26,13 +34,18 @@ class UserOps:
     This handles user and file creation on the local system.
     """
 
+    backend: str
     base_dir: str
     default_shell: str
     delete_system_groups: bool
     delete_system_users: bool
     host_env: dict
+    local_state: LocalStateIndex
+    manifest: FileManifest
+    native_backend: NativeAccountBackend
     protected_uid_start: int
     protected_gid_start: int
+    purge_queue: PurgeQueue
 
     def __init__(self,
                  host_env: dict = None,
@@ -41,11 +54,20 @@ class UserOps:
                  delete_system_groups: bool = False,
                  delete_system_users: bool = False,
                  protected_uid_start: int = 1000,
-                 protected_gid_start: int = 1000,) -> None:
+                 protected_gid_start: int = 1000,
+                 manifest: FileManifest = None,
+                 local_state: LocalStateIndex = None,
+                 backend: str = 'useradd',
+                 purge_queue: PurgeQueue = None,) -> None:
         """
         Used to manipulate users and groups on a Linux/Unix system
         :param host_env: The environment of the host (defaults to os.environ.copy)
         :param default_shell: The default shell used to create users
+        :param manifest: The manifest of managed files used to skip unchanged writes (not persisted by default)
+        :param local_state: The index of local users and groups (enumerated from the system by default)
+        :param backend: `useradd` to run the shadow utilities for every change, or `native` to batch every change
+        into a single locked rewrite of the account databases (see `commit`)
+        :param purge_queue: If set, the homes of deleted users are handed to this queue instead of being removed inline
         """
         self.default_shell = default_shell
         if host_env:
@@ -57,6 +79,11 @@ class UserOps:
         self.delete_system_users = delete_system_users
         self.protected_gid_start = protected_gid_start
         self.protected_uid_start = protected_uid_start
+        self.manifest = manifest if manifest else FileManifest()
+        self.local_state = local_state if local_state else LocalStateIndex.from_system()
+        self.backend = backend
+        self.native_backend = NativeAccountBackend() if backend == 'native' else None
+        self.purge_queue = purge_queue
 
     def create_user(self,
                     user: str,
@@ -74,6 +101,8 @@ class UserOps:
         """
         if not shell:
             shell = self.default_shell
+        if self.native_backend:
+            return self.__create_user_native(user, group, groups or list(), shell)
         if groups:
             command = "useradd -b {base_dir} -s {shell} -m -g {group} -G {groups} {user}".format(
                 base_dir=self.base_dir,
@@ -90,13 +119,20 @@ class UserOps:
                 shell=shell,
             )
         try:
-            subprocess.check_call(shlex.split(command), env=self.host_env)
+            self.__run(shlex.split(command), user=user, group=group)
         except subprocess.CalledProcessError as e:
             if e.returncode == 9:
                 raise UOUserAlreadyExistsError
             else:
                 sys.exit(10)
-        return self.get_user_uid(user)
+        user_info = pwd.getpwnam(user)
+        self.local_state.add_user(
+            user,
+            user_info.pw_uid,
+            user_info.pw_gid,
+            [self.local_state.gid_by_name[i] for i in groups or list() if i in self.local_state.gid_by_name],
+        )
+        return user_info.pw_uid
 
     def create_group(self, group: str) -> int:
         """
@@ -105,13 +141,22 @@ class UserOps:
         :return: The GID of the group created
         :raises UOGroupAlreadyExistsError: If the group being created already exists
         """
+        if self.native_backend:
+            try:
+                gid = self.native_backend.add_group(group)
+            except NABGroupExistsError:
+                raise UOGroupAlreadyExistsError
+            self.local_state.add_group(group, gid)
+            return gid
         command = "groupadd {group}".format(group=group)
         try:
-            subprocess.check_call(shlex.split(command), env=self.host_env)
+            self.__run(shlex.split(command), group=group)
         except subprocess.CalledProcessError as e:
             if e.returncode == 9:
                 raise UOGroupAlreadyExistsError
-        return self.get_group_gid(group)
+        group_info = grp.getgrnam(group)
+        self.local_state.add_group(group, group_info.gr_gid, group_info.gr_mem)
+        return group_info.gr_gid
 
     def delete_user(self, user: str) -> None:
         """
@@ -121,8 +166,109 @@ class UserOps:
         """
         if self.get_user_uid(user) < self.protected_uid_start and not self.delete_system_users:
             raise UOProtectedUserError
-        command = "userdel -f --remove {user}".format(user=user)
-        subprocess.check_call(shlex.split(command), env=self.host_env)
+        home = self.__get_purgeable_home(user)
+        if self.native_backend:
+            self.native_backend.delete_user(user, remove_home=not home)
+        else:
+            command = "userdel -f {remove}{user}".format(remove='' if home else '--remove ', user=user)
+            self.__run(shlex.split(command), user=user)
+        if home:
+            self.purge_queue.enqueue(user, home)
+        self.local_state.remove_user(user)
+        self.manifest.forget(self.get_authorized_keys_path(user))
+
+    def __get_purgeable_home(self, user: str) -> str:
+        """
+        Finds the home directory of a user that is about to be deleted if it can be handed to the purge queue.  Only
+        homes inside `base_dir` are queued, since the tombstone directory lives there too.
+        :param user: The name of the user
+        :return: The home directory, or an empty string if it has to be removed inline
+        """
+        if not self.purge_queue:
+            return ''
+        if self.native_backend:
+            home = self.native_backend.get_home(user)
+        else:
+            try:
+                home = pwd.getpwnam(user).pw_dir
+            except KeyError:
+                home = ''
+        if not home:
+            return ''
+        home = os.path.realpath(home)
+        base_dir = os.path.realpath(self.base_dir)
+        if os.path.dirname(home) != base_dir or not os.path.isdir(home) or os.path.ismount(home):
+            return ''
+        return home
+
+    def modify_user(self, user: str, group: str, groups: list = None) -> None:
+        """
+        Changes the primary and supplementary groups of an existing user via the `usermod` command.
+        :param user: The username of the user to change
+        :param group: The main group of the user
+        :param groups: A complete list of supplementary groups to use
+        """
+        groups = groups or list()
+        if self.native_backend:
+            try:
+                self.native_backend.modify_user(user, group, groups)
+            except NABGroupNotFoundError:
+                sys.exit(10)
+        else:
+            command = ["usermod", "-g", group, "-G", ','.join(groups), user]
+            try:
+                self.__run(command, user=user, group=group)
+            except subprocess.CalledProcessError:
+                sys.exit(10)
+        uid = self.get_user_uid(user)
+        self.local_state.remove_user(user)
+        self.local_state.add_user(
+            user,
+            uid,
+            self.get_group_gid(group),
+            [self.local_state.gid_by_name[i] for i in groups if i in self.local_state.gid_by_name],
+        )
+
+    def __run(self, command: List[str], **attributes) -> None:
+        """
+        Runs an account management command, counting and tracing the fork.
+        :param command: The command and its arguments
+        :param attributes: The user and group the command works on, recorded with the trace span
+        :raises subprocess.CalledProcessError: If the command fails
+        """
+        metrics.increment('subprocess_forks')
+        with tracer.span(command[0], command=' '.join(command), **attributes):
+            subprocess.check_call(command, env=self.host_env)
+
+    def reload_local_state(self) -> None:
+        """
+        Enumerates the passwd and group databases again, picking up the users and groups changed outside of Automata
+        since the local state index was built.
+        """
+        self.local_state = LocalStateIndex.from_system()
+
+    def commit(self) -> None:
+        """
+        Writes out all of the account changes made so far.  This only does something for the `native` backend, the
+        `useradd` backend applies every change immediately.
+        """
+        if self.native_backend:
+            self.native_backend.commit()
+
+    def __create_user_native(self, user: str, group: str, groups: list, shell: str) -> int:
+        """
+        Creates a user through the native account backend.
+        :return: The UID of the user created
+        :raises UOUserAlreadyExistsError: If the user being created already exists
+        """
+        try:
+            uid, gid = self.native_backend.add_user(user, group, groups, os.path.join(self.base_dir, user), shell)
+        except NABUserExistsError:
+            raise UOUserAlreadyExistsError
+        except NABGroupNotFoundError:
+            sys.exit(10)
+        self.local_state.add_user(user, uid, gid, [self.local_state.gid_by_name[i] for i in groups])
+        return uid
 
     def populate_ssh_file(self, ssh_keys: SSHKeyObject, gid: int) -> None:
         """
@@ -134,23 +280,66 @@ class UserOps:
         """
         username = sanitize_username(ssh_keys.username)
         authorized_keys_contents = ssh_keys.get_authorized_keys()
-        authorized_keys_base_path = os.path.join(self.base_dir, username, '.ssh')
-        authorized_keys_path = os.path.join(authorized_keys_base_path, 'authorized_keys')
+        authorized_keys_path = self.get_authorized_keys_path(username)
+        authorized_keys_base_path = os.path.dirname(authorized_keys_path)
+        uid = self.get_user_uid(username)
+        if self.manifest.is_current(authorized_keys_path, authorized_keys_contents, uid, gid, 0o644):
+            self.manifest.skipped += 1
+            metrics.increment('files_skipped')
+            return
         try:
             os.makedirs(authorized_keys_base_path)
         except FileExistsError:
             pass
         except OSError:
             raise UOCannotCreateDirectory(message="Cannot create '{}' directory.".format(authorized_keys_base_path))
-        uid = self.get_user_uid(username)
         os.chown(authorized_keys_base_path, uid, gid)
-        with open(authorized_keys_path, 'w') as f:
-            f.write(authorized_keys_contents)
-        os.chown(authorized_keys_path, uid, gid)
-        os.chmod(authorized_keys_path, 0o644)
+        self.manifest.write_file(authorized_keys_path, authorized_keys_contents, uid, gid, 0o644)
 
-    @staticmethod
-    def generate_sudoers_file(sudoers_file: str,
+    def ssh_file_is_current(self, ssh_keys: SSHKeyObject, gid: int) -> bool:
+        """
+        Checks whether a user's `authorized_keys` file already has the right keys, owner and permissions.
+        :param ssh_keys: An SSHKeyObject containing a user's SSH public keys
+        :param gid: The GID of the group that owns the file
+        :return: True if `populate_ssh_file` would not need to write anything
+        """
+        username = sanitize_username(ssh_keys.username)
+        try:
+            uid = self.get_user_uid(username)
+        except UOUserNotFoundError:
+            return False
+        return self.manifest.is_current(
+            self.get_authorized_keys_path(username), ssh_keys.get_authorized_keys(), uid, gid, 0o644
+        )
+
+    def get_authorized_keys_path(self, user: str) -> str:
+        """
+        Returns the location of a user's `authorized_keys` file
+        :param user: The username of the user
+        :return: The path of the `authorized_keys` file
+        """
+        return os.path.join(self.base_dir, sanitize_username(user), '.ssh', 'authorized_keys')
+
+    def write_key_index(self, key_index: str, contents: str) -> None:
+        """
+        Atomically replaces the key index read by `automata-keys`, so sshd never sees a half-written index.
+        :param key_index: The path of the key index
+        :param contents: The contents built by `build_key_index`
+        """
+        os.makedirs(os.path.dirname(key_index), exist_ok=True)
+        self.manifest.write_file(key_index, contents, 0, 0, 0o644)
+
+    def key_index_is_current(self, key_index: str, contents: str) -> bool:
+        """
+        Checks whether the key index already has the given contents.
+        :param key_index: The path of the key index
+        :param contents: The contents built by `build_key_index`
+        :return: True if `write_key_index` would not need to write anything
+        """
+        return self.manifest.is_current(key_index, contents, 0, 0, 0o644)
+
+    def generate_sudoers_file(self,
+                              sudoers_file: str,
                               gitlab_groups: List[AutomataGroupConfig]) -> None:
         """
         Generates the sudoers file from a list of group configurations
@@ -158,48 +347,57 @@ class UserOps:
         :param gitlab_groups: A list of AutomataGroupConfig objects to parse
         :return: None
         """
-        with open(sudoers_file, 'w') as f:
-            template = '%{group} {sudoers_line}'
-            for group in gitlab_groups:
-                f.write(
-                    template.format(
-                        group=sanitize_username(group.linux_group),
-                        sudoers_line=sanitize_sudoers_line(group.sudoers_line),
-                    )
-                )
+        self.manifest.write_file(sudoers_file, self.get_sudoers_contents(gitlab_groups), 0, 0, 0o440)
+
+    def sudoers_file_is_current(self,
+                                sudoers_file: str,
+                                gitlab_groups: List[AutomataGroupConfig]) -> bool:
+        """
+        Checks whether the sudoers file already has the right contents, owner and permissions.
+        :param sudoers_file: The location of the sudoers file
+        :param gitlab_groups: A list of AutomataGroupConfig objects to parse
+        :return: True if `generate_sudoers_file` would not need to write anything
+        """
+        return self.manifest.is_current(sudoers_file, self.get_sudoers_contents(gitlab_groups), 0, 0, 0o440)
 
     @staticmethod
-    def get_all_users() -> list:
+    def get_sudoers_contents(gitlab_groups: List[AutomataGroupConfig]) -> str:
+        """
+        Generates the contents of the sudoers file from a list of group configurations
+        :param gitlab_groups: A list of AutomataGroupConfig objects to parse
+        :return: The contents of the sudoers file
+        """
+        template = '%{group} {sudoers_line}\n'
+        return ''.join(
+            template.format(
+                group=sanitize_username(group.linux_group),
+                sudoers_line=sanitize_sudoers_line(group.sudoers_line),
+            ) for group in gitlab_groups
+        )
+
+    def get_all_users(self) -> list:
         """
         Returns all of the usernames present in /etc/passwd
         :return: a list of all usernames present in /etc/passwd
         """
-        user_info = pwd.getpwall()
-        return [i[0] for i in user_info]
+        return list(self.local_state.uid_by_name)
 
-    @staticmethod
-    def get_all_users_in_group(gid: int) -> Set[str]:
+    def get_all_users_in_group(self, gid: int) -> Set[str]:
         """
         Gets all of the users associated with a Linux group.
         :param gid: The GID of the group
         :return: A Set of users associated with the group
         """
-        group_info = grp.getgrgid(gid)
-        passwd_users = {sanitize_username(i[0]) for i in pwd.getpwall() if i[3] == gid}
-        group_users = {sanitize_username(i) for i in group_info[-1]}
-        return group_users.union(passwd_users)
+        return {sanitize_username(i) for i in self.local_state.members_by_gid.get(gid, set())}
 
-    @staticmethod
-    def get_all_groups() -> list:
+    def get_all_groups(self) -> list:
         """
         Returns all of the groups present in /etc/group
         :return: a list of all groups present in /etc/group
         """
-        group_info = grp.getgrall()
-        return [i[0] for i in group_info]
+        return list(self.local_state.gid_by_name)
 
-    @staticmethod
-    def get_group_gid(group: str) -> int:
+    def get_group_gid(self, group: str) -> int:
         """
         Return the GID of a given group name
         :param group: The name of the group
@@ -207,13 +405,11 @@ class UserOps:
         :raises UOGroupNotFoundError: If the group is not found in /etc/group
         """
         try:
-            group_info = grp.getgrnam(group)
+            return self.local_state.gid_by_name[group]
         except KeyError:
             raise UOGroupNotFoundError
-        return group_info[2]
 
-    @staticmethod
-    def get_user_uid(user: str) -> int:
+    def get_user_uid(self, user: str) -> int:
         """
         Return the UID of a given user name
         :param user: The name of the user
@@ -221,10 +417,9 @@ class UserOps:
         :raises UOUserNotFoundError: If the user is not found in /etc/passwd
         """
         try:
-            user_info = pwd.getpwnam(user)
+            return self.local_state.uid_by_name[user]
         except KeyError:
             raise UOUserNotFoundError
-        return user_info[2]
 
 
 class UOError(Exception):
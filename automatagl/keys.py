@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from automatagl.helpers.key_index import default_key_index, lookup_keys, KIError
+
+
+def main():
+    """
+    Prints the SSH public keys of a user from the key index, one per line.  Meant to be used as sshd's
+    `AuthorizedKeysCommand`, e.g. `AuthorizedKeysCommand /usr/local/bin/automata-keys %u`.
+    """
+    parser = argparse.ArgumentParser(description='Print the SSH public keys of a user from the Automata key index.')
+    parser.add_argument('user', help='The user to look up.')
+    parser.add_argument('-f', '--index', default=default_key_index,
+                        help='The key index to read (defaults to {}).'.format(default_key_index))
+    arguments = parser.parse_args()
+
+    try:
+        keys = lookup_keys(arguments.index, arguments.user)
+    except OSError as e:
+        print("Cannot read the key index '{}': {}".format(arguments.index, e.strerror), file=sys.stderr)
+        sys.exit(1)
+    except KIError as e:
+        print(e.message, file=sys.stderr)
+        sys.exit(1)
+    for key in keys:
+        print(key)
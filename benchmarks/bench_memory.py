@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Memory benchmark for the Gitlab provider.
+
+Fetches synthetic groups through the real REST code path (paging, key fetching, decoding) from an in-process fake
+Gitlab server, and measures the Python heap with `tracemalloc`.  `retained` is what the fetched groups take once the
+fetch is done, `transient` is how far the heap peaked above that while fetching.  The transient part should depend on
+the page size and the number of workers, not on the number of users.
+
+    python3 benchmarks/bench_memory.py --sizes 1000 10000 --output memory.json
+"""
+
+from urllib.parse import parse_qs, urlparse
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# pylint: disable=wrong-import-position
+from automatagl.helpers.providers.gitlab_provider import GitlabProvider
+from bench_sync import synthetic_key
+
+default_sizes = [1000, 5000, 10000]
+api_address = 'https://gitlab.bench/api/v4'
+
+
+class SyntheticGitlabAdapter(requests.adapters.BaseAdapter):
+    """
+    Answers the Gitlab member and key endpoints for `users` users spread over `groups` groups, the same way
+    `bench_sync.SyntheticProvider` spreads them: every fifth user is also a member of the next group.
+    """
+
+    def __init__(self, users: int, groups: int, keys: int) -> None:
+        super().__init__()
+        self.users = users
+        self.groups = groups
+        self.keys = keys
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        url = urlparse(request.url)
+        query = {k: int(v[0]) for k, v in parse_qs(url.query).items() if v[0].isdigit()}
+        parts = url.path.split('/')
+        if parts[-1] == 'members':
+            index = int(parts[-2].rsplit('-', 1)[1])
+            members = [
+                i for i in range(self.users)
+                if i % self.groups == index or (i % 5 == 0 and (i + 1) % self.groups == index)
+            ]
+            page, per_page = query.get('page', 1), query.get('per_page', 20)
+            body = [
+                {'id': i, 'username': 'user{}'.format(i), 'state': 'active'}
+                for i in members[(page - 1) * per_page:page * per_page]
+            ]
+            link = None
+            if page * per_page < len(members):
+                link = '<{}://{}{}?page={}&per_page={}>; rel="next"'.format(
+                    url.scheme, url.netloc, url.path, page + 1, per_page
+                )
+            return self.__response(request, body, link)
+        user = int(parts[-2])
+        return self.__response(request, [{'key': synthetic_key(user, k)} for k in range(self.keys)])
+
+    def close(self) -> None:
+        pass
+
+    @staticmethod
+    def __response(request: requests.PreparedRequest, body: list, link: str = None) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        response.url = request.url
+        response._content = json.dumps(body).encode('utf-8')  # pylint: disable=protected-access
+        response.headers['Content-Type'] = 'application/json'
+        if link:
+            response.headers['Link'] = link
+        return response
+
+
+def run_size(size: int, groups: int, keys: int, workers: int) -> dict:
+    """
+    Fetches every group once and measures the heap.
+    """
+    provider = GitlabProvider({
+        'api_address': api_address,
+        'api_token': 'benchmark',
+        'only_active': True,
+        'max_workers': workers,
+    })
+    provider.session.session.mount(api_address, SyntheticGitlabAdapter(size, groups, keys))
+    group_names = ['synthetic-{}'.format(i) for i in range(groups)]
+
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    group_members = provider.fetch_groups(group_names)
+    seconds = time.perf_counter() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    retained, transient = current - baseline, peak - current
+    memberships = sum(len(i) for i in group_members.values())
+    print('{:>6} users  retained {:8.1f} KiB ({:5.0f} B/membership)  transient {:8.1f} KiB  {:6.2f}s'.format(
+        size, retained / 1024, retained / max(memberships, 1), transient / 1024, seconds
+    ), file=sys.stderr)
+    return {
+        'users': size,
+        'groups': groups,
+        'keys': keys,
+        'workers': workers,
+        'per_page': provider.per_page,
+        'memberships': memberships,
+        'seconds': seconds,
+        'retained_bytes': retained,
+        'transient_bytes': transient,
+        'peak_bytes': peak - baseline,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Measure the memory used to fetch groups from the Gitlab provider.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='Numbers of users to test.')
+    parser.add_argument('--groups', type=int, default=5, help='Number of provider groups.')
+    parser.add_argument('--keys', type=int, default=2, help='Number of SSH keys per user.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of key fetching workers.')
+    parser.add_argument('--output', help='Where to write the JSON results (defaults to stdout).')
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'results': [run_size(i, arguments.groups, arguments.keys, arguments.workers) for i in arguments.sizes],
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
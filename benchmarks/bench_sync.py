@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks for Automata.
+
+Runs the real fetch/plan/apply path against a synthetic in-process provider and a throwaway root directory with its own
+passwd/group/shadow files and home tree, then writes the timings as JSON.  Must be run as root, since key files are
+chowned to the synthetic users.
+
+    python3 benchmarks/bench_sync.py --sizes 100 1000 --output bench.json
+"""
+
+from typing import List
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import platform
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# pylint: disable=wrong-import-position
+from automatagl.helpers.file_manifest import FileManifest
+from automatagl.helpers.local_state import LocalStateIndex
+from automatagl.helpers.native_accounts import NativeAccountBackend
+from automatagl.helpers.provider_operations import AutomataConfig, AutomataGroupConfig, ProviderUser
+from automatagl.helpers.providers.base_provider import BaseProvider
+from automatagl.helpers.ssh_key_parser import KeyParser
+from automatagl.helpers.synchronizer import Synchronizer
+from automatagl.helpers.user_operations import UserOps
+
+default_sizes = [100, 1000, 10000, 50000]
+
+
+class SyntheticProvider(BaseProvider):
+    """
+    Generates `users` users with `keys` keys each, spread over `groups` groups.  Every fifth user is also a member of
+    the next group, so group precedence is exercised.  Each `generation` removes 5% of the users and adds 5% new ones.
+    """
+
+    def __init__(self, config: dict) -> None:
+        super().__init__(config)
+        self.groups = config['groups']
+        self.keys = config['keys']
+        users = config['users']
+        generation = config.get('generation', 0)
+        churn = max(users // 20, 1) if generation else 0
+        removed = set(range(0, churn * 20, 20))
+        self.user_ids = [i for i in range(users) if i not in removed] + list(range(users, users + churn))
+
+    def get_users_from_group(self, group: str) -> List[ProviderUser]:
+        index = int(group.rsplit('-', 1)[1])
+        return [
+            ProviderUser(username='user{}'.format(i), keys=[synthetic_key(i, k) for k in range(self.keys)])
+            for i in self.user_ids
+            if i % self.groups == index or (i % 5 == 0 and (i + 1) % self.groups == index)
+        ]
+
+
+class FakeRootUserOps(UserOps):
+    """
+    UserOps confined to a temporary root: the native backend edits `<root>/etc` and homes live in `<root>/home`.
+    """
+
+    def __init__(self, root: str) -> None:
+        etc_dir = os.path.join(root, 'etc')
+        super().__init__(
+            base_dir=os.path.join(root, 'home'),
+            manifest=FileManifest(os.path.join(root, 'var', 'lib', 'automata', 'manifest.json')),
+            local_state=LocalStateIndex.from_files(os.path.join(etc_dir, 'passwd'), os.path.join(etc_dir, 'group')),
+            backend='native',
+        )
+        self.native_backend = NativeAccountBackend(etc_dir=etc_dir, skel_dir=os.path.join(etc_dir, 'skel'))
+
+
+def synthetic_key(user: int, key: int) -> str:
+    """
+    Generates a well-formed (but useless) ed25519 public key.
+    """
+    blob = b''.join([
+        struct.pack('>I', 11), b'ssh-ed25519',
+        struct.pack('>I', 32), hashlib.sha256('{}:{}'.format(user, key).encode('utf-8')).digest(),
+    ])
+    return 'ssh-ed25519 {} user{}-{}'.format(base64.b64encode(blob).decode('ascii'), user, key)
+
+
+def make_root(root: str) -> None:
+    """
+    Creates an empty system root with only a root user.
+    """
+    for directory in ('etc/sudoers.d', 'home', 'var/lib/automata'):
+        os.makedirs(os.path.join(root, directory))
+    files = {
+        'passwd': 'root:x:0:0:root:/root:/bin/bash\n',
+        'shadow': 'root:*:19000:0:99999:7:::\n',
+        'group': 'root:x:0:\n',
+        'gshadow': 'root:*::\n',
+        'login.defs': 'UID_MIN 10000\nUID_MAX 200000\nGID_MIN 10000\nGID_MAX 200000\n',
+    }
+    for name, contents in files.items():
+        with open(os.path.join(root, 'etc', name), 'w') as f:
+            f.write(contents)
+
+
+def run_once(root: str, provider_config: dict) -> dict:
+    """
+    Runs one complete synchronization the way a cron run would, with fresh objects loaded from the root.
+    """
+    groups = [
+        AutomataGroupConfig('synthetic-{}'.format(i), 'synthetic{}'.format(i), 'ALL=(ALL) ALL', list())
+        for i in range(provider_config['groups'])
+    ]
+    automata_config = AutomataConfig(
+        groups=groups,
+        sudoers_file=os.path.join(root, 'etc', 'sudoers.d', 'automata'),
+        home_dir_path=os.path.join(root, 'home'),
+        protected_uid_start=1000,
+        protected_gid_start=1000,
+        state_dir=os.path.join(root, 'var', 'lib', 'automata'),
+        backend='native',
+        key_index='',
+        authorized_keys_files=True,
+        pipeline_depth=8,
+    )
+    timings = dict()
+    started = time.perf_counter()
+    user_ops = FakeRootUserOps(root)
+    key_parser = KeyParser(cache_file=os.path.join(automata_config.state_dir, 'key_cache.json'))
+    synchronizer = Synchronizer(SyntheticProvider(provider_config), user_ops, automata_config, key_parser=key_parser)
+    timings['setup'] = time.perf_counter() - started
+    phase = time.perf_counter()
+    synchronizer.fetch()
+    timings['fetch'] = time.perf_counter() - phase
+    phase = time.perf_counter()
+    plan = synchronizer.plan()
+    timings['plan'] = time.perf_counter() - phase
+    phase = time.perf_counter()
+    synchronizer.apply(plan)
+    timings['apply'] = time.perf_counter() - phase
+    timings['total'] = time.perf_counter() - started
+    return {
+        'seconds': timings,
+        'users_added': len(plan.user_adds),
+        'users_deleted': len(plan.user_deletes),
+        'key_files_written': user_ops.manifest.rewritten,
+    }
+
+
+def run_size(size: int, groups: int, keys: int) -> List[dict]:
+    """
+    Runs the cold-provision, steady-state and churn scenarios for one fleet size.
+    """
+    root = tempfile.mkdtemp(prefix='automata-bench-')
+    try:
+        make_root(root)
+        provider_config = {'users': size, 'groups': groups, 'keys': keys}
+        results = list()
+        for scenario, generation in (('cold', 0), ('steady', 0), ('churn', 1)):
+            result = run_once(root, dict(provider_config, generation=generation))
+            result.update({'scenario': scenario, 'users': size, 'groups': groups, 'keys': keys})
+            results.append(result)
+            print('{:>6} users  {:<7} {:8.3f}s'.format(size, scenario, result['seconds']['total']), file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark Automata against a synthetic provider.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='Numbers of users to test.')
+    parser.add_argument('--groups', type=int, default=5, help='Number of provider groups.')
+    parser.add_argument('--keys', type=int, default=2, help='Number of SSH keys per user.')
+    parser.add_argument('--output', help='Where to write the JSON results (defaults to stdout).')
+    arguments = parser.parse_args()
+    if os.geteuid() != 0:
+        parser.error('the benchmarks must be run as root to chown the synthetic users\' files.')
+
+    logging.basicConfig(level=logging.WARNING)
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'results': [i for size in arguments.sizes for i in run_size(size, arguments.groups, arguments.keys)],
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Import-time budget check for Automata.
+
+Measures how long `import automatagl.automatagl` takes with `python -X importtime` in fresh interpreters, and checks
+that the network libraries are only imported once a provider that needs them is looked up.  Exits with a non-zero
+status if the budget is exceeded.
+
+    python3 benchmarks/import_budget.py --budget-ms 100
+"""
+
+from typing import List, Tuple
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules that must not be imported before a provider that needs them is looked up.
+network_modules = ['requests', 'urllib3', 'chardet']
+lazy_modules = network_modules + ['http.server', 'asyncio']
+
+# Each check runs some code and lists the modules it must not import.
+checks = {
+    'cli': ("import automatagl.automatagl", lazy_modules),
+    'bundle': (
+        "import automatagl.automatagl\n"
+        "from automatagl.helpers.providers import automata_providers\n"
+        "automata_providers['bundle']",
+        network_modules,
+    ),
+}
+
+# The import time allowed for each check, in milliseconds.
+default_budget_ms = 100
+
+importtime_line = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)$')
+
+
+def measure(code: str, forbidden: List[str]) -> Tuple[int, List[str]]:
+    """
+    Runs `code` in a fresh interpreter with `-X importtime`.
+    :return: The cumulative time of the top-level `automatagl` imports in microseconds, and the forbidden modules that
+    were imported
+    :raises RuntimeError: If the interpreter did not report any import time
+    """
+    code = "{}\nimport sys\nprint(','.join(i for i in {!r} if i in sys.modules))".format(code, forbidden)
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True,
+    )
+    cumulative, parsed = 0, False
+    for line in result.stderr.splitlines():
+        match = importtime_line.match(line)
+        if match and len(match.group(3)) == 1 and match.group(4).startswith('automatagl'):
+            cumulative += int(match.group(2))
+            parsed = True
+    if not parsed:
+        raise RuntimeError("No `automatagl` import found in the `-X importtime` output (it needs Python 3.7+).")
+    return cumulative, [i for i in result.stdout.strip().split(',') if i]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Check the import time of Automata against a budget.')
+    parser.add_argument('--budget-ms', type=float, default=default_budget_ms,
+                        help='Maximum import time in milliseconds.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs, the fastest one is compared.')
+    arguments = parser.parse_args()
+
+    results, failed = dict(), False
+    for name, (code, forbidden) in checks.items():
+        runs = [measure(code, forbidden) for _ in range(arguments.runs)]
+        best = min(i[0] for i in runs) / 1000
+        imported = runs[0][1]
+        results[name] = {'import_ms': best, 'forbidden_modules_imported': imported}
+        if best > arguments.budget_ms or imported:
+            failed = True
+        print('{:<8} {:8.1f}ms  {}'.format(name, best, ', '.join(imported) or 'no forbidden modules imported'),
+              file=sys.stderr)
+
+    print(json.dumps({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'budget_ms': arguments.budget_ms,
+        'results': results,
+    }, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
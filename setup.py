@@ -11,6 +11,7 @@ setup(name='automatagl',
       entry_points={
           'console_scripts': [
               'automata=automatagl.automatagl:main',
+              'automata-keys=automatagl.keys:main',
           ],
       },
       install_requires=[
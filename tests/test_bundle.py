@@ -0,0 +1,101 @@
+"""
+Writes bundles to a temporary directory and reads them back through the bundle provider.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from automatagl.helpers.bundle import BNDFormatError, BNDGroupNotFoundError, BNDSignatureError, read_bundle, \
+    write_bundle
+from automatagl.helpers.provider_operations import ProviderUser
+from automatagl.helpers.providers.bundle_provider import BundleProvider
+
+group_members = {
+    'team/ops': [ProviderUser('alice', ['ssh-ed25519 AAAA alice']), ProviderUser('bob')],
+    'team/dev': [ProviderUser('alice', ['ssh-ed25519 AAAA alice', 'ssh-rsa BBBB alice@laptop'])],
+}
+
+
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'bundle.json')
+        self.key = b'correct horse battery staple'
+
+    def tamper(self, replace):
+        with open(self.path, 'rb') as f:
+            header, payload = f.read().split(b'\n', 1)
+        with open(self.path, 'wb') as f:
+            f.write(header + b'\n' + replace(payload))
+
+    def test_round_trip(self):
+        write_bundle(self.path, group_members, self.key)
+        self.assertEqual(read_bundle(self.path, self.key), group_members)
+        self.assertEqual(os.listdir(self.root), ['bundle.json'])
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        # A signed bundle can still be read without checking the signature.
+        self.assertEqual(read_bundle(self.path), group_members)
+
+    def test_unsigned_round_trip(self):
+        write_bundle(self.path, group_members)
+        self.assertEqual(read_bundle(self.path), group_members)
+
+    def test_tampered_payload(self):
+        write_bundle(self.path, group_members, self.key)
+        self.tamper(lambda payload: payload.replace(b'"bob"', b'"eve"'))
+        with self.assertRaises(BNDSignatureError):
+            read_bundle(self.path, self.key)
+
+    def test_wrong_key(self):
+        write_bundle(self.path, group_members, self.key)
+        with self.assertRaises(BNDSignatureError):
+            read_bundle(self.path, b'wrong key')
+
+    def test_unsigned_bundle_with_a_key(self):
+        write_bundle(self.path, group_members)
+        with self.assertRaises(BNDSignatureError):
+            read_bundle(self.path, self.key)
+
+    def test_malformed_bundles(self):
+        for contents in [
+            b'',
+            b'not json\n{}\n',
+            b'[]\n{}\n',
+            b'{"version": 2}\n{"groups": {}}\n',
+            b'{"version": 1}\n{"groups": []}\n',
+            b'{"version": 1}\n{"groups": {"team/ops": [["alice"]]}}\n',
+        ]:
+            with self.subTest(contents=contents):
+                with open(self.path, 'wb') as f:
+                    f.write(contents)
+                with self.assertRaises(BNDFormatError):
+                    read_bundle(self.path)
+
+    def test_provider(self):
+        key_file = os.path.join(self.root, 'bundle.key')
+        with open(key_file, 'wb') as f:
+            f.write(self.key + b'\n')
+        write_bundle(self.path, group_members, self.key)
+        provider = BundleProvider({'path': self.path, 'signing_key_file': key_file})
+        self.assertEqual(provider.fetch_groups(['team/ops', 'team/dev']), group_members)
+        # A group missing from the bundle fails the fetch, so its members are not deleted.
+        with self.assertRaises(BNDGroupNotFoundError):
+            provider.fetch_groups(['team/ops', 'team/qa'])
+
+    def test_provider_rejects_an_unsigned_bundle(self):
+        key_file = os.path.join(self.root, 'bundle.key')
+        with open(key_file, 'wb') as f:
+            f.write(self.key)
+        with open(self.path, 'w') as f:
+            f.write('{}\n{}\n'.format(json.dumps({'version': 1}), json.dumps({'groups': {'team/ops': []}})))
+        with self.assertRaises(BNDSignatureError):
+            BundleProvider({'path': self.path, 'signing_key_file': key_file})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+"""
+Sends Gitlab system hooks to the daemon's HTTP endpoint.
+"""
+
+from types import SimpleNamespace
+import json
+import socket
+import threading
+import time
+import unittest
+import urllib.error
+import urllib.request
+
+from automatagl.helpers.daemon import AutomataDaemon
+from automatagl.helpers.provider_operations import AutomataGroupConfig, DaemonConfig
+
+
+class FakeUserOps:
+    """
+    Counts how often the local state index is rebuilt.
+    """
+
+    def __init__(self):
+        self.reloads = 0
+
+    def reload_local_state(self):
+        self.reloads += 1
+
+
+class FakeSynchronizer:
+    """
+    Records the groups of every run and the paths of every repair instead of synchronizing anything.
+    """
+
+    def __init__(self, groups):
+        self.automata_config = SimpleNamespace(groups=[AutomataGroupConfig(i, i, '', []) for i in groups])
+        self.group_members = dict()
+        self.user_ops = FakeUserOps()
+        self.runs = list()
+        self.repairs = list()
+        self.reloads_before_run = list()
+
+    def run(self, provider_groups=None):
+        self.reloads_before_run.append(self.user_ops.reloads)
+        self.runs.append(provider_groups)
+
+    def repair(self, paths):
+        self.repairs.append((time.monotonic(), paths))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class DaemonHookTest(unittest.TestCase):
+
+    def setUp(self):
+        self.synchronizer = FakeSynchronizer(['group-a', 'group-b', 'group-c'])
+        self.port = free_port()
+
+    def start_daemon(self, hook_token='secret', debounce=0.5, interval=3600):
+        config = DaemonConfig(
+            interval=interval, listen_address='127.0.0.1', listen_port=self.port, hook_token=hook_token,
+            debounce=debounce, watch_files=False,
+        )
+        return AutomataDaemon(self.synchronizer, config)
+
+    def run_daemon(self, daemon, client):
+        """
+        Runs the daemon in the main thread (it installs signal handlers) while `client` runs in another thread, and
+        stops the daemon once `client` returns.
+        """
+        errors = list()
+
+        def run_client():
+            try:
+                client()
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+            finally:
+                daemon.stop()
+
+        thread = threading.Thread(target=run_client)
+        thread.start()
+        daemon.run()
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    def post(self, payload, token='secret') -> int:
+        request = urllib.request.Request(
+            'http://127.0.0.1:{}/'.format(self.port),
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'X-Gitlab-Token': token, 'Content-Type': 'application/json'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=5) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                raise AssertionError('Timed out, runs so far: {}'.format(self.synchronizer.runs))
+            time.sleep(0.02)
+
+    def wait_for_listener(self, daemon):
+        self.wait_for(lambda: daemon.server is not None and self.synchronizer.runs)
+
+    def test_rejects_wrong_token(self):
+        daemon = self.start_daemon()
+
+        def client():
+            self.wait_for_listener(daemon)
+            self.assertEqual(self.post({'event_name': 'user_add_to_group', 'group_path': 'group-a'}, 'wrong'), 403)
+            self.assertEqual(self.post({'event_name': 'user_add_to_group', 'group_path': 'group-a'}, ''), 403)
+            time.sleep(1)
+
+        self.run_daemon(daemon, client)
+        # Only the full reconciliation at startup.
+        self.assertEqual(self.synchronizer.runs, [None])
+
+    def test_accepted_hooks_are_debounced_into_one_resync(self):
+        daemon = self.start_daemon()
+
+        def client():
+            self.wait_for_listener(daemon)
+            self.assertEqual(self.post({'event_name': 'user_add_to_group', 'group_path': 'group-b'}), 202)
+            self.assertEqual(self.post({'event_name': 'user_remove_from_group', 'group_path': 'group-a'}), 202)
+            self.assertEqual(self.post({'event_name': 'project_create', 'path': 'group-c'}), 202)
+            self.wait_for(lambda: len(self.synchronizer.runs) >= 2)
+            time.sleep(1)
+
+        self.run_daemon(daemon, client)
+        self.assertEqual(self.synchronizer.runs, [None, ['group-a', 'group-b']])
+        # Resyncing some groups keeps the local state index of the full run.
+        self.assertEqual(self.synchronizer.user_ops.reloads, 0)
+
+    def test_full_runs_reload_the_local_state(self):
+        daemon = self.start_daemon(debounce=5, interval=0.2)
+
+        def client():
+            self.wait_for(lambda: len(self.synchronizer.runs) >= 4, timeout=3)
+
+        started = time.monotonic()
+        self.run_daemon(daemon, client)
+        # Waking up for a full run does not wait for `debounce`, no hook was received.
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(self.synchronizer.runs[:4], [None] * 4)
+        # The index built at startup is used for the first run, and rebuilt before every run after it.
+        self.assertEqual(self.synchronizer.reloads_before_run[:4], [0, 1, 2, 3])
+
+    def test_repairs_are_not_debounced(self):
+        daemon = self.start_daemon(hook_token='', debounce=5)
+
+        def client():
+            self.wait_for(lambda: self.synchronizer.runs)
+            queued = time.monotonic()
+            daemon.queue_repair(['/home/alice/.ssh/authorized_keys'])
+            self.wait_for(lambda: self.synchronizer.repairs, timeout=2)
+            self.assertLess(self.synchronizer.repairs[0][0] - queued, 1)
+
+        with self.assertLogs(level='ERROR'):
+            self.run_daemon(daemon, client)
+        self.assertEqual([i[1] for i in self.synchronizer.repairs], [['/home/alice/.ssh/authorized_keys']])
+
+    def test_invalid_body(self):
+        daemon = self.start_daemon()
+
+        def client():
+            self.wait_for_listener(daemon)
+            request = urllib.request.Request(
+                'http://127.0.0.1:{}/'.format(self.port), data=b'not json', headers={'X-Gitlab-Token': 'secret'},
+            )
+            with self.assertRaises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(request, timeout=5)
+            self.assertEqual(error.exception.code, 400)
+
+        self.run_daemon(daemon, client)
+        self.assertEqual(self.synchronizer.runs, [None])
+
+    def test_no_listener_without_token(self):
+        daemon = self.start_daemon(hook_token='')
+
+        def client():
+            self.wait_for(lambda: self.synchronizer.runs)
+            with self.assertRaises(OSError):
+                self.post({'event_name': 'user_add_to_group', 'group_path': 'group-a'}, '')
+
+        with self.assertLogs(level='ERROR'):
+            self.run_daemon(daemon, client)
+        self.assertIsNone(daemon.server)
+        self.assertEqual(self.synchronizer.runs, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Touches files in a temporary directory watched with inotify.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from automatagl.helpers.atomic_file import write_atomically
+from automatagl.helpers.drift_watcher import DriftWatcher, DWNotSupportedError
+
+
+class DriftWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.calls = list()
+        self.called = threading.Condition()
+        try:
+            self.watcher = DriftWatcher(self.callback, settle=0.1)
+        except DWNotSupportedError as e:
+            self.skipTest(e.message)
+        self.addCleanup(self.watcher.stop)
+        self.managed = [self.path('authorized_keys'), self.path('sudoers'), self.path('keys', 'automata_keys.idx')]
+        for path in self.managed:
+            self.write(path, 'managed\n')
+        self.watcher.watch(self.managed)
+        self.watcher.start()
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    @staticmethod
+    def write(path, contents):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def callback(self, paths):
+        with self.called:
+            self.calls.append(paths)
+            self.called.notify_all()
+
+    def touched(self, change, timeout=5):
+        """
+        Makes a change and returns the paths of every callback it caused.
+        """
+        with self.called:
+            del self.calls[:]
+        change()
+        with self.called:
+            self.called.wait_for(lambda: self.calls, timeout=timeout)
+        # Anything reported after the first callback would be a duplicate.
+        time.sleep(0.5)
+        with self.called:
+            return list(self.calls)
+
+    def test_modify(self):
+        def change():
+            with open(self.managed[0], 'a') as f:
+                f.write('ssh-ed25519 AAAA mallory\n')
+                f.flush()
+                time.sleep(0.02)
+                f.write('ssh-ed25519 BBBB mallory\n')
+            os.chmod(self.managed[0], 0o666)
+
+        self.assertEqual(self.touched(change), [[self.managed[0]]])
+
+    def test_atomic_replace(self):
+        self.assertEqual(self.touched(lambda: write_atomically(self.managed[1], 'replaced\n')), [[self.managed[1]]])
+
+    def test_delete(self):
+        self.assertEqual(self.touched(lambda: os.remove(self.managed[1])), [[self.managed[1]]])
+
+    def test_several_files(self):
+        def change():
+            os.remove(self.managed[0])
+            self.write(self.managed[1], 'changed\n')
+            self.write(self.managed[2], 'changed\n')
+
+        self.assertEqual(self.touched(change), [sorted(self.managed)])
+
+    def test_unmanaged_files_are_ignored(self):
+        self.assertEqual(self.touched(lambda: self.write(self.path('known_hosts'), 'changed\n'), 1), [])
+        self.assertEqual(self.touched(lambda: self.write(self.path('keys', 'other.idx'), 'changed\n'), 1), [])
+
+    def test_directory_removed(self):
+        self.assertEqual(self.touched(lambda: shutil.rmtree(self.path('keys'))), [[self.managed[2]]])
+
+    def test_watch_replaces_the_watched_files(self):
+        self.watcher.watch(self.managed[:1])
+        self.assertEqual(self.touched(lambda: os.remove(self.managed[1]), 1), [])
+        self.assertEqual(self.touched(lambda: os.remove(self.managed[2]), 1), [])
+        self.assertEqual(self.touched(lambda: os.remove(self.managed[0])), [[self.managed[0]]])
+
+
+if __name__ == '__main__':
+    unittest.main()
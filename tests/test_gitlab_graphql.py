@@ -0,0 +1,141 @@
+"""
+Fetches groups in `graphql` mode from a local server standing in for the Gitlab GraphQL and REST APIs.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import re
+import threading
+import unittest
+
+from automatagl.helpers.providers.gitlab_provider import GitlabProvider
+
+members = [
+    {'id': 1, 'username': 'alice', 'state': 'active'},
+    {'id': 2, 'username': 'bob', 'state': 'blocked'},
+    {'id': 3, 'username': 'carol', 'state': 'active'},
+    {'id': 4, 'username': 'dave', 'state': 'active'},
+    {'id': 5, 'username': 'erin', 'state': 'active'},
+]
+
+
+def user_key(user_id: int) -> str:
+    return 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{} user{}'.format('A' * 42, user_id)
+
+
+class StubGitlabHandler(BaseHTTPRequestHandler):
+    """
+    Serves the `groupMembers` GraphQL query with the end cursor being the offset of the next page, the REST group
+    lookup and the REST user keys.  Servers without `keys_over_graphql` reject queries asking for `publicKeys`.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.record('POST', body)
+        if not self.server.keys_over_graphql and 'publicKeys' in body['query']:
+            return self.send_json({'errors': [{'message': "Field 'publicKeys' doesn't exist on type 'UserCore'"}]})
+        variables = body['variables']
+        if not variables['group'].startswith('team/'):
+            return self.send_json({'data': {'group': None}})
+        start, first = int(variables['after'] or 0), variables['first']
+        nodes = [{'user': None}]
+        for member in members[start:start + first]:
+            user = {'id': 'gid://gitlab/User/{}'.format(member['id']), 'username': member['username'],
+                    'state': member['state']}
+            if 'publicKeys' in body['query']:
+                user['publicKeys'] = {'nodes': [{'key': user_key(member['id'])}]}
+            nodes.append({'user': user})
+        page_info = {'hasNextPage': start + first < len(members), 'endCursor': str(start + first)}
+        return self.send_json({'data': {'group': {'groupMembers': {'pageInfo': page_info, 'nodes': nodes}}}})
+
+    def do_GET(self):
+        self.server.record('GET', self.path)
+        match = re.match(r'/api/v4/users/(\d+)/keys', self.path)
+        if match:
+            return self.send_json([{'key': user_key(int(match.group(1)))}])
+        if self.path.startswith('/api/v4/groups/42'):
+            return self.send_json({'id': 42, 'full_path': 'team/ops'})
+        return self.send_json({'message': '404 Not found'}, 404)
+
+    def send_json(self, body, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class StubGitlabServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubGitlabHandler)
+        self.keys_over_graphql = True
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def record(self, method, request):
+        with self.lock:
+            self.requests.append((method, request))
+
+    def graphql_queries(self):
+        return [i for method, i in self.requests if method == 'POST']
+
+
+class GitlabGraphQLTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubGitlabServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.provider = GitlabProvider({
+            'api_address': 'http://127.0.0.1:{}/api/v4'.format(self.server.server_address[1]),
+            'api_token': 'token',
+            'only_active': True,
+            'mode': 'graphql',
+            'max_workers': 4,
+            'max_retries': 0,
+        })
+        self.addCleanup(self.provider.session.session.close)
+        self.provider.per_page = 2
+
+    def expected(self):
+        return [(i['username'], (user_key(i['id']),)) for i in members if i['state'] == 'active']
+
+    def test_paginated_query(self):
+        users = self.provider.fetch_groups(['team/ops'])['team/ops']
+        self.assertEqual([tuple(i) for i in users], self.expected())
+        queries = self.server.graphql_queries()
+        # One probe, then three pages of two members.
+        self.assertEqual([i['variables']['first'] for i in queries], [1, 2, 2, 2])
+        self.assertEqual([i['variables']['after'] for i in queries[1:]], [None, '2', '4'])
+        self.assertFalse([i for method, i in self.server.requests if method == 'GET'])
+
+    def test_keys_fallback_to_rest(self):
+        self.server.keys_over_graphql = False
+        group_members = self.provider.fetch_groups(['team/ops', 'team/dev'])
+        self.assertEqual([tuple(i) for i in group_members['team/ops']], self.expected())
+        self.assertEqual([tuple(i) for i in group_members['team/dev']], self.expected())
+        # The probe is the only query asking for the keys, however many groups are fetched.
+        queries = self.server.graphql_queries()
+        self.assertEqual(len([i for i in queries if 'publicKeys' in i['query']]), 1)
+        keys_requests = [i for method, i in self.server.requests if method == 'GET' and '/keys' in i]
+        # Members of both groups, their keys are only fetched once.
+        self.assertEqual(sorted(keys_requests), ['/api/v4/users/{}/keys?per_page=2'.format(i) for i in (1, 3, 4, 5)])
+
+    def test_numeric_group(self):
+        users = self.provider.fetch_groups(['42'])['42']
+        self.assertEqual([tuple(i) for i in users], self.expected())
+        self.assertEqual({i['variables']['group'] for i in self.server.graphql_queries()}, {'team/ops'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""
+Fetches groups in `incremental` mode from a local server standing in for the Gitlab REST API and its audit events.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import re
+import threading
+import time
+import unittest
+
+from automatagl.helpers.providers.gitlab_provider import GitlabProvider
+
+
+def user_key(user_id: int, version: int = 1) -> str:
+    return 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{}{} user{}'.format(version, 'A' * 41, user_id)
+
+
+class StubGitlabHandler(BaseHTTPRequestHandler):
+    """
+    Serves the members of the `ops` group, single members, user keys and the instance and group audit events from the
+    state of the server.  Audit event endpoints answer with `audit_status` when it is set.
+    """
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        server.record(path)
+        match = re.match(r'/api/v4/users/(\d+)/keys$', path)
+        if match:
+            user_id = int(match.group(1))
+            return self.send_json([{'key': user_key(user_id, server.key_versions.get(user_id, 1))}])
+        if path in ('/api/v4/audit_events', '/api/v4/groups/ops/audit_events'):
+            status = server.audit_status.get(path)
+            if status:
+                return self.send_json({'message': '{} Forbidden'.format(status)}, status)
+            if path == '/api/v4/audit_events':
+                return self.send_json([{'entity_type': 'User', 'entity_id': i} for i in server.user_events])
+            return self.send_json([{'details': {'target_type': 'User', 'target_id': i}} for i in server.member_events])
+        if path == '/api/v4/groups/ops/members':
+            return self.send_json([server.users[i] for i in server.members])
+        match = re.match(r'/api/v4/groups/ops/members/(\d+)$', path)
+        if match and int(match.group(1)) in server.members:
+            return self.send_json(server.users[int(match.group(1))])
+        return self.send_json({'message': '404 Not found'}, 404)
+
+    def send_json(self, body, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class StubGitlabServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubGitlabHandler)
+        self.users = {i: {'id': i, 'username': name, 'state': 'active'}
+                      for i, name in enumerate(['alice', 'bob', 'carol', 'dave', 'erin'], start=1)}
+        self.members = [1, 2, 4, 5]
+        self.key_versions = dict()
+        self.user_events = list()
+        self.member_events = list()
+        self.audit_status = dict()
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def record(self, path):
+        with self.lock:
+            self.requests.append(path)
+
+
+class GitlabIncrementalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubGitlabServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.provider = GitlabProvider({
+            'api_address': 'http://127.0.0.1:{}/api/v4'.format(self.server.server_address[1]),
+            'api_token': 'token',
+            'only_active': True,
+            'incremental': True,
+            'full_sync_interval': 3600,
+            'max_retries': 0,
+        })
+        self.addCleanup(self.provider.session.session.close)
+
+    def full_fetch(self):
+        snapshot = self.provider.fetch_groups_since({'ops': None})['ops']
+        self.assertEqual(self.server.requests[0], '/api/v4/groups/ops/members')
+        self.assertEqual(snapshot.cursor['user_ids'], {'alice': 1, 'bob': 2, 'dave': 4, 'erin': 5})
+        del self.server.requests[:]
+        return snapshot
+
+    def test_refetch_the_members_named_in_audit_events(self):
+        snapshot = self.full_fetch()
+        # bob changed his keys, carol joined and dave left the group.  User 99 is not a member of the group.
+        self.server.key_versions[2] = 2
+        self.server.members = [1, 2, 3, 5]
+        self.server.user_events = [2, 99]
+        self.server.member_events = [3, 4]
+
+        snapshot = self.provider.fetch_groups_since({'ops': snapshot})['ops']
+        self.assertEqual([(i.username, tuple(i.keys)) for i in snapshot.users], [
+            ('alice', (user_key(1),)), ('bob', (user_key(2, 2),)), ('erin', (user_key(5),)), ('carol', (user_key(3),)),
+        ])
+        self.assertEqual(snapshot.cursor['user_ids'], {'alice': 1, 'bob': 2, 'carol': 3, 'erin': 5})
+        # Neither the member list nor the keys of the unchanged members are fetched again.
+        self.assertEqual(sorted(self.server.requests), sorted([
+            '/api/v4/audit_events', '/api/v4/groups/ops/audit_events',
+            '/api/v4/groups/ops/members/2', '/api/v4/groups/ops/members/3', '/api/v4/groups/ops/members/4',
+            '/api/v4/users/2/keys', '/api/v4/users/3/keys',
+        ]))
+
+    def test_nothing_changed(self):
+        snapshot = self.full_fetch()
+        fetched = self.provider.fetch_groups_since({'ops': snapshot})['ops']
+        self.assertEqual(fetched.users, snapshot.users)
+        self.assertEqual(sorted(self.server.requests), ['/api/v4/audit_events', '/api/v4/groups/ops/audit_events'])
+        self.assertGreaterEqual(fetched.cursor['since'], snapshot.cursor['since'])
+
+    def test_full_sync_interval(self):
+        snapshot = self.full_fetch()
+        cursor = dict(snapshot.cursor, full_sync_at=time.time() - 7200)
+        self.server.members = [1, 3]
+        fetched = self.provider.fetch_groups_since({'ops': snapshot._replace(cursor=cursor)})['ops']
+        self.assertEqual([i.username for i in fetched.users], ['alice', 'carol'])
+        self.assertIn('/api/v4/groups/ops/members', self.server.requests)
+        self.assertNotIn('/api/v4/audit_events', self.server.requests)
+        self.assertGreater(fetched.cursor['full_sync_at'], cursor['full_sync_at'])
+
+    def test_fallback_when_audit_events_are_forbidden(self):
+        for path, status in [('/api/v4/audit_events', 403), ('/api/v4/groups/ops/audit_events', 404)]:
+            with self.subTest(path=path, status=status):
+                self.provider.incremental = True
+                self.server.audit_status = {path: status}
+                snapshot = self.full_fetch()
+                self.server.members = [1, 3]
+                with self.assertLogs(level='WARNING') as logs:
+                    fetched = self.provider.fetch_groups_since({'ops': snapshot})['ops']
+                self.assertIn('Cannot sync incrementally', logs.output[0])
+                self.assertEqual([i.username for i in fetched.users], ['alice', 'carol'])
+                self.assertIn('/api/v4/groups/ops/members', self.server.requests)
+                # Incremental mode is off for the rest of the run, the next fetch does not ask for audit events.
+                self.assertFalse(self.provider.incremental)
+                del self.server.requests[:]
+                self.provider.fetch_groups_since({'ops': fetched})
+                self.assertNotIn(path, self.server.requests)
+                self.server.members = [1, 2, 4, 5]
+
+
+if __name__ == '__main__':
+    unittest.main()
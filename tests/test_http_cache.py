@@ -0,0 +1,212 @@
+"""
+Caches the responses of a local server that answers conditional requests with `304 Not Modified`.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from automatagl.helpers.http_cache import HTTPCache
+
+last_modified = 'Wed, 21 Oct 2026 07:28:00 GMT'
+
+
+class ConditionalHandler(BaseHTTPRequestHandler):
+    """
+    Serves `/etag/<name>` with an `ETag` and `/dated/<name>` with a `Last-Modified` validator, the body changing
+    with the version of the resource.  `/plain` has no validator at all, `/latin1` is not encoded in UTF-8.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.record(self.path, dict(self.headers))
+        if self.path == '/latin1':
+            headers = {'Content-Type': 'application/json; charset=iso-8859-1', 'ETag': '"latin1"'}
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                return self.send(304, headers)
+            return self.send(200, headers, '{"name": "Jos\u00e9"}'.encode('iso-8859-1'))
+        version = server.versions.get(self.path, 1)
+        body = '{{"path": "{}", "version": {}, "padding": "{}"}}'.format(self.path, version, 'x' * 1000)
+        headers = {'Content-Type': 'application/json', 'X-Total-Pages': '3'}
+        if self.path.startswith('/etag/'):
+            headers['ETag'] = '"v{}"'.format(version)
+            if self.headers.get('If-None-Match') == headers['ETag']:
+                return self.send(304, headers)
+        elif self.path.startswith('/dated/'):
+            headers['Last-Modified'] = last_modified
+            if version == 1 and self.headers.get('If-Modified-Since') == last_modified:
+                return self.send(304, headers)
+        return self.send(200, headers, body.encode('utf-8'))
+
+    def send(self, status: int, headers: dict, body: bytes = b''):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), ConditionalHandler)
+        self.versions = dict()
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def record(self, path, headers):
+        with self.lock:
+            self.requests.append((path, headers))
+
+
+class HTTPCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], path)
+
+    def entries(self):
+        return sorted(i for i in os.listdir(self.cache_dir))
+
+    def test_etag_revalidation(self):
+        cache = HTTPCache(self.cache_dir)
+        first = cache.get(self.session, self.url('/etag/a'))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertNotIn('If-None-Match', self.server.requests[0][1])
+
+        second = cache.get(self.session, self.url('/etag/a'), headers={'Authorization': 'Bearer token'})
+        # The server answered with a 304, the body comes from the cache.
+        self.assertEqual(self.server.requests[1][1]['If-None-Match'], '"v1"')
+        self.assertEqual(self.server.requests[1][1]['Authorization'], 'Bearer token')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.headers['X-Total-Pages'], '3')
+        self.assertEqual(second.headers['etag'], '"v1"')
+
+        # A changed resource is served and cached again.
+        self.server.versions['/etag/a'] = 2
+        self.assertEqual(cache.get(self.session, self.url('/etag/a')).json()['version'], 2)
+        self.assertEqual(cache.get(self.session, self.url('/etag/a')).json()['version'], 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_last_modified_revalidation(self):
+        cache = HTTPCache(self.cache_dir)
+        cache.get(self.session, self.url('/dated/a'))
+        response = cache.get(self.session, self.url('/dated/a'))
+        self.assertEqual(self.server.requests[1][1]['If-Modified-Since'], last_modified)
+        self.assertNotIn('If-None-Match', self.server.requests[1][1])
+        self.assertEqual(response.json()['version'], 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_query_string_is_part_of_the_key(self):
+        cache = HTTPCache(self.cache_dir)
+        cache.get(self.session, self.url('/etag/a'), params={'page': 1})
+        cache.get(self.session, self.url('/etag/a'), params={'page': 2})
+        self.assertEqual(len(self.entries()), 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_responses_without_validators_are_not_cached(self):
+        cache = HTTPCache(self.cache_dir)
+        cache.get(self.session, self.url('/plain'))
+        cache.get(self.session, self.url('/plain'))
+        self.assertEqual(self.entries(), [])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_entries_are_written_atomically(self):
+        cache = HTTPCache(self.cache_dir)
+        cache.get(self.session, self.url('/etag/a'))
+        entries = self.entries()
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0].endswith('.json'))
+        self.assertEqual(os.stat(os.path.join(self.cache_dir, entries[0])).st_mode & 0o777, 0o600)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = HTTPCache(self.cache_dir)
+        for name in 'abc':
+            cache.get(self.session, self.url('/etag/{}'.format(name)))
+        entry_size = os.path.getsize(os.path.join(self.cache_dir, self.entries()[0]))
+        paths = {os.path.join(self.cache_dir, i) for i in self.entries()}
+        # Age the entries in the order they were written, `a` being the oldest.
+        for age, path in enumerate(sorted(paths, key=os.path.getmtime)):
+            os.utime(path, (1000000 + age, 1000000 + age))
+
+        # A cache that only fits three entries, reading `a` makes `b` the least recently used one.
+        cache = HTTPCache(self.cache_dir, max_size=entry_size * 3 + entry_size // 2)
+        cache.get(self.session, self.url('/etag/a'))
+        self.assertEqual(cache.hits, 1)
+        cache.get(self.session, self.url('/etag/d'))
+        self.assertEqual(len(self.entries()), 3)
+
+        for name, hit in [('a', True), ('c', True), ('d', True), ('b', False)]:
+            hits = cache.hits
+            cache.get(self.session, self.url('/etag/{}'.format(name)))
+            self.assertEqual(cache.hits - hits, int(hit), name)
+
+    def test_body_is_stored_as_sent(self):
+        cache = HTTPCache(self.cache_dir)
+        first = cache.get(self.session, self.url('/latin1'))
+        second = cache.get(self.session, self.url('/latin1'))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second.content, '{"name": "Jos\u00e9"}'.encode('iso-8859-1'))
+        self.assertEqual(second.json(), {'name': 'Jos\u00e9'})
+        with open(os.path.join(self.cache_dir, self.entries()[0]), 'r') as f:
+            self.assertNotIn('body', json.load(f))
+
+    def test_entries_of_older_versions_are_replaced(self):
+        cache = HTTPCache(self.cache_dir)
+        cache.get(self.session, self.url('/etag/a'))
+        path = os.path.join(self.cache_dir, self.entries()[0])
+        with open(path, 'w') as f:
+            json.dump({'headers': {'ETag': '"v1"'}, 'body': '{}'}, f)
+        # Without a usable body the validators are not sent, the entry is fetched and written again.
+        self.assertEqual(cache.get(self.session, self.url('/etag/a')).json()['version'], 1)
+        self.assertNotIn('If-None-Match', self.server.requests[1][1])
+        self.assertEqual(cache.get(self.session, self.url('/etag/a')).json()['version'], 1)
+        self.assertEqual(cache.hits, 1)
+
+    def test_disabled(self):
+        cache = HTTPCache(self.cache_dir, enabled=False)
+        cache.get(self.session, self.url('/etag/a'))
+        cache.get(self.session, self.url('/etag/a'))
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertEqual(cache.hits, 0)
+
+    def test_unusable_cache_directory(self):
+        with open(self.cache_dir, 'w'):
+            pass
+        with self.assertLogs(level='WARNING'):
+            cache = HTTPCache(self.cache_dir)
+        self.assertFalse(cache.enabled)
+        self.assertEqual(cache.get(self.session, self.url('/etag/a')).status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""
+Sends requests to a local HTTP server that pushes back with `429 Too Many Requests`.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from types import SimpleNamespace
+from unittest import mock
+import threading
+import time
+import unittest
+
+from automatagl.helpers import http_client
+from automatagl.helpers.http_client import HTTPClient
+from automatagl.helpers.metrics import metrics
+
+
+class FakeClock:
+    """
+    Stands in for the `time` module of the HTTP client, so backing off records the delays instead of sleeping.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = list()
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    @staticmethod
+    def time():
+        return time.time()
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """
+    Answers the first `throttled` requests with a 429 and `Retry-After`, and the ones after with a 200.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.requests <= server.throttled:
+            self.send_response(429)
+            self.send_header('Retry-After', server.retry_after)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class HTTPClientRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+        self.server.requests = 0
+        self.server.throttled = 2
+        self.server.retry_after = '3'
+        self.url = 'http://127.0.0.1:{}/api/v4/groups'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.clock = FakeClock()
+        patcher = mock.patch.object(http_client, 'time', SimpleNamespace(
+            monotonic=self.clock.monotonic, sleep=self.clock.sleep, time=self.clock.time,
+        ))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def client(self, **kwargs):
+        client = HTTPClient(max_concurrency=8, backoff=0.01, **kwargs)
+        self.addCleanup(client.session.close)
+        return client
+
+    def test_retries_after_the_delay_the_server_asked_for(self):
+        client = self.client(max_retries=5)
+        retries = metrics.counters.get('http_retries', 0)
+        with mock.patch.object(client.bucket, 'pause', wraps=client.bucket.pause) as pause:
+            response = client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(metrics.counters.get('http_retries', 0) - retries, 2)
+        # Every 429 pauses the token bucket for `Retry-After`, and the retry waits exactly that long.
+        self.assertEqual(pause.call_args_list, [mock.call(3.0), mock.call(3.0)])
+        self.assertEqual(self.clock.sleeps, [3.0, 3.0])
+        # Each 429 halves the concurrency cap, the one success is not enough to raise it again.
+        self.assertEqual(client.limiter.limit, 2)
+
+    def test_returns_the_last_response_when_out_of_retries(self):
+        self.server.throttled = 10
+        client = self.client(max_retries=2)
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.clock.sleeps, [3.0, 3.0])
+
+    def test_retry_after_is_capped(self):
+        self.server.retry_after = '3600'
+        client = self.client(max_retries=1, max_backoff=5)
+        response = client.get(self.url)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.clock.sleeps, [5.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
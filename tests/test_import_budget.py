@@ -0,0 +1,30 @@
+"""
+Fails when importing the CLI gets slower than the budget, or pulls in a module that should only be imported lazily.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'benchmarks'))
+
+import import_budget  # pylint: disable=wrong-import-position
+
+# Slow CI workers can raise the budget instead of skipping the check.
+budget_ms = float(os.environ.get('AUTOMATA_IMPORT_BUDGET_MS', import_budget.default_budget_ms))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '`-X importtime` needs Python 3.7')
+class ImportBudgetTest(unittest.TestCase):
+
+    def test_import_budget(self):
+        for name, (code, forbidden) in import_budget.checks.items():
+            with self.subTest(check=name):
+                runs = [import_budget.measure(code, forbidden) for _ in range(3)]
+                self.assertEqual(runs[0][1], [], 'Imported too early: {}'.format(', '.join(runs[0][1])))
+                best = min(i[0] for i in runs) / 1000
+                self.assertLessEqual(best, budget_ms, 'Importing took {:.1f}ms'.format(best))
+
+
+if __name__ == '__main__':
+    unittest.main()
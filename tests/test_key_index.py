@@ -0,0 +1,88 @@
+"""
+Builds key indexes in a temporary directory and looks users up in them.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from automatagl.helpers.key_index import KIFormatError, build_key_index, lookup_keys
+
+
+def user_key(username: str, n: int = 0) -> str:
+    return 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI{}{} {}@host'.format(n, 'A' * 41, username)
+
+
+class KeyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'automata_keys.idx')
+
+    def build(self, users):
+        with open(self.path, 'w') as f:
+            f.write(build_key_index(users))
+
+    def test_first_and_last_record(self):
+        users = {name: [user_key(name)] for name in ['alice', 'bob', 'carol', 'dave', 'erin']}
+        self.build(users)
+        self.assertEqual(lookup_keys(self.path, 'alice'), users['alice'])
+        self.assertEqual(lookup_keys(self.path, 'erin'), users['erin'])
+
+    def test_every_record(self):
+        # Enough users of varying lengths that the binary search lands in the middle of lines.
+        users = {'user{}'.format('x' * (i % 7) + str(i)): [user_key(str(i))] for i in range(500)}
+        self.build(users)
+        for username, keys in users.items():
+            self.assertEqual(lookup_keys(self.path, username), keys, username)
+
+    def test_username_prefix_of_another(self):
+        users = {'al': [user_key('al')], 'alice': [user_key('alice')], 'alice2': [user_key('alice2')],
+                 'alicea': [user_key('alicea')]}
+        self.build(users)
+        for username, keys in users.items():
+            self.assertEqual(lookup_keys(self.path, username), keys, username)
+        self.assertEqual(lookup_keys(self.path, 'ali'), [])
+        self.assertEqual(lookup_keys(self.path, 'a'), [])
+
+    def test_missing_user(self):
+        self.build({name: [user_key(name)] for name in ['bob', 'dave', 'frank']})
+        # Before the first, between two and after the last record.
+        for username in ['alice', 'carol', 'erin', 'zoe', '']:
+            self.assertEqual(lookup_keys(self.path, username), [], username)
+
+    def test_empty_index(self):
+        self.build({})
+        self.assertEqual(lookup_keys(self.path, 'alice'), [])
+
+    def test_several_keys(self):
+        keys = [user_key('alice', 1), user_key('alice', 2), 'ssh-rsa  AAAAB3NzaC1yc2E\tlaptop']
+        self.build({'alice': keys, 'bob': [user_key('bob')]})
+        # Whitespace inside a key is collapsed, so a tab cannot split it.
+        self.assertEqual(lookup_keys(self.path, 'alice'), keys[:2] + ['ssh-rsa AAAAB3NzaC1yc2E laptop'])
+
+    def test_user_without_keys(self):
+        self.build({'alice': [], 'bob': [user_key('bob')]})
+        self.assertEqual(lookup_keys(self.path, 'alice'), [])
+        self.assertEqual(lookup_keys(self.path, 'bob'), [user_key('bob')])
+
+    def test_non_ascii_usernames(self):
+        # Records are sorted by their UTF-8 bytes, the order the lookup compares them in.
+        users = {name: [user_key(str(i))] for i, name in enumerate(['z', 'é', 'a', 'ö', 'Z'])}
+        self.build(users)
+        for username, keys in users.items():
+            self.assertEqual(lookup_keys(self.path, username), keys, username)
+
+    def test_not_a_key_index(self):
+        for contents in [b'', b'AUTO', b'alice\tssh-ed25519 AAAA\n']:
+            with self.subTest(contents=contents):
+                with open(self.path, 'wb') as f:
+                    f.write(contents)
+                with self.assertRaises(KIFormatError):
+                    lookup_keys(self.path, 'alice')
+
+
+if __name__ == '__main__':
+    unittest.main()
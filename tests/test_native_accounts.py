@@ -0,0 +1,147 @@
+"""
+Applies account changes to the databases of a temporary `etc_dir`.
+"""
+
+from unittest import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from automatagl.helpers import native_accounts
+from automatagl.helpers.atomic_file import write_atomically as real_write_atomically
+from automatagl.helpers.native_accounts import NABGroupExistsError, NABUserExistsError, NativeAccountBackend
+
+passwd = """root:x:0:0:root:/root:/bin/bash
++nis-entry
+alice:x:1000:1000::/home/alice:/bin/bash
+nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin
+"""
+shadow = """root:*:18000:0:99999:7:::
+alice:!:18000:0:99999:7:::
+"""
+group = """root:x:0:
+alice:x:1000:
+admins:x:1001:alice
+nogroup:x:65534:
+"""
+gshadow = """root:*::
+alice:!::
+admins:!::alice
+nogroup:*::
+"""
+
+
+class NativeAccountBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.etc = os.path.join(self.root, 'etc')
+        os.makedirs(self.etc)
+        for name, contents in [('passwd', passwd), ('shadow', shadow), ('group', group), ('gshadow', gshadow),
+                               ('login.defs', 'UID_MIN 1000\nUID_MAX 1003\nGID_MIN 1000\nGID_MAX 60000\n')]:
+            self.write(name, contents)
+        self.backend = NativeAccountBackend(self.etc, os.path.join(self.etc, 'skel'))
+
+    def write(self, name, contents):
+        with open(os.path.join(self.etc, name), 'w') as f:
+            f.write(contents)
+
+    def read(self, name):
+        with open(os.path.join(self.etc, name), 'r') as f:
+            return f.read()
+
+    def entries(self, name):
+        return {i.split(':')[0]: i.split(':') for i in self.read(name).splitlines() if ':' in i}
+
+    def home(self, user):
+        return os.path.join(self.root, 'home', user)
+
+    def test_id_allocation(self):
+        self.assertEqual(self.backend.add_group('developers'), 1002)
+        self.assertEqual(self.backend.add_group('operators'), 1003)
+        # One past the highest UID in the range, IDs outside of it (nobody) are ignored.
+        self.assertEqual(self.backend.add_user('bob', 'developers', [], self.home('bob'), '/bin/sh'), (1001, 1002))
+        self.assertEqual(self.backend.add_user('carol', 'developers', [], self.home('carol'), '/bin/sh'), (1002, 1002))
+        self.assertEqual(self.backend.add_user('dave', 'developers', [], self.home('dave'), '/bin/sh'), (1003, 1002))
+        self.backend.commit()
+        self.assertEqual(self.entries('passwd')['carol'][2:], ['1002', '1002', '', self.home('carol'), '/bin/sh'])
+        self.assertIn('carol', self.entries('shadow'))
+        self.assertEqual(self.entries('gshadow')['operators'], ['operators', '!', '', ''])
+
+        # Once the top of the range is taken, the lowest free ID is reused.
+        self.backend.delete_user('bob')
+        self.assertEqual(self.backend.add_user('erin', 'developers', [], self.home('erin'), '/bin/sh')[0], 1001)
+        self.backend.commit()
+        self.assertNotIn('bob', self.entries('passwd'))
+        self.assertFalse(os.path.exists(self.home('bob')))
+
+    def test_existing_names(self):
+        with self.assertRaises(NABGroupExistsError):
+            self.backend.add_group('admins')
+        with self.assertRaises(NABUserExistsError):
+            self.backend.add_user('alice', 'admins', [], self.home('alice'), '/bin/sh')
+        self.backend.commit()
+        self.assertEqual(self.read('passwd'), passwd)
+
+    def test_members(self):
+        self.backend.add_group('developers')
+        self.backend.add_user('bob', 'developers', ['admins', 'developers'], self.home('bob'), '/bin/sh')
+        self.backend.commit()
+        self.assertEqual(self.entries('group')['admins'][3], 'alice,bob')
+        self.assertEqual(self.entries('gshadow')['developers'][3], 'bob')
+
+        self.backend.set_supplementary_groups('bob', ['developers'])
+        self.backend.set_supplementary_groups('alice', ['admins', 'developers'])
+        self.backend.commit()
+        self.assertEqual(self.entries('group')['admins'][3], 'alice')
+        self.assertEqual(self.entries('group')['developers'][3], 'bob,alice')
+        self.assertEqual(self.entries('gshadow')['admins'][3], 'alice')
+
+        self.backend.delete_user('alice')
+        self.backend.commit()
+        self.assertEqual(self.entries('group')['admins'][3], '')
+        self.assertEqual(self.entries('gshadow')['developers'][3], 'bob')
+        # Comments and NIS entries are kept as they are.
+        self.assertIn('+nis-entry\n', self.read('passwd'))
+
+    def test_backup(self):
+        self.backend.add_group('developers')
+        self.backend.commit()
+        self.assertEqual(self.read('group-'), group)
+        self.assertEqual(self.read('gshadow-'), gshadow)
+        # Databases that did not change are neither written nor backed up.
+        self.assertFalse(os.path.exists(os.path.join(self.etc, 'passwd-')))
+
+    def test_rollback(self):
+        written = list()
+
+        def write_atomically(path, contents, *args):
+            if path.endswith('gshadow'):
+                raise OSError('No space left on device')
+            written.append(path)
+            return real_write_atomically(path, contents, *args)
+
+        self.backend.add_group('developers')
+        self.backend.add_user('bob', 'developers', ['admins'], self.home('bob'), '/bin/sh')
+        self.backend.delete_user('alice')
+        with mock.patch.object(native_accounts, 'write_atomically', write_atomically):
+            with self.assertRaises(OSError):
+                self.backend.commit()
+        self.assertTrue(written)
+        for name, contents in [('passwd', passwd), ('shadow', shadow), ('group', group), ('gshadow', gshadow)]:
+            self.assertEqual(self.read(name), contents)
+        self.assertEqual([i for i in os.listdir(self.etc) if i.endswith('.tmp')], [])
+        # The home of the deleted user is only removed once the databases are written.
+        self.assertFalse(self.backend.pending_home_removals)
+
+        # The lock was released and nothing is left pending.
+        self.backend.add_group('developers')
+        self.backend.commit()
+        self.assertIn('developers', self.entries('group'))
+        self.assertNotIn('bob', self.entries('passwd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
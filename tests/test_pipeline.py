@@ -0,0 +1,100 @@
+"""
+Hands groups from a producer event loop to a consumer thread through a GroupPipeline.
+"""
+
+import asyncio
+import threading
+import time
+import unittest
+
+from automatagl.helpers.pipeline import GroupPipeline
+from automatagl.helpers.provider_operations import ProviderUser
+
+
+class GroupPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.groups = ['a', 'b', 'c', 'd']
+
+    def produce(self, pipeline, order):
+        """
+        Fetches the groups in `order` concurrently in a new event loop, recording when each one was started.
+        """
+        started = list()
+
+        async def fetch(group):
+            await pipeline.wait_turn(group)
+            started.append(group)
+            await asyncio.sleep(0.01)
+            pipeline.put(group, [ProviderUser(group)])
+
+        async def fetch_all():
+            await asyncio.gather(*[fetch(i) for i in order])
+
+        def run():
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(fetch_all())
+            finally:
+                loop.close()
+                pipeline.finish()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.addCleanup(thread.join)
+        return started
+
+    def test_order_of_precedence(self):
+        pipeline = GroupPipeline(self.groups, depth=4)
+        self.produce(pipeline, list(reversed(self.groups)))
+        applied = list()
+        while True:
+            fetched = pipeline.get(time.monotonic() + 5)
+            if fetched is None:
+                break
+            applied.append(fetched[0])
+            self.assertEqual(fetched[1], [ProviderUser(fetched[0])])
+            pipeline.done(fetched[0])
+        self.assertEqual(applied, self.groups)
+
+    def test_back_pressure(self):
+        pipeline = GroupPipeline(self.groups, depth=2)
+        started = self.produce(pipeline, self.groups)
+        self.assertEqual(pipeline.get(time.monotonic() + 5)[0], 'a')
+        self.assertTrue(pipeline.ready())
+        time.sleep(0.1)
+        # Nothing is applied yet, so only the first `depth` groups may be fetched.
+        self.assertEqual(sorted(started), ['a', 'b'])
+        pipeline.done('a')
+        self.assertEqual(pipeline.get(time.monotonic() + 5)[0], 'b')
+        time.sleep(0.1)
+        self.assertEqual(sorted(started), ['a', 'b', 'c'])
+        pipeline.close()
+
+    def test_deadline(self):
+        pipeline = GroupPipeline(self.groups, depth=1)
+        self.assertFalse(pipeline.ready())
+        started = time.monotonic()
+        self.assertIsNone(pipeline.get(started + 0.05))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertIsNone(pipeline.get(time.monotonic() - 1))
+
+    def test_provider_finished_without_the_group(self):
+        pipeline = GroupPipeline(self.groups, depth=4)
+        pipeline.put('b', list())
+        pipeline.finish()
+        # `a` never arrives, so `b` cannot be applied either.
+        self.assertIsNone(pipeline.get())
+
+    def test_done_out_of_order(self):
+        pipeline = GroupPipeline(self.groups, depth=4)
+        pipeline.put('a', list())
+        pipeline.put('b', list())
+        with self.assertRaises(ValueError):
+            pipeline.done('b')
+        pipeline.done('a')
+        self.assertEqual(pipeline.get(), ('b', list()))
+
+
+if __name__ == '__main__':
+    unittest.main()
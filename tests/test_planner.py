@@ -0,0 +1,73 @@
+"""
+Plans against an in-memory local state index.
+"""
+
+from types import SimpleNamespace
+import unittest
+
+from automatagl.helpers.local_state import LocalStateIndex
+from automatagl.helpers.planner import Planner, build_desired_state
+from automatagl.helpers.provider_operations import AutomataGroupConfig, ProviderUser
+
+
+class FakeUserOps:
+    """
+    Only the parts of `UserOps` the planner reads.
+    """
+
+    def __init__(self, local_state):
+        self.local_state = local_state
+
+    def ssh_file_is_current(self, ssh_keys, gid):
+        return True
+
+    def key_index_is_current(self, key_index, contents):
+        return True
+
+    def sudoers_file_is_current(self, sudoers_file, gitlab_groups):
+        return True
+
+
+class PlannerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.groups = [
+            AutomataGroupConfig('admins', 'admins', '', []),
+            AutomataGroupConfig('developers', 'developers', '', []),
+        ]
+        self.config = SimpleNamespace(groups=self.groups, authorized_keys_files=True, key_index=None, sudoers_file='')
+        # alice belongs to both groups and is owned by `admins`, bob only belongs to `admins`.
+        index = LocalStateIndex(
+            [('alice', 'x', 2000, 3000), ('bob', 'x', 2001, 3000), ('carol', 'x', 2002, 3001)],
+            [('admins', 'x', 3000, []), ('developers', 'x', 3001, ['alice'])],
+        )
+        self.planner = Planner(FakeUserOps(index), self.config)
+
+    def plan(self, group_members):
+        return self.planner.plan(build_desired_state(self.groups, group_members))
+
+    def test_complete_plan(self):
+        plan = self.plan({
+            'admins': [ProviderUser('alice'), ProviderUser('bob')],
+            'developers': [ProviderUser('alice'), ProviderUser('carol')],
+        })
+        self.assertEqual(plan.user_adds, [])
+        self.assertEqual(plan.user_deletes, [])
+
+    def test_missing_group_members_are_left_alone(self):
+        # `admins` was refused, alice must neither be recreated in `developers` nor bob deleted.
+        plan = self.plan({'developers': [ProviderUser('alice'), ProviderUser('carol')]})
+        self.assertEqual(plan.user_adds, [])
+        self.assertEqual(plan.user_deletes, [])
+        self.assertEqual(plan.group_changes, [])
+        self.assertEqual(plan.key_changes, [])
+
+    def test_users_of_fetched_groups_are_still_deleted(self):
+        plan = self.plan({'admins': [ProviderUser('alice'), ProviderUser('bob')]})
+        self.assertEqual([i.user for i in plan.user_deletes], [])
+        plan = self.plan({'admins': [ProviderUser('alice'), ProviderUser('bob')], 'developers': []})
+        self.assertEqual([i.user for i in plan.user_deletes], ['carol'])
+
+
+if __name__ == '__main__':
+    unittest.main()
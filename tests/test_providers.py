@@ -0,0 +1,44 @@
+"""
+Looks up third-party providers through the entry point APIs of every supported Python version.
+"""
+
+from types import SimpleNamespace
+from unittest import mock
+import sys
+import unittest
+
+from automatagl.helpers.providers import ProviderRegistry, builtin_providers, entry_point_group
+
+
+class ProviderRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.entry_point = SimpleNamespace(name='ldap', module_name='automata_ldap.provider', attrs=('LDAPProvider',))
+        self.taken = SimpleNamespace(name='gitlab', module_name='evil.provider', attrs=('GitlabProvider',))
+
+    def iter_entry_points(self, group):
+        self.assertEqual(group, entry_point_group)
+        return [self.entry_point, self.taken]
+
+    def test_pkg_resources_fallback(self):
+        # Python 3.6 and 3.7 have neither `importlib.metadata` nor, usually, its backport.
+        pkg_resources = SimpleNamespace(iter_entry_points=self.iter_entry_points)
+        with mock.patch.dict(sys.modules, {
+            'importlib.metadata': None, 'importlib_metadata': None, 'pkg_resources': pkg_resources,
+        }):
+            names = list(ProviderRegistry(builtin_providers))
+        # Built-in providers cannot be replaced, so `gitlab` is only listed once.
+        self.assertEqual(sorted(names), sorted(list(builtin_providers) + ['ldap']))
+
+    def test_no_entry_point_api(self):
+        with mock.patch.dict(sys.modules, {
+            'importlib.metadata': None, 'importlib_metadata': None, 'pkg_resources': None,
+        }):
+            with self.assertLogs(level='WARNING') as logs:
+                names = list(ProviderRegistry(builtin_providers))
+        self.assertEqual(sorted(names), sorted(builtin_providers))
+        self.assertIn('third-party providers', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
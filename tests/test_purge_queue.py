@@ -0,0 +1,102 @@
+"""
+Tombstones and purges home directories in a temporary home directory.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from automatagl.helpers.purge_queue import PurgeQueue
+
+
+class PurgeQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.queue_file = os.path.join(self.root, 'state', 'purge_queue.json')
+        self.tombstone_dir = os.path.join(self.root, 'home', '.automata-purge')
+
+    def queue(self, **kwargs):
+        queue = PurgeQueue(self.queue_file, self.tombstone_dir, **kwargs)
+        self.addCleanup(queue.finish, 5)
+        return queue
+
+    def make_home(self, user, files=3):
+        home = os.path.join(self.root, 'home', user)
+        os.makedirs(os.path.join(home, '.ssh'))
+        for i in range(files):
+            with open(os.path.join(home, 'file{}'.format(i)), 'w') as f:
+                f.write('data')
+        os.symlink('/etc/passwd', os.path.join(home, 'link'))
+        return home
+
+    def persisted(self):
+        with open(self.queue_file, 'r') as f:
+            return json.load(f)
+
+    def test_tombstone(self):
+        home = self.make_home('alice')
+        queue = self.queue(retention=3600)
+        tombstone = queue.enqueue('alice', home)
+        self.assertFalse(os.path.exists(home))
+        self.assertEqual(os.path.dirname(tombstone), self.tombstone_dir)
+        self.assertTrue(os.path.isfile(os.path.join(tombstone, 'file0')))
+        self.assertEqual([(i['user'], i['path']) for i in self.persisted()], [('alice', tombstone)])
+        self.assertEqual(os.listdir(os.path.dirname(self.queue_file)), ['purge_queue.json'])
+
+    def test_retention(self):
+        queue = self.queue(retention=3600)
+        kept = queue.enqueue('alice', self.make_home('alice'))
+        queue.start()
+        queue.finish(5)
+        self.assertTrue(os.path.isdir(kept))
+        self.assertEqual(len(self.persisted()), 1)
+
+    def test_purge(self):
+        queue = self.queue(retention=0)
+        tombstone = queue.enqueue('alice', self.make_home('alice', files=20))
+        queue.start()
+        queue.finish(5)
+        self.assertFalse(os.path.exists(tombstone))
+        # The symlink is removed, not followed.
+        self.assertTrue(os.path.exists('/etc/passwd'))
+        self.assertEqual(self.persisted(), [])
+
+    def test_throttle(self):
+        queue = self.queue(retention=0, files_per_second=50)
+        queue.enqueue('alice', self.make_home('alice', files=10))
+        started = time.monotonic()
+        queue.start()
+        queue.finish(5)
+        # 10 files, the symlink and `.ssh` at 50 files per second.
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(self.persisted(), [])
+
+    def test_persisted_queue(self):
+        queue = self.queue(retention=3600)
+        tombstone = queue.enqueue('alice', self.make_home('alice'))
+        del queue
+
+        # The next run picks up where the last one left off, once the retention period is over.
+        queue = self.queue(retention=0)
+        self.assertEqual([i['path'] for i in queue.entries], [tombstone])
+        queue.start()
+        queue.finish(5)
+        self.assertFalse(os.path.exists(tombstone))
+        self.assertEqual(self.persisted(), [])
+
+    def test_unreadable_queue(self):
+        os.makedirs(os.path.dirname(self.queue_file))
+        with open(self.queue_file, 'w') as f:
+            f.write('{')
+        with self.assertLogs(level='WARNING'):
+            queue = self.queue()
+        self.assertEqual(queue.entries, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
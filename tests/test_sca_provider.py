@@ -0,0 +1,168 @@
+"""
+Logs in to a local server standing in for the SCA API, reusing the cached access token while it is valid.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from automatagl.helpers.provider_operations import ProviderUser
+from automatagl.helpers.providers.sca_provider import SCANotAuthorized, SCAProvider
+
+
+def make_token(expiry: float, serial: int = 0) -> str:
+    claims = base64.urlsafe_b64encode(json.dumps({'exp': expiry, 'jti': serial}).encode('utf-8')).rstrip(b'=')
+    return 'eyJhbGciOiJIUzI1NiJ9.{}.signature'.format(claims.decode('ascii'))
+
+
+class StubSCAHandler(BaseHTTPRequestHandler):
+    """
+    Hands out a new token on every login and only accepts the tokens it handed out itself.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.record('POST', self.path)
+        if body != {'username': 'automata', 'password': 'secret'}:
+            return self.send_json({'message': 'Invalid credentials'}, 401)
+        token = make_token(time.time() + 3600, len(self.server.tokens))
+        self.server.tokens.add(token)
+        return self.send_json({'access_token': token})
+
+    def do_GET(self):
+        self.server.record('GET', self.path)
+        if self.headers.get('Authorization', '')[len('Bearer '):] not in self.server.tokens:
+            return self.send_json({'message': 'Token expired'}, 401)
+        if self.path == '/api/groups':
+            return self.send_json([{'id': 7, 'name': 'admins'}])
+        if self.path == '/api/group/7':
+            return self.send_json({'users': [{'username': 'alice', 'keys': [{'pub_ssh_key': 'ssh-ed25519 AAAA'}]}]})
+        return self.send_json({'message': 'Not found'}, 404)
+
+    def send_json(self, body, status: int = 200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+class StubSCAServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSCAHandler)
+        self.tokens = set()
+        self.requests = list()
+        self.lock = threading.Lock()
+
+    def record(self, method, path):
+        with self.lock:
+            self.requests.append((method, path))
+
+    def logins(self):
+        return len([i for i in self.requests if i == ('POST', '/api/login')])
+
+
+class SCAProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubSCAServer()
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.config = {
+            'api_address': 'http://127.0.0.1:{}/api'.format(self.server.server_address[1]),
+            'username': 'automata',
+            'password': 'secret',
+            'token_cache': os.path.join(self.root, 'cache', 'sca_token.json'),
+            'max_retries': 0,
+        }
+
+    def provider(self):
+        provider = SCAProvider(self.config)
+        self.addCleanup(provider.session.session.close)
+        return provider
+
+    def cache_token(self, token):
+        os.makedirs(os.path.dirname(self.config['token_cache']), exist_ok=True)
+        with open(self.config['token_cache'], 'w') as f:
+            json.dump({'api_address': self.config['api_address'], 'username': 'automata', 'access_token': token}, f)
+
+    def cached_token(self):
+        with open(self.config['token_cache'], 'r') as f:
+            return json.load(f)['access_token']
+
+    def test_login_once_and_cache_the_token(self):
+        provider = self.provider()
+        self.assertEqual(provider.fetch_groups(['admins']), {'admins': [ProviderUser('alice', ['ssh-ed25519 AAAA'])]})
+        self.assertEqual(self.server.logins(), 1)
+        self.assertEqual(self.cached_token(), provider.jwt_token)
+        self.assertEqual(os.stat(self.config['token_cache']).st_mode & 0o777, 0o600)
+
+        # The next run reuses the cached token.
+        self.provider().fetch_groups(['admins'])
+        self.assertEqual(self.server.logins(), 1)
+
+    def test_expired_token_is_not_reused(self):
+        expired = make_token(time.time() + 30)
+        self.server.tokens.add(expired)
+        self.cache_token(expired)
+        provider = self.provider()
+        # The token expires within the minute of slack, so a new one is requested before anything else.
+        self.assertEqual(self.server.requests[0], ('POST', '/api/login'))
+        self.assertNotEqual(provider.jwt_token, expired)
+        self.assertNotEqual(self.cached_token(), expired)
+
+    def test_malformed_token_is_not_reused(self):
+        self.cache_token('not-a-jwt')
+        self.provider()
+        self.assertEqual(self.server.logins(), 1)
+
+    def test_token_of_another_server_is_not_reused(self):
+        token = make_token(time.time() + 3600)
+        self.server.tokens.add(token)
+        self.cache_token(token)
+        self.config['username'] = 'someone-else'
+        with self.assertRaises(SCANotAuthorized):
+            self.provider()
+
+    def test_login_again_on_401(self):
+        # The cached token looks valid, but the server revoked it.
+        self.cache_token(make_token(time.time() + 3600))
+        provider = self.provider()
+        self.assertEqual(self.server.logins(), 0)
+        self.assertEqual(provider.fetch_groups(['admins'])['admins'], [ProviderUser('alice', ['ssh-ed25519 AAAA'])])
+        self.assertEqual(self.server.logins(), 1)
+        self.assertEqual(self.server.requests[:3], [
+            ('GET', '/api/groups'), ('POST', '/api/login'), ('GET', '/api/groups'),
+        ])
+        self.assertEqual(self.cached_token(), provider.jwt_token)
+
+    def test_uncacheable_token(self):
+        self.config['token_cache'] = os.path.join(self.root, 'file', 'sca_token.json')
+        with open(os.path.join(self.root, 'file'), 'w'):
+            pass
+        with self.assertLogs(level='WARNING') as logs:
+            provider = self.provider()
+        self.assertIn('Cannot cache the SCA access token', logs.output[0])
+        self.assertEqual(provider.fetch_groups(['admins'])['admins'], [ProviderUser('alice', ['ssh-ed25519 AAAA'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
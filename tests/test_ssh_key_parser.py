@@ -0,0 +1,163 @@
+"""
+Parses and filters real public keys generated with `ssh-keygen`.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from automatagl.helpers.provider_operations import KeyPolicy
+from automatagl.helpers.ssh_key_object import SSHKeyObject
+from automatagl.helpers.ssh_key_parser import KeyParser, SKPInvalidKeyError, parse_key
+
+ed25519_key = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIMQSnDU1ODawmaZETTKlrReI7zpGutdmaN/BJ/G59UaP ed25519@test'
+rsa_2048_key = (
+    'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQDgQZMZ+vhmLyfgzETKQGR+T+Cz1/VFZL7g/wXaOqQDfSXAWV60yEf0Mczei+p5'
+    'CAvH4G1O79aEHLWWfuaGsi+DxnI61ARYwBHMy+IySc/J9s80polJAUOEK0y8k+k2KQ6J1mlmveCyavVYlqOv+6HXwf0yrWi7+r0T'
+    'enJ3LOcj25c4iDLyDt9c3kKgcMiLGCC5oTGJPyTcaT+b7OD0yIj5ZSywEEZsS5kfzyU+Q42hNuU2lWnHRlMV05Tfa5/p+82zpZUk'
+    'Jjo8LrJnV859VN+Uh9pS42/j6Pm/1S6gXBiqxKCIMU/9c6Ul/c8TFAsizFdl62hhk27OZPzvwXxi3jjB rsab2048@test'
+)
+rsa_1024_key = (
+    'ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAAAgQDCRyDWMcUd7EE9jydwzpXdsf+atRaJZQRWUuLTrXWBhl/ODFPxw7yqUKBHodYk'
+    'pY/jbmzuUR8usSA0IdveCps1EHtY7zsQ7WG2K23BrkkJnltm88crANKzGMA30e5VfcLicxITAX+7rqzfep2FnQLfk/NYEfayGNnA'
+    'nEtOeRjT7w== rsab1024@test'
+)
+ecdsa_key = (
+    'ecdsa-sha2-nistp256 AAAAE2VjZHNhLXNoYTItbmlzdHAyNTYAAAAIbmlzdHAyNTYAAABBBEgZm5eY5xi9tM3chb+SsYHV+b2c'
+    '3opWOF/5gDeaLeAfUQIyjtn6BYOzVPs9XZPL/oJuon5UJV9iL9aGZNmMhf0= ecdsab256@test'
+)
+dsa_key = (
+    'ssh-dss AAAAB3NzaC1kc3MAAACBAP1aUhaI3NjYkXymdcj3ZoAqK3TaabomCk8cgm+4n5HcMpUFTzWXTCk69GGxQzUJN0GfGKGo'
+    'WkGmHm/vciEDKCTY92CzPdkfAIY2GH/n31uRMixLWpXv6zbU9QSksOENDJ2NxRYgb63CJYzbHfsF7KAAlhzkkt/9AuuyYLiVRqk5'
+    'AAAAFQCYDL5B6m1aSR+mDGvJ+uBM9Agn0QAAAIAPzYAEun7pKgSZDxPpN0GmxrSPSUKUT084lM4J9hhF8tYjRS5UuQQD10Wh3V/D'
+    'CvpTHVC0+9a/rkKl2xTAFc2OUpXKoLIod8yhUA1Afz4r99pBh2uAEjKDz7hHfsqfRbuDGAWS1TgOxDR21mS9niqx5GEoFbsE5zAq'
+    'dyh5iM0+/gAAAIAuRJXHw/RG9nTTH6c8LKoFaKVHtc5d36jMieD7ghYYdCuK9aTAgpvfA0K23Goig8DcVacgwlVg3U8ou1nlWGjJ'
+    'Lx//yNCgowoTVF7ed+nFpqtxxOsNEI/T5l9KUDjQD2QHPquWMgF3YWSX/ksmGUOg1NIUcMy+IU6o+Ba38OjMJg== dsa@test'
+)
+ed25519_certificate = (
+    'ssh-ed25519-cert-v01@openssh.com AAAAIHNzaC1lZDI1NTE5LWNlcnQtdjAxQG9wZW5zc2guY29tAAAAIKvterozm3RirMA'
+    'YlrWB75ZW3AkugZW4M1vc9zqHAuPUAAAAIMQSnDU1ODawmaZETTKlrReI7zpGutdmaN/BJ/G59UaPAAAAAAAAAAAAAAABAAAABHR'
+    'lc3QAAAAJAAAABWFsaWNlAAAAAAAAAAD//////////wAAAAAAAACCAAAAFXBlcm1pdC1YMTEtZm9yd2FyZGluZwAAAAAAAAAXcGV'
+    'ybWl0LWFnZW50LWZvcndhcmRpbmcAAAAAAAAAFnBlcm1pdC1wb3J0LWZvcndhcmRpbmcAAAAAAAAACnBlcm1pdC1wdHkAAAAAAAA'
+    'ADnBlcm1pdC11c2VyLXJjAAAAAAAAAAAAAAAzAAAAC3NzaC1lZDI1NTE5AAAAIFdEGIReCjpjQxJ7p4VYG7lQtLnYy7QMGxTCP2N'
+    '35qcfAAAAUwAAAAtzc2gtZWQyNTUxOQAAAEAnM9iKBczKWm8GChh2jlzWbVW8Kwu3UOaNuB7QnIBhyCSwpBFkaqGUQMRf3d5WyA3'
+    'q3zxnEGbV1S70/6NmuUgM ed25519@test'
+)
+rsa_1024_certificate = (
+    'ssh-rsa-cert-v01@openssh.com AAAAHHNzaC1yc2EtY2VydC12MDFAb3BlbnNzaC5jb20AAAAgXaUW+BqiD0VX9J1awNdJE99'
+    'VUS5Lm78Cz9LqnQzKE5YAAAADAQABAAAAgQDCRyDWMcUd7EE9jydwzpXdsf+atRaJZQRWUuLTrXWBhl/ODFPxw7yqUKBHodYkpY/'
+    'jbmzuUR8usSA0IdveCps1EHtY7zsQ7WG2K23BrkkJnltm88crANKzGMA30e5VfcLicxITAX+7rqzfep2FnQLfk/NYEfayGNnAnEt'
+    'OeRjT7wAAAAAAAAAAAAAAAQAAAAR0ZXN0AAAACQAAAAVhbGljZQAAAAAAAAAA//////////8AAAAAAAAAggAAABVwZXJtaXQtWDE'
+    'xLWZvcndhcmRpbmcAAAAAAAAAF3Blcm1pdC1hZ2VudC1mb3J3YXJkaW5nAAAAAAAAABZwZXJtaXQtcG9ydC1mb3J3YXJkaW5nAAA'
+    'AAAAAAApwZXJtaXQtcHR5AAAAAAAAAA5wZXJtaXQtdXNlci1yYwAAAAAAAAAAAAAAMwAAAAtzc2gtZWQyNTUxOQAAACBXRBiEXgo'
+    '6Y0MSe6eFWBu5ULS52Mu0DBsUwj9jd+anHwAAAFMAAAALc3NoLWVkMjU1MTkAAABAPQ2U68g507ZjdluGdNtOAVlPByf02qeKXbp'
+    'P3lhAvtGInQxW+OI1jttML7sW31Qe1cWDiytPKNoaoH1zkWP0DQ== rsab1024@test'
+)
+
+
+class ParseKeyTest(unittest.TestCase):
+
+    def test_key_types(self):
+        # The sizes and fingerprints `ssh-keygen -l` reports.
+        for key, key_type, bits, fingerprint in [
+            (ed25519_key, 'ssh-ed25519', 256, 'SHA256:D4EW5oPkYiUX0lf+0YZ8OJw7/nG88SVPOGVkl7eUVI4'),
+            (rsa_2048_key, 'ssh-rsa', 2048, 'SHA256:/22PtB5EIYrBepds+EVotYss+tJVjpflU0S852moO5w'),
+            (ecdsa_key, 'ecdsa-sha2-nistp256', 256, 'SHA256:sglUxZA+JS73tY5fWXCYp/ibDGnuKQgnM8JLmErAFBM'),
+            (rsa_1024_key, 'ssh-rsa', 1024, None),
+            (dsa_key, 'ssh-dss', 1024, None),
+            (rsa_1024_certificate, 'ssh-rsa-cert-v01@openssh.com', 1024, None),
+            (ed25519_certificate, 'ssh-ed25519-cert-v01@openssh.com', 256, None),
+        ]:
+            with self.subTest(key_type=key_type, bits=bits):
+                parsed = parse_key(key)
+                self.assertEqual(parsed.type, key_type)
+                self.assertEqual(parsed.bits, bits)
+                self.assertEqual(parsed.blob, key.split()[1])
+                if fingerprint:
+                    self.assertEqual(parsed.fingerprint, fingerprint)
+
+    def test_comment(self):
+        self.assertEqual(parse_key(ed25519_key).comment, 'ed25519@test')
+        self.assertEqual(parse_key(ed25519_key + ' with spaces').comment, 'ed25519@test with spaces')
+        self.assertEqual(parse_key(' '.join(ed25519_key.split()[:2])).comment, '')
+
+    def test_invalid_keys(self):
+        blob = ed25519_key.split()[1]
+        for key in [
+            '',
+            'ssh-ed25519',
+            'ssh-ed25519 not*base64',
+            'ssh-rsa {}'.format(blob),  # The blob says ssh-ed25519.
+            'ssh-ed25519 {}'.format(blob[:-8]),  # Truncated.
+            'ssh-foo {}'.format(parse_key(rsa_2048_key).blob),
+        ]:
+            with self.subTest(key=key):
+                with self.assertRaises(SKPInvalidKeyError):
+                    parse_key(key)
+
+
+class KeyParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        self.cache_file = os.path.join(self.state_dir, 'state', 'key_cache.json')
+
+    @staticmethod
+    def filter(keys, parser=None):
+        parser = parser or KeyParser()
+        return [i.fingerprint for i in parser.filter_keys('alice', keys)]
+
+    def test_default_policy(self):
+        with self.assertLogs(level='WARNING') as logs:
+            accepted = self.filter(accepted_keys + rejected_keys)
+        self.assertEqual(accepted, [parse_key(i).fingerprint for i in accepted_keys])
+        self.assertEqual(len(logs.output), len(rejected_keys))
+
+    def test_duplicates_by_fingerprint(self):
+        # The same key with another comment, and the same key twice, are only listed once.
+        renamed = ' '.join(rsa_2048_key.split()[:2] + ['laptop'])
+        parser = KeyParser()
+        self.assertEqual(len(self.filter([rsa_2048_key, renamed, rsa_2048_key, ed25519_key], parser)), 2)
+        self.assertEqual(parser.counts['keys_duplicate'], 2)
+
+    def test_custom_policy(self):
+        parser = KeyParser(KeyPolicy(allowed_types=['ssh-ed25519'], min_bits={}))
+        with self.assertLogs(level='WARNING'):
+            accepted = parser.filter_keys('alice', [rsa_2048_key, ed25519_key, ed25519_certificate])
+        self.assertEqual([i.type for i in accepted], ['ssh-ed25519', 'ssh-ed25519-cert-v01@openssh.com'])
+
+    def test_cache(self):
+        parser = KeyParser(cache_file=self.cache_file)
+        self.filter([ed25519_key, rsa_2048_key], parser)
+        parser.save()
+        with open(self.cache_file, 'r') as f:
+            self.assertEqual(len(json.load(f)), 2)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache_file)), ['key_cache.json'])
+
+        # The next run reads the parse results from the cache, and forgets keys that are gone.
+        parser = KeyParser(cache_file=self.cache_file)
+        self.assertEqual(self.filter([ed25519_key], parser), [parse_key(ed25519_key).fingerprint])
+        self.assertEqual((parser.counts['keys_parsed'], parser.counts['keys_cached']), (0, 1))
+        parser.save()
+        with open(self.cache_file, 'r') as f:
+            self.assertEqual(len(json.load(f)), 1)
+
+    def test_key_object(self):
+        ssh_keys = SSHKeyObject(username='alice')
+        with self.assertLogs(level='WARNING'):
+            ssh_keys.add_keys([ed25519_key, dsa_key], KeyParser())
+        self.assertEqual(ssh_keys.ssh_keys, [ed25519_key])
+        authorized_keys = '# This file is automatically generated by Automata.\n{}\n'.format(ed25519_key)
+        self.assertEqual(ssh_keys.get_authorized_keys(), authorized_keys)
+
+
+accepted_keys = [ed25519_key, rsa_2048_key, ecdsa_key, ed25519_certificate]
+# DSA keys, short RSA keys and certificates of short RSA keys, and keys that are not keys at all.
+rejected_keys = [dsa_key, rsa_1024_key, rsa_1024_certificate, 'ssh-ed25519 AAAA']
+
+
+if __name__ == '__main__':
+    unittest.main()